@@ -0,0 +1,162 @@
+'''Backend di inferenza alternativi a PyTorch per i modelli Anomalib esportati (ONNX Runtime, OpenVINO).
+
+Il grafo esportato (vedi anomalib_export.py) riceve lo stesso tensore del
+percorso Torch — float32 NCHW RGB in [0, 1] alla risoluzione dell'entry — e
+restituisce anomaly map, score grezzo e, se il checkpoint contiene soglie e
+statistiche, lo score normalizzato già calcolato nel grafo.
+'''
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+
+from utils.logger import get_logger
+
+logger = get_logger('anomalib')
+
+BACKENDS = ("torch", "onnx", "openvino")
+
+# Estensione dell'artefatto per backend, nella cartella weights/<backend>/ accanto al checkpoint
+ARTIFACT_SUFFIX = {"onnx": ".onnx", "openvino": ".xml"}
+
+INPUT_NAME = "images"
+OUTPUT_NAMES = ("anomaly_map", "pred_score", "normalized_score")
+
+
+def entry_backend(model_entry: dict) -> str:
+    backend = str(model_entry.get("backend", "torch")).lower()
+    if backend not in BACKENDS:
+        logger.warning(f"⚠️ Backend '{backend}' sconosciuto per {model_entry['name']}, uso torch.")
+        return "torch"
+    return backend
+
+
+def artifact_path(ckpt_path: Path, entry_name: str, backend: str, precision: str = "fp32") -> Path:
+    '''results/<Model>/<dataset>/latest/weights/<backend>/<entry>[.int8].<ext>'''
+    stem = entry_name if precision == "fp32" else f"{entry_name}.{precision}"
+    return ckpt_path.parent.parent / backend / f"{stem}{ARTIFACT_SUFFIX[backend]}"
+
+
+def metadata_path(artifact: Path) -> Path:
+    return artifact.with_suffix(".json")
+
+
+def is_promoted(artifact: Path) -> bool:
+    '''True se l'artefatto quantizzato ha superato il controllo di accuratezza (anomalib_quantize.py).'''
+    try:
+        metadata = json.loads(metadata_path(artifact).read_text())
+    except (OSError, ValueError):
+        return False
+    return bool((metadata.get("quantization") or {}).get("promoted"))
+
+
+class ExportWrapper(nn.Module):
+    '''Modello Anomalib + post-processing in un unico grafo esportabile.
+
+    Estrae l'anomaly map qualunque sia la forma dell'output del modello,
+    ricava lo score immagine dal massimo della mappa se il modello non lo
+    fornisce e applica la normalizzazione min-max centrata sulla soglia.
+    '''
+
+    def __init__(self, torch_model: nn.Module, thresholds: dict):
+        super().__init__()
+        self.model = torch_model
+        image, low, high = thresholds.get("image"), thresholds.get("min"), thresholds.get("max")
+        self.normalize = image is not None and low is not None and high is not None and high > low
+        self.register_buffer("threshold", torch.tensor(float(image) if image is not None else 0.0))
+        self.register_buffer("scale", torch.tensor(float(high - low) if self.normalize else 1.0))
+
+    @property
+    def output_names(self) -> list[str]:
+        return list(OUTPUT_NAMES if self.normalize else OUTPUT_NAMES[:2])
+
+    def forward(self, images: torch.Tensor):
+        output = self.model(images)
+        if isinstance(output, dict):
+            anomaly_map = output.get("anomaly_map", output.get("anomaly_maps"))
+            pred_score = output.get("pred_score", output.get("pred_scores"))
+        elif isinstance(output, torch.Tensor):
+            anomaly_map, pred_score = output, None
+        else:
+            anomaly_map, pred_score = getattr(output, "anomaly_map"), getattr(output, "pred_score", None)
+
+        if anomaly_map.ndim == 3:
+            anomaly_map = anomaly_map.unsqueeze(1)
+        if pred_score is None:
+            pred_score = anomaly_map.flatten(1).amax(dim=1)
+        pred_score = pred_score.reshape(-1)
+
+        if not self.normalize:
+            return anomaly_map, pred_score
+        normalized = ((pred_score - self.threshold) / self.scale + 0.5).clamp(0.0, 1.0)
+        return anomaly_map, pred_score, normalized
+
+
+class ExportedModel:
+    '''Modello esportato caricato in ONNX Runtime o OpenVINO, con la stessa chiamata del modello Torch.
+
+    Restituisce un dict di tensori (anomaly_map, pred_score, normalized_score)
+    così che il runner lo tratti come l'output di un modello Anomalib.
+    '''
+
+    def __init__(self, artifact: Path, backend: str, device: str = "cpu"):
+        self.artifact = Path(artifact)
+        self.backend = backend
+        self.metadata = json.loads(metadata_path(self.artifact).read_text())
+        self.thresholds = self.metadata.get("thresholds") or {}
+        self.size = int(self.metadata["size"])
+        self.device = torch.device("cpu")  # gli output tornano sempre su CPU
+        files = (self.artifact, self.artifact.with_suffix(".bin"), metadata_path(self.artifact))
+        self.nbytes = sum(path.stat().st_size for path in files if path.exists())
+        threads = int(os.getenv("ANOMALIB_CPU_THREADS", "0"))
+
+        if backend == "onnx":
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if threads > 0:
+                options.intra_op_num_threads = threads
+            providers = ["CPUExecutionProvider"]
+            if device.startswith("cuda") and "CUDAExecutionProvider" in ort.get_available_providers():
+                providers.insert(0, "CUDAExecutionProvider")
+            self._session = ort.InferenceSession(str(self.artifact), options, providers=providers)
+            self.output_names = [output.name for output in self._session.get_outputs()]
+        elif backend == "openvino":
+            import openvino as ov
+
+            config = {"PERFORMANCE_HINT": "LATENCY"}
+            if threads > 0:
+                config["INFERENCE_NUM_THREADS"] = threads
+            self._compiled = ov.Core().compile_model(str(self.artifact), "CPU", config)
+            self.output_names = [output.get_any_name() for output in self._compiled.outputs]
+        else:
+            raise ValueError(f"Backend non esportato: {backend}")
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+    def __call__(self, images: torch.Tensor) -> dict:
+        inputs = np.ascontiguousarray(images.detach().cpu().numpy(), dtype=np.float32)
+        if self.backend == "onnx":
+            values = self._session.run(self.output_names, {INPUT_NAME: inputs})
+        else:
+            result = self._compiled({INPUT_NAME: inputs})
+            values = [result[output] for output in self._compiled.outputs]
+        return {name: torch.from_numpy(np.asarray(value)) for name, value in zip(self.output_names, values)}
+
+
+def load_exported_model(artifact: Path, device: str = "cpu") -> ExportedModel | None:
+    backend = next((name for name, suffix in ARTIFACT_SUFFIX.items() if artifact.suffix == suffix), None)
+    if backend is None or not metadata_path(artifact).exists():
+        logger.error(f"❌ Artefatto esportato non valido o senza metadati: {artifact}")
+        return None
+    model = ExportedModel(artifact, backend, device)
+    logger.info(f"✅ Modello esportato caricato con {backend}: {artifact.name}")
+    return model
@@ -0,0 +1,432 @@
+'''Configurazione dei modelli Anomalib: caricamento unico, validazione e hot reload.
+
+Il file YAML viene letto e validato una sola volta; le richieste usano la
+configurazione già in memoria. Le entry con errori (modello sconosciuto, tipo
+o valore non ammesso, nome duplicato) vengono escluse e segnalate; i campi
+sconosciuti sono solo avvisi. Nel processo che serve l'inferenza un thread
+controlla la data di modifica del file. Se cambia, la nuova versione viene
+validata, i modelli appena abilitati vengono caricati in background e solo
+allora la configurazione viene sostituita in blocco. Un YAML non leggibile
+lascia in uso la versione precedente.
+
+    python anomalib_config.py                  # report di validazione, exit 1 se ci sono errori
+    python anomalib_config.py --config altro.yaml --json
+'''
+import argparse
+import difflib
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Callable
+
+import yaml
+
+from utils.paths import CONFIGS_DIR
+from utils.logger import get_logger
+
+logger = get_logger('anomalib')
+
+ANOMALIB_CONFIG_PATH = CONFIGS_DIR / "anomalib_models.yaml"
+
+# Classi istanziabili da anomalib_runner.load_anomalib_model
+KNOWN_MODELS = ("Padim", "Patchcore", "Draem", "Cfa", "ReverseDistillation", "EfficientAd")
+
+# Campo -> (tipo, valori ammessi). Gli elenchi sono quelli di anomalib_backends e
+# patchcore_index, ripetuti qui per non importare torch solo per validare il file.
+FIELDS = {
+    "model": (str, KNOWN_MODELS),
+    "name": (str, None),
+    "size": (int, None),
+    "iterations": (int, None),
+    "epochs": (int, None),
+    "train_batch_size": (int, None),
+    "model_params": (dict, None),
+    "disabled": (bool, None),
+    "dataset": (str, None),
+    "device": (str, None),
+    "backend": (str, ("torch", "onnx", "openvino")),
+    "precision": (str, ("fp32", "int8")),
+    "nn_search": (str, ("exact", "ivf")),
+    "nprobe": (int, None),
+    "n_lists": (int, None),
+    "memory_bank_dtype": (str, ("float16", "float32")),
+    "feature_cache": (bool, None),
+    "threshold": (float, None),
+    "pixel_threshold": (float, None),
+}
+REQUIRED = ("model", "name", "size")
+POSITIVE = ("size", "iterations", "epochs", "train_batch_size", "nprobe", "n_lists")
+
+
+class ConfigError(ValueError):
+    '''File di configurazione assente o non interpretabile come lista di entry.'''
+
+
+@dataclass
+class ConfigIssue:
+    level: str              # error (entry esclusa) | warning
+    entry: str | None       # nome dell'entry o posizione nel file
+    field: str | None
+    message: str
+
+    def __str__(self):
+        where = " / ".join(part for part in (self.entry, self.field) if part)
+        return f"{where}: {self.message}" if where else self.message
+
+
+@dataclass(frozen=True)
+class ModelEntry:
+    '''Entry validata. `options` è il dict del YAML (campi a scelta in minuscolo), passato a registro, planner e training.'''
+    name: str
+    model: str
+    size: int
+    disabled: bool
+    options: dict = field(repr=False, compare=False)
+
+    def as_dict(self) -> dict:
+        return dict(self.options)
+
+
+@dataclass
+class AnomalibConfig:
+    '''Una versione del file: entry valide e problemi trovati.'''
+    path: Path
+    entries: tuple[ModelEntry, ...]
+    issues: list[ConfigIssue]
+    mtime_ns: int | None
+    loaded_at: float = field(default_factory=time.time)
+
+    @property
+    def errors(self) -> list[ConfigIssue]:
+        return [issue for issue in self.issues if issue.level == "error"]
+
+    @property
+    def warnings(self) -> list[ConfigIssue]:
+        return [issue for issue in self.issues if issue.level == "warning"]
+
+    @property
+    def enabled(self) -> list[dict]:
+        return [entry.as_dict() for entry in self.entries if not entry.disabled]
+
+    def select(self, names: str | None = None) -> list[dict]:
+        '''Entry indicate per nome (separate da virgola, anche se disabilitate) o, senza nomi, quelle attive.'''
+        if not names:
+            return self.enabled
+        selected = {name.strip() for name in names.split(",")}
+        return [entry.as_dict() for entry in self.entries if entry.name in selected]
+
+    def report(self) -> dict:
+        return {
+            "path": str(self.path),
+            "loaded_at": self.loaded_at,
+            "entries": len(self.entries),
+            "enabled": [entry.name for entry in self.entries if not entry.disabled],
+            "errors": [asdict(issue) for issue in self.errors],
+            "warnings": [asdict(issue) for issue in self.warnings],
+        }
+
+
+def _mtime_ns(path: Path) -> int | None:
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _suggest(value: str, choices) -> str:
+    matches = difflib.get_close_matches(value, list(choices), n=1)
+    return f" (forse '{matches[0]}'?)" if matches else ""
+
+
+def _model_param_names(model: str) -> set[str] | None:
+    '''Parametri accettati dal costruttore del modello, se anomalib è importabile.'''
+    try:
+        import anomalib.models as models
+    except ImportError:
+        return None
+    model_class = getattr(models, model, None)
+    if model_class is None:
+        return None
+    parameters = inspect.signature(model_class.__init__).parameters
+    if any(parameter.kind == parameter.VAR_KEYWORD for parameter in parameters.values()):
+        return None
+    return set(parameters) - {"self"}
+
+
+def _check_value(key: str, value, label: str, issues: list[ConfigIssue]) -> bool:
+    expected, choices = FIELDS[key]
+    if value is None and key not in REQUIRED:
+        return True
+    # bool è un int per Python, ma `size: true` è quasi certamente un errore
+    valid_type = (
+        isinstance(value, (int, float)) and not isinstance(value, bool) if expected is float
+        else isinstance(value, int) and not isinstance(value, bool) if expected is int
+        else isinstance(value, expected)
+    )
+    if not valid_type:
+        issues.append(ConfigIssue("error", label, key, f"atteso {expected.__name__}, trovato {value!r}"))
+        return False
+    if choices is not None:
+        normalized = value if key == "model" else value.lower()
+        if normalized not in choices:
+            issues.append(ConfigIssue(
+                "error", label, key, f"'{value}' non valido, ammessi: {', '.join(choices)}{_suggest(value, choices)}"
+            ))
+            return False
+    if key in POSITIVE and value <= 0:
+        issues.append(ConfigIssue("error", label, key, f"deve essere positivo, trovato {value}"))
+        return False
+    return True
+
+
+def validate_entries(raw: list, check_params: bool | None = None) -> tuple[list[ModelEntry], list[ConfigIssue]]:
+    '''Valida le entry del YAML; quelle con errori vengono escluse.
+
+    `check_params` confronta `model_params` con il costruttore del modello;
+    per default solo se anomalib è già importato (nel CLI sempre).
+    '''
+    if check_params is None:
+        check_params = "anomalib.models" in sys.modules
+    entries: list[ModelEntry] = []
+    issues: list[ConfigIssue] = []
+    names: set[str] = set()
+
+    for position, item in enumerate(raw, start=1):
+        if not isinstance(item, dict):
+            issues.append(ConfigIssue("error", f"#{position}", None, f"atteso un mapping, trovato {item!r}"))
+            continue
+        label = str(item.get("name") or f"#{position}")
+        valid = True
+
+        for key in REQUIRED:
+            if key not in item:
+                issues.append(ConfigIssue("error", label, key, "campo obbligatorio mancante"))
+                valid = False
+        for key, value in item.items():
+            if key not in FIELDS:
+                issues.append(ConfigIssue("warning", label, key, f"campo sconosciuto, ignorato{_suggest(key, FIELDS)}"))
+                continue
+            valid = _check_value(key, value, label, issues) and valid
+
+        name = item.get("name")
+        if isinstance(name, str):
+            if name in names:
+                issues.append(ConfigIssue("error", label, "name", "nome duplicato, vale la prima entry"))
+                valid = False
+            names.add(name)
+
+        accepted = _model_param_names(item["model"]) if valid and check_params and item.get("model_params") else None
+        if accepted is not None:
+            for key in sorted(set(item["model_params"]) - accepted):
+                issues.append(ConfigIssue(
+                    "error", label, f"model_params.{key}", f"parametro sconosciuto per {item['model']}{_suggest(key, accepted)}"
+                ))
+                valid = False
+
+        if valid:
+            # I campi a scelta sono validati senza distinzione di maiuscole: si salvano già normalizzati
+            lowercase = {key for key, (_, choices) in FIELDS.items() if choices is not None and key != "model"}
+            options = {key: value.lower() if key in lowercase and isinstance(value, str) else value for key, value in item.items()}
+            entries.append(ModelEntry(
+                name=name,
+                model=item["model"],
+                size=item["size"],
+                disabled=bool(item.get("disabled", False)),
+                options=options,
+            ))
+    return entries, issues
+
+
+def parse_config(path: Path, check_params: bool | None = None) -> AnomalibConfig:
+    '''Legge e valida il file; solleva ConfigError se manca o non è una lista di entry.'''
+    path = Path(path)
+    mtime_ns = _mtime_ns(path)
+    if mtime_ns is None:
+        raise ConfigError(f"File YAML non trovato: {path}")
+    try:
+        with open(path, "r") as f:
+            raw = yaml.safe_load(f)
+    except yaml.YAMLError as e:
+        raise ConfigError(f"YAML non valido in {path}: {e}") from e
+    if raw is None:
+        raw = []
+    if not isinstance(raw, list):
+        raise ConfigError(f"{path} deve contenere una lista di entry, trovato {type(raw).__name__}")
+    entries, issues = validate_entries(raw, check_params)
+    return AnomalibConfig(path=path, entries=tuple(entries), issues=issues, mtime_ns=mtime_ns)
+
+
+def log_report(config: AnomalibConfig):
+    for issue in config.errors:
+        logger.error(f"❌ {config.path.name}: {issue}")
+    for issue in config.warnings:
+        logger.warning(f"⚠️ {config.path.name}: {issue}")
+    enabled = [entry.name for entry in config.entries if not entry.disabled]
+    logger.info(
+        f"📋 {config.path.name}: {len(config.entries)} entry valide, attive {enabled}, "
+        f"{len(config.errors)} errori, {len(config.warnings)} avvisi"
+    )
+
+
+# Hook di reload: (nuova configurazione, precedente)
+ReloadHook = Callable[[AnomalibConfig, AnomalibConfig], None]
+
+
+class ConfigStore:
+    '''Configurazione corrente di un file, sostituita in blocco a ogni reload.
+
+    `current` non tocca mai il disco dopo il primo caricamento. Gli hook
+    `before_swap` girano nel thread del watcher con la configurazione vecchia
+    ancora in uso (es. warmup dei modelli appena abilitati); gli hook
+    `after_swap` subito dopo la sostituzione.
+    '''
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._config: AnomalibConfig | None = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._before_swap: list[ReloadHook] = []
+        self._after_swap: list[ReloadHook] = []
+        self._watcher: threading.Thread | None = None
+        self._rejected_mtime: int | None = None
+        self.reloads = 0
+        self.last_error: str | None = None
+
+    @property
+    def current(self) -> AnomalibConfig:
+        config = self._config
+        if config is None:
+            with self._lock:
+                if self._config is None:
+                    self._config = self._load_initial()
+                config = self._config
+        return config
+
+    def _load_initial(self) -> AnomalibConfig:
+        try:
+            config = parse_config(self.path)
+        except ConfigError as e:
+            self.last_error = str(e)
+            config = AnomalibConfig(self.path, (), [ConfigIssue("error", None, None, str(e))], _mtime_ns(self.path))
+        log_report(config)
+        return config
+
+    def add_hooks(self, before_swap: ReloadHook | None = None, after_swap: ReloadHook | None = None):
+        if before_swap is not None and before_swap not in self._before_swap:
+            self._before_swap.append(before_swap)
+        if after_swap is not None and after_swap not in self._after_swap:
+            self._after_swap.append(after_swap)
+
+    def _run_hooks(self, hooks: list[ReloadHook], new: AnomalibConfig, old: AnomalibConfig):
+        for hook in hooks:
+            try:
+                hook(new, old)
+            except Exception:
+                logger.exception(f"❌ Errore nell'hook di reload {getattr(hook, '__name__', hook)}:")
+
+    def reload(self, force: bool = False) -> bool:
+        '''Rilegge il file se è cambiato; restituisce True se la configurazione è stata sostituita.'''
+        with self._reload_lock:
+            old = self.current
+            mtime_ns = _mtime_ns(self.path)
+            if not force and mtime_ns in (old.mtime_ns, self._rejected_mtime):
+                return False
+            try:
+                new = parse_config(self.path)
+            except ConfigError as e:
+                self._rejected_mtime = mtime_ns
+                self.last_error = str(e)
+                logger.error(f"❌ Configurazione non ricaricata, resta in uso la precedente: {e}")
+                return False
+            if new.mtime_ns != mtime_ns:
+                return False  # file ancora in scrittura: si riprova al prossimo controllo
+            self.last_error = None
+
+            log_report(new)
+            old_entries = {entry.name: entry.options for entry in old.entries if not entry.disabled}
+            new_entries = {entry.name: entry.options for entry in new.entries if not entry.disabled}
+            added = sorted(new_entries.keys() - old_entries.keys())
+            removed = sorted(old_entries.keys() - new_entries.keys())
+            changed = sorted(name for name in new_entries.keys() & old_entries.keys() if new_entries[name] != old_entries[name])
+
+            self._run_hooks(self._before_swap, new, old)
+            self._config = new
+            self.reloads += 1
+            logger.info(f"🔄 {self.path.name} ricaricato: attivati {added}, disattivati {removed}, modificati {changed}")
+            self._run_hooks(self._after_swap, new, old)
+            return True
+
+    def watch(self, interval_s: float | None = None) -> threading.Thread | None:
+        '''Avvia (una volta) il thread che controlla il file ogni ANOMALIB_CONFIG_POLL_S secondi (0 = mai).'''
+        if interval_s is None:
+            interval_s = float(os.getenv("ANOMALIB_CONFIG_POLL_S", "2"))
+        if interval_s <= 0:
+            return None
+        with self._lock:
+            if self._watcher is not None and self._watcher.is_alive():
+                return self._watcher
+
+            def loop():
+                while True:
+                    time.sleep(interval_s)
+                    try:
+                        self.reload()
+                    except Exception:
+                        logger.exception(f"❌ Errore nel controllo di {self.path.name}:")
+
+            self._watcher = threading.Thread(target=loop, name=f"config-watch-{self.path.stem}", daemon=True)
+            self._watcher.start()
+            return self._watcher
+
+    def status(self) -> dict:
+        return {**self.current.report(), "reloads": self.reloads, "last_error": self.last_error}
+
+
+_stores: dict[Path, ConfigStore] = {}
+_stores_lock = threading.Lock()
+
+
+def config_store(path: Path = ANOMALIB_CONFIG_PATH) -> ConfigStore:
+    '''Store di processo per il file (uno per percorso).'''
+    key = Path(path).resolve()
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = ConfigStore(key)
+        return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default=str(ANOMALIB_CONFIG_PATH))
+    parser.add_argument("--json", action="store_true", help="report in JSON")
+    parser.add_argument("--no-params", action="store_true", help="non confrontare model_params con i costruttori (evita di importare anomalib)")
+    args = parser.parse_args()
+
+    try:
+        config = parse_config(Path(args.config), check_params=not args.no_params)
+    except ConfigError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(config.report(), indent=2, ensure_ascii=False))
+    else:
+        print(f"{config.path}: {len(config.entries)} entry valide, attive: {', '.join(config.report()['enabled']) or '-'}")
+        for issue in config.errors:
+            print(f"  ❌ {issue}")
+        for issue in config.warnings:
+            print(f"  ⚠️  {issue}")
+        if not config.issues:
+            print("  ✅ nessun problema")
+    sys.exit(1 if config.errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+'''Valutazione a livello immagine dei modelli Anomalib su un dataset in formato Folder.
+
+Funzioni condivise da quantizzazione, benchmark e sweep: split good/anomali,
+good escluse dal training (holdout), scoring a batch con qualsiasi backend e
+metriche (AUROC, F1).
+'''
+import json
+import math
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import cv2
+import numpy as np
+import torch
+
+from utils.paths import DATASETS_DIR
+from anomalib_planner import preprocess_batch
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff"}
+# Accanto al checkpoint: le good che il training non ha visto
+HOLDOUT_FILE = "holdout.json"
+
+
+def list_images(directory: Path) -> list[Path]:
+    return sorted(path for path in directory.glob("*") if path.suffix.lower() in IMAGE_SUFFIXES)
+
+
+@dataclass
+class EvaluationSplit:
+    '''Immagini "good" per calibrazione e test, più le anomale (label 1) per il test.'''
+    calibration: list[Path]
+    test_good: list[Path]
+    test_abnormal: list[Path]
+
+    @property
+    def test_paths(self) -> list[Path]:
+        return self.test_good + self.test_abnormal
+
+    @property
+    def test_labels(self) -> np.ndarray:
+        return np.array([0] * len(self.test_good) + [1] * len(self.test_abnormal))
+
+
+def holdout_good(dataset: str, normal_test_dir: str = "good_test", fraction: float = 0.2, seed: int = 0) -> list[Path]:
+    '''Good da escludere dal training: `normal_test_dir` se il dataset la contiene, altrimenti una frazione di good/ estratta col seed.'''
+    root = DATASETS_DIR / dataset
+    held_out = list_images(root / normal_test_dir)
+    if held_out:
+        return held_out
+    good = list_images(root / "good")
+    # Almeno un'immagine resta sempre al training
+    count = max(0, min(math.ceil(fraction * len(good)), len(good) - 1))
+    order = np.random.default_rng(seed).permutation(len(good))
+    return sorted(good[index] for index in order[:count])
+
+
+def save_holdout(ckpt_path: Path, dataset: str, paths: list[Path]):
+    '''Registra accanto al checkpoint le good escluse dal training (path relativi al dataset).'''
+    root = DATASETS_DIR / dataset
+    images = [Path(path).relative_to(root).as_posix() for path in paths]
+    (Path(ckpt_path).parent / HOLDOUT_FILE).write_text(json.dumps({"dataset": dataset, "images": images}, indent=2))
+
+
+def load_holdout(ckpt_path: Path, dataset: str) -> list[Path] | None:
+    '''Good escluse dal training del checkpoint; None se il checkpoint non le registra.'''
+    holdout_path = Path(ckpt_path).parent / HOLDOUT_FILE
+    if not holdout_path.exists():
+        return None
+    images = json.loads(holdout_path.read_text()).get("images") or []
+    return [DATASETS_DIR / dataset / image for image in images]
+
+
+def split_dataset(
+    dataset: str,
+    calibration_size: int = 64,
+    abnormal_dirs: tuple[str, ...] = ("crack",),
+    seed: int = 0,
+    test_good: list[Path] | None = None,
+) -> EvaluationSplit:
+    '''Calibrazione da good/ e test su good e anomale, deterministico dato il seed.
+
+    Con `test_good` (le good escluse dal training, vedi load_holdout) la
+    calibrazione pesca dalle altre good/. Senza, good/ viene divisa in
+    calibrazione e test (al più metà in calibrazione): va bene solo se il
+    modello è addestrato sulla sola parte di calibrazione, come nello sweep.
+    '''
+    root = DATASETS_DIR / dataset
+    good = list_images(root / "good")
+    if test_good is not None:
+        held_out = set(test_good)
+        good = [path for path in good if path not in held_out]
+        order = np.random.default_rng(seed).permutation(len(good))
+        calibration = [good[index] for index in order[:calibration_size]]
+    else:
+        order = np.random.default_rng(seed).permutation(len(good))
+        calibration_size = min(calibration_size, len(good) // 2)
+        calibration = [good[index] for index in order[:calibration_size]]
+        test_good = [good[index] for index in order[calibration_size:]]
+    abnormal = [path for directory in abnormal_dirs for path in list_images(root / directory)]
+    return EvaluationSplit(calibration=calibration, test_good=test_good, test_abnormal=abnormal)
+
+
+def load_batches(paths: list[Path], size: int, batch_size: int = 8):
+    '''Tensori preprocessati come in inferenza (resize, RGB, [0, 1]), a blocchi di `batch_size`.
+
+    Una riga per path, nello stesso ordine: un'immagine illeggibile solleva
+    ValueError invece di sparire e disallineare score e label.
+    '''
+    for start in range(0, len(paths), batch_size):
+        images = []
+        for path in paths[start:start + batch_size]:
+            image = cv2.imread(str(path))
+            if image is None:
+                raise ValueError(f"Immagine non leggibile: {path}")
+            images.append(image)
+        yield preprocess_batch(images, size, torch.device("cpu"))
+
+
+def score_images(run: Callable, paths: list[Path], size: int, batch_size: int = 8) -> tuple[np.ndarray, float]:
+    '''Score immagine per ogni path (stesso ordine) e latenza media per immagine in ms.
+
+    `run` riceve il tensore del batch e restituisce un dict con `pred_score`
+    (come ExportedModel) o direttamente il tensore degli score.
+    '''
+    scores, elapsed = [], 0.0
+    with torch.no_grad():
+        for batch in load_batches(paths, size, batch_size):
+            start = time.perf_counter()
+            output = run(batch)
+            elapsed += time.perf_counter() - start
+            score = output["pred_score"] if isinstance(output, dict) else output
+            scores.append(torch.as_tensor(score).reshape(-1).cpu().numpy())
+    scores = np.concatenate(scores) if scores else np.array([])
+    if len(scores) != len(paths):
+        raise ValueError(f"Attesi {len(paths)} score, ricevuti {len(scores)}: score e label non sarebbero allineati")
+    return scores, 1000 * elapsed / max(len(scores), 1)
+
+
+def auroc(labels: np.ndarray, scores: np.ndarray) -> float | None:
+    '''AUROC tramite statistica di Mann-Whitney (ranghi medi in caso di pari merito).'''
+    positives, negatives = int(labels.sum()), int(len(labels) - labels.sum())
+    if positives == 0 or negatives == 0:
+        return None
+    order = np.argsort(scores, kind="mergesort")
+    ranks = np.empty(len(scores))
+    sorted_scores = scores[order]
+    start = 0
+    while start < len(scores):
+        end = start
+        while end + 1 < len(scores) and sorted_scores[end + 1] == sorted_scores[start]:
+            end += 1
+        ranks[order[start:end + 1]] = (start + end) / 2 + 1
+        start = end + 1
+    return float((ranks[labels == 1].sum() - positives * (positives + 1) / 2) / (positives * negatives))
+
+
+def f1_at(labels: np.ndarray, scores: np.ndarray, threshold: float) -> float:
+    predicted = scores >= threshold
+    true_positive = int((predicted & (labels == 1)).sum())
+    if true_positive == 0:
+        return 0.0
+    precision = true_positive / int(predicted.sum())
+    recall = true_positive / int((labels == 1).sum())
+    return 2 * precision * recall / (precision + recall)
+
+
+def f1_max(labels: np.ndarray, scores: np.ndarray) -> tuple[float, float | None]:
+    '''Miglior F1 su tutte le soglie candidate (gli score stessi) e soglia corrispondente.'''
+    best, best_threshold = 0.0, None
+    for threshold in np.unique(scores):
+        value = f1_at(labels, scores, threshold)
+        if value > best:
+            best, best_threshold = value, float(threshold)
+    return best, best_threshold
+
+
+def image_metrics(labels: np.ndarray, scores: np.ndarray, threshold: float | None = None) -> dict:
+    best_f1, best_threshold = f1_max(labels, scores)
+    return {
+        "auroc": auroc(labels, scores),
+        "f1": f1_at(labels, scores, threshold) if threshold is not None else None,
+        "f1_max": best_f1,
+        "f1_max_threshold": best_threshold,
+    }
+
+
+def recall_at(labels: np.ndarray, scores: np.ndarray, threshold: float) -> float | None:
+    abnormal = scores[labels == 1]
+    return float((abnormal >= threshold).mean()) if len(abnormal) else None
+
+
+def operating_point(labels: np.ndarray, scores: np.ndarray, target_recall: float) -> tuple[float | None, float | None]:
+    '''Soglia più alta che raggiunge il recall richiesto sulle anomale e relativo false positive rate sulle good.'''
+    abnormal = np.sort(scores[labels == 1])[::-1]
+    good = scores[labels == 0]
+    if not len(abnormal) or not len(good):
+        return None, None
+    needed = max(1, int(np.ceil(target_recall * len(abnormal) - 1e-9)))
+    threshold = float(abnormal[needed - 1])
+    return threshold, float((good >= threshold).mean())
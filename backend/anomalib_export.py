@@ -0,0 +1,132 @@
+'''Esporta i modelli Anomalib addestrati in ONNX e/o OpenVINO per l'inferenza su CPU.
+
+Per ogni entry di anomalib_models.yaml con un checkpoint disponibile scrive
+results/<Model>/<dataset>/latest/weights/<backend>/<entry>.{onnx,xml} più un
+JSON con soglie, statistiche di normalizzazione e impronta del checkpoint.
+Per usare l'artefatto impostare `backend: onnx` (o `openvino`) nell'entry.
+
+    python anomalib_export.py                       # entry abilitate, ONNX + OpenVINO
+    python anomalib_export.py --names padim_512 --format onnx
+'''
+import argparse
+import json
+import time
+from pathlib import Path
+
+import torch
+
+from utils.paths import CONFIGS_DIR
+from utils.logger import get_logger
+from anomalib_backends import INPUT_NAME, ExportWrapper, artifact_path, metadata_path
+from anomalib_runner import (
+    INFERENCE_MODEL_CLASSES,
+    checkpoint_thresholds,
+    get_latest_ckpt_path,
+    load_checkpoint_with_fallback,
+    select_model_entries,
+)
+
+logger = get_logger('anomalib')
+
+
+def export_onnx(wrapper: ExportWrapper, size: int, path, opset: int = 17):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    example = torch.rand(1, 3, size, size)
+    torch.onnx.export(
+        wrapper,
+        example,
+        str(path),
+        input_names=[INPUT_NAME],
+        output_names=wrapper.output_names,
+        dynamic_axes={INPUT_NAME: {0: "batch"}, **{name: {0: "batch"} for name in wrapper.output_names}},
+        opset_version=opset,
+    )
+
+
+def export_openvino(onnx_path, path):
+    '''Converte il modello ONNX in IR OpenVINO (FP32: sulle CPU di linea non c'è guadagno in FP16).'''
+    import openvino as ov
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ov.save_model(ov.convert_model(str(onnx_path)), str(path), compress_to_fp16=False)
+
+
+def write_metadata(artifact, entry: dict, backend: str, ckpt_path, thresholds: dict, opset: int):
+    stat = ckpt_path.stat()
+    metadata = {
+        "name": entry["name"],
+        "model": entry["model"],
+        "backend": backend,
+        "size": int(entry["size"]),
+        "input": INPUT_NAME,
+        "thresholds": thresholds,
+        "opset": opset,
+        "checkpoint": {"path": str(ckpt_path.resolve()), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size},
+        "exported_at": time.time(),
+    }
+    metadata_path(artifact).write_text(json.dumps(metadata, indent=2))
+
+
+def export_entry(entry: dict, dataset: str, formats: list[str], opset: int) -> list:
+    model_class = INFERENCE_MODEL_CLASSES.get(entry["model"])
+    if model_class is None:
+        logger.warning(f"🔕 Export non supportato per {entry['model']} ({entry['name']}).")
+        return []
+
+    ckpt_path = get_latest_ckpt_path(entry["model"], dataset)
+    model = load_checkpoint_with_fallback(model_class, ckpt_path, entry)
+    if model is None:
+        return []
+    model.eval()
+
+    thresholds = checkpoint_thresholds(model)
+    if thresholds["pixel"] is None:
+        thresholds["pixel"] = thresholds["image"]
+    wrapper = ExportWrapper(getattr(model, "model", model), thresholds).eval()
+    size = int(entry["size"])
+
+    written = []
+    onnx_path = artifact_path(ckpt_path, entry["name"], "onnx")
+    with torch.no_grad():
+        export_onnx(wrapper, size, onnx_path, opset)
+    write_metadata(onnx_path, entry, "onnx", ckpt_path, thresholds, opset)
+    logger.info(f"📦 {entry['name']}: ONNX scritto in {onnx_path}")
+    written.append(onnx_path)
+
+    if "openvino" in formats:
+        openvino_path = artifact_path(ckpt_path, entry["name"], "openvino")
+        export_openvino(onnx_path, openvino_path)
+        write_metadata(openvino_path, entry, "openvino", ckpt_path, thresholds, opset)
+        logger.info(f"📦 {entry['name']}: OpenVINO scritto in {openvino_path}")
+        written.append(openvino_path)
+    if "onnx" not in formats:
+        # L'ONNX serve solo come passaggio intermedio per OpenVINO
+        onnx_path.unlink()
+        metadata_path(onnx_path).unlink()
+        written.remove(onnx_path)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default=str(CONFIGS_DIR / "anomalib_models.yaml"))
+    parser.add_argument("--names", help="entry da esportare separate da virgola (default: quelle abilitate)")
+    parser.add_argument("--dataset", default="hazelnut_toy")
+    parser.add_argument("--format", choices=["onnx", "openvino", "both"], default="both")
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    entries = select_model_entries(Path(args.config), args.names)
+
+    formats = ["onnx", "openvino"] if args.format == "both" else [args.format]
+    exported = 0
+    for entry in entries:
+        try:
+            exported += len(export_entry(entry, args.dataset, formats, args.opset))
+        except Exception:
+            logger.exception(f"❌ Export fallito per {entry['name']}:")
+    logger.info(f"✅ {exported} artefatti esportati")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any
+
+import cv2
+import numpy as np
+import torch
+
+from utils.logger import get_logger
+
+logger = get_logger('anomalib')
+
+
+@dataclass
+class PlannedModel:
+    '''Entry YAML abilitata con il relativo modello Lightning già residente.'''
+    entry: dict
+    model: Any
+
+    @property
+    def name(self) -> str:
+        return self.entry["name"]
+
+    @property
+    def size(self) -> int:
+        return int(self.entry["size"])
+
+    @property
+    def torch_model(self):
+        return getattr(self.model, "model", self.model)
+
+    @property
+    def device(self) -> torch.device:
+        if not hasattr(self.model, "parameters"):
+            return self.model.device  # modello esportato (ONNX Runtime / OpenVINO)
+        return next(self.model.parameters()).device
+
+
+def preprocess_batch(images: list[np.ndarray], size: int, device: torch.device) -> torch.Tensor:
+    '''Resize + conversione BGR→RGB in [0, 1], una sola volta per risoluzione.'''
+    batch = np.stack([
+        cv2.cvtColor(cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2RGB)
+        for image in images
+    ])
+    tensor = torch.from_numpy(batch).permute(0, 3, 1, 2).float().div_(255.0)
+    return tensor.to(device)
+
+
+def _backbone_key(torch_model) -> tuple[str, list[str]] | None:
+    '''(backbone, layers) del feature extractor, se il modello è condivisibile.'''
+    if getattr(torch_model, "tiler", None) is not None:
+        return None
+    extractor = getattr(torch_model, "feature_extractor", None)
+    backbone = getattr(extractor, "backbone", None)
+    layers = getattr(extractor, "layers", None)
+    if not isinstance(backbone, str) or not layers:
+        return None
+    return backbone, list(layers)
+
+
+def _padim_head(torch_model, features: dict, output_size) -> torch.Tensor:
+    '''Parte di PadimModel.forward successiva all'estrazione delle feature.'''
+    embeddings = torch_model.generate_embedding(features)
+    return torch_model.anomaly_map_generator(
+        embedding=embeddings,
+        mean=torch_model.gaussian.mean,
+        inv_covariance=torch_model.gaussian.inv_covariance,
+        image_size=output_size,
+    )
+
+
+def _patchcore_head(torch_model, features: dict, output_size) -> dict:
+    '''Parte di PatchcoreModel.forward successiva all'estrazione delle feature.'''
+    features = {layer: torch_model.feature_pooler(feature) for layer, feature in features.items()}
+    embedding = torch_model.generate_embedding(features)
+
+    batch_size, _, width, height = embedding.shape
+    embedding = torch_model.reshape_embedding(embedding)
+
+    index = getattr(torch_model, "nn_index", None)
+    if index is None:
+        patch_scores, locations = torch_model.nearest_neighbors(embedding=embedding, n_neighbors=1)
+    else:
+        # Ricerca approssimata sull'indice IVF (patchcore_index.py)
+        patch_scores, locations = index.search(embedding, k=1)
+    patch_scores = patch_scores.reshape((batch_size, -1))
+    locations = locations.reshape((batch_size, -1))
+    if index is None:
+        pred_score = torch_model.compute_anomaly_score(patch_scores, locations, embedding)
+    else:
+        pred_score = index.anomaly_score(torch_model.num_neighbors, patch_scores, locations, embedding)
+    patch_scores = patch_scores.reshape((batch_size, 1, width, height))
+    anomaly_map = torch_model.anomaly_map_generator(patch_scores, output_size)
+    return {"anomaly_map": anomaly_map, "pred_score": pred_score}
+
+
+# Modelli di cui sappiamo separare backbone e testa
+FEATURE_HEADS = {
+    "Padim": _padim_head,
+    "Patchcore": _patchcore_head,
+}
+
+
+@dataclass
+class SharedBackbone:
+    '''Un'unica estrazione di feature che serve più modelli con lo stesso backbone.'''
+    provider: PlannedModel
+    consumers: list[PlannedModel]
+
+
+@dataclass
+class ResolutionGroup:
+    '''Modelli che condividono risoluzione e device: un solo preprocessing.'''
+    size: int
+    device: torch.device
+    shared: list[SharedBackbone]
+    standalone: list[PlannedModel]
+
+
+def _share_backbones(models: list[PlannedModel]) -> tuple[list[SharedBackbone], list[PlannedModel]]:
+    '''Raggruppa i modelli il cui set di layer è coperto da un altro modello dello stesso backbone.'''
+    buckets: dict[str, list[tuple[PlannedModel, set]]] = defaultdict(list)
+    standalone = []
+    for planned in models:
+        key = _backbone_key(planned.torch_model)
+        if key is None or planned.entry["model"] not in FEATURE_HEADS:
+            standalone.append(planned)
+            continue
+        backbone, layers = key
+        buckets[backbone].append((planned, set(layers)))
+
+    shared = []
+    for members in buckets.values():
+        # Il modello con più layer estrae le feature anche per gli altri (es. Padim l1-l3 ⊇ Patchcore l2-l3)
+        remaining = sorted(members, key=lambda item: len(item[1]), reverse=True)
+        while remaining:
+            provider, provided = remaining[0]
+            consumers = [planned for planned, layers in remaining if layers <= provided]
+            remaining = [(planned, layers) for planned, layers in remaining if not layers <= provided]
+            shared.append(SharedBackbone(provider=provider, consumers=consumers))
+    return shared, standalone
+
+
+def build_inference_plan(models: list[PlannedModel]) -> list[ResolutionGroup]:
+    '''Raggruppa i modelli per (size, device) e individua i backbone condivisibili.'''
+    by_resolution: dict[tuple, list[PlannedModel]] = defaultdict(list)
+    for planned in models:
+        by_resolution[(planned.size, str(planned.device))].append(planned)
+
+    plan = []
+    for (size, device), members in by_resolution.items():
+        shared, standalone = _share_backbones(members)
+        plan.append(ResolutionGroup(size=size, device=torch.device(device), shared=shared, standalone=standalone))
+        logger.debug(
+            f"Piano {size}px su {device}: "
+            f"{[[c.name for c in s.consumers] for s in shared]} condivisi, {[m.name for m in standalone]} singoli"
+        )
+    return plan
+
+
+def _run_full(planned: PlannedModel, input_tensor: torch.Tensor):
+    torch_model = planned.torch_model
+    if getattr(torch_model, "nn_index", None) is not None:
+        # La memory bank FP32 è stata sostituita dall'indice: il forward di anomalib non la troverebbe
+        return _patchcore_head(torch_model, torch_model.feature_extractor(input_tensor), input_tensor.shape[-2:])
+    return torch_model(input_tensor)
+
+
+def run_inference_plan(plan: list[ResolutionGroup], images: list[np.ndarray]) -> dict[str, Any]:
+    '''Esegue il piano su un batch di immagini BGR e restituisce l'output grezzo per modello.'''
+    outputs: dict[str, Any] = {}
+    with torch.no_grad():
+        for group in plan:
+            input_tensor = preprocess_batch(images, group.size, group.device)
+            output_size = input_tensor.shape[-2:]
+
+            for shared in group.shared:
+                extractor = shared.provider.torch_model.feature_extractor
+                features = extractor(input_tensor)
+                for consumer in shared.consumers:
+                    _, layers = _backbone_key(consumer.torch_model)
+                    head = FEATURE_HEADS[consumer.entry["model"]]
+                    try:
+                        outputs[consumer.name] = head(
+                            consumer.torch_model, {layer: features[layer] for layer in layers}, output_size
+                        )
+                    except (AttributeError, KeyError, TypeError) as e:
+                        # API del modello diversa da quella attesa: ripiego sul forward completo
+                        logger.warning(f"⚠️ Backbone condiviso non applicabile a {consumer.name} ({e}), forward completo.")
+                        outputs[consumer.name] = _run_full(consumer, input_tensor)
+
+            for planned in group.standalone:
+                outputs[planned.name] = _run_full(planned, input_tensor)
+    return outputs
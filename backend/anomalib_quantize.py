@@ -0,0 +1,165 @@
+'''Quantizzazione INT8 post-training (ONNX Runtime) dei backbone Padim/Patchcore con controllo di accuratezza.
+
+Parte dall'artefatto ONNX FP32 di anomalib_export.py (lo genera se manca),
+calibra sulle immagini good/ del dataset e quantizza solo le convoluzioni del
+feature extractor: testa, distanze e smoothing restano in FP32. Sul test split
+(good escluse dal training, registrate da train_scheduler.py in holdout.json
+accanto al checkpoint, + anomale) confronta AUROC/F1 e latenza con l'FP32; il
+modello INT8 viene promosso solo se il calo resta entro la tolleranza. Per
+usarlo: `backend: onnx` e `precision: int8` nell'entry.
+
+    python anomalib_quantize.py --names padim_512 --tolerance 0.01
+'''
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+
+from utils.paths import CONFIGS_DIR
+from utils.logger import get_logger
+from anomalib_backends import artifact_path, load_exported_model, metadata_path
+from anomalib_eval import HOLDOUT_FILE, image_metrics, load_batches, load_holdout, score_images, split_dataset
+from anomalib_export import export_entry
+from anomalib_runner import get_latest_ckpt_path, select_model_entries
+
+logger = get_logger('anomalib')
+
+
+class FolderCalibrationReader:
+    '''CalibrationDataReader di ONNX Runtime sulle immagini di calibrazione già preprocessate.'''
+
+    def __init__(self, paths, size: int, input_name: str, batch_size: int = 1):
+        self._batches = iter([{input_name: batch.numpy()} for batch in load_batches(paths, size, batch_size)])
+
+    def get_next(self):
+        return next(self._batches, None)
+
+
+def backbone_conv_nodes(onnx_path) -> list[str]:
+    '''Nodi Conv del feature extractor: solo questi vengono quantizzati.'''
+    import onnx
+
+    graph = onnx.load(str(onnx_path), load_external_data=False).graph
+    return [node.name for node in graph.node if node.op_type == "Conv" and "feature_extractor" in node.name]
+
+
+def quantize_entry(entry: dict, args) -> dict | None:
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+
+    ckpt_path = get_latest_ckpt_path(entry["model"], args.dataset)
+    if ckpt_path is None:
+        return None
+    fp32_path = artifact_path(ckpt_path, entry["name"], "onnx")
+    if not fp32_path.exists() and not export_entry(entry, args.dataset, ["onnx"], args.opset):
+        return None
+
+    size = int(entry["size"])
+    # Le good/ sono il training set di Folder: valutarci sopra gonfierebbe AUROC e F1
+    held_out = load_holdout(ckpt_path, args.dataset)
+    if not held_out:
+        logger.error(f"❌ {ckpt_path} non registra good escluse dal training ({HOLDOUT_FILE}): riaddestrare con train_scheduler.py.")
+        return None
+    split = split_dataset(args.dataset, args.calibration, tuple(args.abnormal_dirs.split(",")), args.seed, test_good=held_out)
+    if not split.calibration or not split.test_abnormal:
+        logger.error(f"❌ Dataset {args.dataset} insufficiente per calibrazione e test.")
+        return None
+
+    nodes = backbone_conv_nodes(fp32_path)
+    if not nodes:
+        logger.error(f"❌ Nessuna convoluzione del backbone trovata in {fp32_path.name}")
+        return None
+
+    int8_path = artifact_path(ckpt_path, entry["name"], "onnx", precision="int8")
+    logger.info(f"🧮 Calibrazione {entry['name']} su {len(split.calibration)} immagini good, {len(nodes)} conv da quantizzare")
+    quantize_static(
+        str(fp32_path),
+        str(int8_path),
+        FolderCalibrationReader(split.calibration, size, "images"),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        nodes_to_quantize=nodes,
+        calibrate_method=CalibrationMethod.Percentile if args.method == "percentile" else CalibrationMethod.MinMax,
+    )
+
+    # Stessi metadati dell'FP32 (soglie, checkpoint), più l'esito della valutazione
+    metadata = json.loads(metadata_path(fp32_path).read_text())
+    metadata_path(int8_path).write_text(json.dumps(metadata, indent=2))
+
+    fp32_model, int8_model = load_exported_model(fp32_path), load_exported_model(int8_path)
+    threshold = (metadata.get("thresholds") or {}).get("image")
+    labels = split.test_labels
+    fp32_scores, fp32_ms = score_images(fp32_model, split.test_paths, size, args.batch_size)
+    int8_scores, int8_ms = score_images(int8_model, split.test_paths, size, args.batch_size)
+    fp32_metrics = image_metrics(labels, fp32_scores, threshold)
+    int8_metrics = image_metrics(labels, int8_scores, threshold)
+
+    deltas = {
+        key: (int8_metrics[key] - fp32_metrics[key])
+        for key in ("auroc", "f1", "f1_max")
+        if fp32_metrics[key] is not None and int8_metrics[key] is not None
+    }
+    promoted = all(delta >= -args.tolerance for delta in deltas.values())
+    report = {
+        "promoted": promoted,
+        "tolerance": args.tolerance,
+        "calibration_images": len(split.calibration),
+        "test_images": {"good": len(split.test_good), "abnormal": len(split.test_abnormal)},
+        "quantized_nodes": len(nodes),
+        "method": args.method,
+        "fp32": {**fp32_metrics, "ms_per_image": round(fp32_ms, 2)},
+        "int8": {**int8_metrics, "ms_per_image": round(int8_ms, 2)},
+        "delta": deltas,
+        "speedup": round(fp32_ms / int8_ms, 2) if int8_ms > 0 else None,
+        "score_correlation": float(np.corrcoef(fp32_scores, int8_scores)[0, 1]) if len(fp32_scores) > 1 else None,
+    }
+    metadata["quantization"] = report
+    metadata_path(int8_path).write_text(json.dumps(metadata, indent=2))
+
+    if promoted:
+        logger.info(f"✅ {entry['name']} INT8 promosso: speedup x{report['speedup']}, delta {deltas}")
+    else:
+        logger.warning(f"⚠️ {entry['name']} INT8 NON promosso: delta {deltas} oltre la tolleranza {args.tolerance}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default=str(CONFIGS_DIR / "anomalib_models.yaml"))
+    parser.add_argument("--names", help="entry da quantizzare separate da virgola (default: quelle abilitate)")
+    parser.add_argument("--dataset", default="hazelnut_toy")
+    parser.add_argument("--abnormal-dirs", default="crack", help="cartelle anomale del test split")
+    parser.add_argument("--calibration", type=int, default=64, help="immagini good usate per la calibrazione")
+    parser.add_argument("--method", choices=["minmax", "percentile"], default="minmax")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="calo massimo ammesso di AUROC/F1")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    entries = select_model_entries(Path(args.config), args.names)
+
+    print(f"{'entry':<24} {'promoted':<9} {'AUROC fp32':>10} {'AUROC int8':>10} {'F1max fp32':>10} {'F1max int8':>10} {'speedup':>8}")
+    for entry in entries:
+        try:
+            report = quantize_entry(entry, args)
+        except Exception:
+            logger.exception(f"❌ Quantizzazione fallita per {entry['name']}:")
+            continue
+        if report is None:
+            continue
+
+        def fmt(value):
+            return f"{value:.4f}" if value is not None else "n/a"
+
+        print(
+            f"{entry['name']:<24} {str(report['promoted']):<9} {fmt(report['fp32']['auroc']):>10} "
+            f"{fmt(report['int8']['auroc']):>10} {fmt(report['fp32']['f1_max']):>10} "
+            f"{fmt(report['int8']['f1_max']):>10} {fmt(report['speedup']):>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,18 @@
+from dataclasses import dataclass, field
 from pathlib import Path
 import uuid
-import yaml
 
 from utils.paths import MODELS_DIR, DATA_DIR, CONFIGS_DIR, DATASETS_DIR
-from utils.logger import get_logger
+from utils.logger import PER_FRAME, get_logger
+from utils.frames import Frame, as_frame
+from utils.storage import StoredImage, store_result
+from utils.metrics import span
+from model_registry import ModelRegistry
+from anomalib_planner import PlannedModel, build_inference_plan, run_inference_plan
+from anomalib_backends import artifact_path, entry_backend, is_promoted, load_exported_model
+from patchcore_index import attach_index, entry_nn_search, load_or_build_index
+from anomalib_config import AnomalibConfig, config_store
+from heatmap import color_anomaly_map
 
 from anomalib.data import Folder
 from anomalib.engine import Engine
@@ -12,32 +21,20 @@ from anomalib.models import (
     EfficientAd, Stfpm, Draem, Dsr, Fastflow, Uflow
 )
 
-from PIL import Image
 import cv2
 import numpy as np
 
 import torch
-from torchvision import transforms
-from PIL import Image
-
-from matplotlib import cm
-from matplotlib.colors import Normalize, LinearSegmentedColormap
 
 logger = get_logger('anomalib')
 
 def load_anomalib_models_config(yaml_path: Path) -> list[dict]:
-    '''Carica i modelli Anomalib attivi da un file di configurazione YAML.'''
-    if not yaml_path.exists():
-        logger.error(f"File YAML non trovato: {yaml_path}")
-        return []
-
-    with open(yaml_path, "r") as f:
-        config = yaml.safe_load(f)
+    '''Entry Anomalib attive e valide del file YAML (letto e validato una volta, vedi anomalib_config.py).'''
+    return config_store(yaml_path).current.enabled
 
-    enabled = [entry for entry in config if not entry.get("disabled", False)]
-    logger.info(f"Modelli Anomalib attivi: {[m['name'] for m in enabled]}")
-    print(f'Enabled models: {enabled}')
-    return enabled
+def select_model_entries(yaml_path: Path, names: str | None = None) -> list[dict]:
+    '''Entry indicate per nome (separate da virgola, anche se disabilitate) o, senza nomi, quelle attive.'''
+    return config_store(yaml_path).current.select(names)
 
 def load_anomalib_model(model_entry: dict):
     '''Crea un'istanza del modello Anomalib specificato nell'entry del dizionario.'''
@@ -61,14 +58,28 @@ def load_anomalib_model(model_entry: dict):
     logger.info(f"Modello '{model_name}' istanziato con parametri: {params}")
     return model
 
-def prepare_folder_datamodule(dataset_name: str) -> Folder:
-    '''Prepara un datamodule per il dataset specificato.'''
+def prepare_folder_datamodule(
+    dataset_name: str,
+    root: Path | None = None,
+    train_batch_size: int = 32,
+    eval_batch_size: int = 32,
+    image_size: tuple[int, int] | None = None,
+    seed: int | None = None,
+    normal_test_dir: str | None = None,
+) -> Folder:
+    '''Prepara un datamodule per il dataset specificato (root: es. la copia ridimensionata di train_scheduler).'''
+    root = root or DATASETS_DIR / dataset_name
     datamodule = Folder(
         name=dataset_name,
-        root=DATASETS_DIR / dataset_name,
+        root=root,
         normal_dir='good',
+        normal_test_dir=normal_test_dir,
         abnormal_dir='crack',
-        mask_dir=DATASETS_DIR / dataset_name / "mask" / "crack"
+        mask_dir=root / "mask" / "crack",
+        train_batch_size=train_batch_size,
+        eval_batch_size=eval_batch_size,
+        image_size=image_size,
+        seed=seed,
     )
 
     datamodule.setup()
@@ -76,35 +87,23 @@ def prepare_folder_datamodule(dataset_name: str) -> Folder:
     logger.info(f"Dataset '{dataset_name}' pronto con {len(datamodule.train_data)} train e {len(datamodule.test_data)} test.")
     return datamodule
 
-def train_enabled_models():
-    '''Addestra tutti i modelli Anomalib abilitati.'''
+def train_enabled_models(dataset: str = "hazelnut_toy", workers: int | None = None) -> list[dict]:
+    '''Addestra tutti i modelli Anomalib abilitati, in parallelo (vedi train_scheduler.py).'''
+    from train_scheduler import train_entries
+
     models = load_anomalib_models_config(CONFIGS_DIR / "anomalib_models.yaml")
     if not models:
         logger.error("Nessun modello abilitato trovato.")
-        return
-
-    datamodule = prepare_folder_datamodule("hazelnut_toy")  # TODO: non hardcodare
-
-    for model_entry in models:
-        model = load_anomalib_model(model_entry)
-        if model is None:
-            logger.warning(f"⚠️ Modello '{model_entry['name']}' non caricato, salto.")
-            continue
-
-        logger.info(f"🚀 Inizio training: {model_entry['name']}")
-
-        engine = Engine()
-        engine.fit(model=model, datamodule=datamodule)
-
-        logger.info(f"✅ Training completato: {model_entry['name']}")
+        return []
+    return train_entries(models, dataset, workers=workers)
     
-def get_latest_ckpt_path(model_name: str, dataset_name: str) -> Path | None:
-    model_dir = Path('results') / model_name / dataset_name
+def get_latest_ckpt_path(model_name: str, dataset_name: str, results_dir: Path = Path('results')) -> Path | None:
+    model_dir = results_dir / model_name / dataset_name
     latest = model_dir / 'latest' / 'weights' / 'lightning'
     ckpt = latest / 'model.ckpt'
     
     if ckpt.exists():
-        logger.info(f"Ultimo checkpoint trovato: {ckpt}")
+        logger.info(f"Ultimo checkpoint trovato: {ckpt}", extra=PER_FRAME)
         return ckpt
     else:
         logger.error(f"Nessun checkpoint trovato in: {ckpt}")
@@ -159,44 +158,77 @@ def load_checkpoint_with_fallback(model_class, ckpt_path: Path, model_entry: dic
     logger.info(f"✅ State_dict loaded for {model_entry['name']}")
     return model
 
-def color_anomaly_map(anomaly_map: np.ndarray, image: np.ndarray | None = None) -> np.ndarray:
-    """Colora l'anomaly map con una colormap personalizzata (viola → magenta → arancione) + contorni arancioni."""
-
-    # Normalizzazione della anomaly map
-    norm_map = cv2.normalize(anomaly_map, None, 0, 1.0, cv2.NORM_MINMAX)
-
-    # Colormap personalizzata (viola → magenta → arancio)
-    colors = [
-        (0.0, (0.45, 0.0, 0.5)),    # viola
-        (0.3, (0.8, 0.2, 0.6)),     # magenta
-        (0.6, (1.0, 0.7, 0.3)),     # arancio chiaro
-        (1.0, (1.0, 0.4, 0.0)),     # arancio intenso
-    ]
-    cmap = LinearSegmentedColormap.from_list("patchcore", colors)
-    colored = (cmap(norm_map)[..., :3] * 255).astype(np.uint8)
-
-    # Se l'immagine di input è disponibile, facciamo l'overlay
-    if image is not None:
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        overlay = cv2.addWeighted(image_rgb, 0.6, colored, 0.4, 0)  # maggiore saturazione per un overlay più visibile
-    else:
-        overlay = colored
-
-    # Soglia dinamica (usiamo il 90° percentile per le anomalie più significative)
-    threshold = np.percentile(anomaly_map, 90)
-    _, binary_mask = cv2.threshold(anomaly_map, threshold, 255, cv2.THRESH_BINARY)
-
-    # Trova contorni per le anomalie
-    contours, _ = cv2.findContours(binary_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Disegna contorni arancioni spessi
-    thickness = max(2, int(image.shape[0] / 100))  # Aumento della larghezza dei contorni
-    for contour in contours:
-        cv2.drawContours(overlay, [contour], -1, (255, 100, 0), thickness)  # Colore arancione (255, 100, 0)
-
-    # Restituisce l'overlay finale
-    return overlay
+# Modelli per cui run_anomalib sa già produrre un'anomaly map
+INFERENCE_MODEL_CLASSES = {
+    "Padim": Padim,
+    "Patchcore": Patchcore,
+}
+
+def _resolve_entry_checkpoint(model_entry: dict) -> Path | None:
+    '''Checkpoint Lightning dell'entry, o l'artefatto esportato se l'entry chiede un altro backend.'''
+    ckpt_path = get_latest_ckpt_path(model_entry["model"], "hazelnut_toy")
+    backend = entry_backend(model_entry)
+    if ckpt_path is None or backend == "torch":
+        return ckpt_path
+
+    if str(model_entry.get("precision", "fp32")).lower() == "int8":
+        quantized = artifact_path(ckpt_path, model_entry["name"], backend, precision="int8")
+        if quantized.exists() and is_promoted(quantized):
+            return quantized
+        logger.warning(f"⚠️ Nessun modello INT8 promosso per {model_entry['name']} ({quantized}), uso FP32.")
+
+    artifact = artifact_path(ckpt_path, model_entry["name"], backend)
+    if artifact.exists():
+        return artifact
+    logger.warning(
+        f"⚠️ Nessun artefatto {backend} per {model_entry['name']} ({artifact}), uso il checkpoint PyTorch. "
+        "Esegui anomalib_export.py per generarlo."
+    )
+    return ckpt_path
+
+def _load_entry_for_inference(model_entry: dict, ckpt_path: Path | None, device: str):
+    '''Carica il checkpoint dell'entry e lo sposta sul device richiesto.'''
+    if ckpt_path is not None and ckpt_path.suffix != ".ckpt":
+        with span("anomalib_load", model=model_entry["model"]):
+            return load_exported_model(ckpt_path, device)
+    model_class = INFERENCE_MODEL_CLASSES.get(model_entry["model"])
+    if model_class is None:
+        return None
+    with span("anomalib_load", model=model_entry["model"]):
+        model = load_checkpoint_with_fallback(model_class, ckpt_path, model_entry)
+    if model is None:
+        return None
+    if entry_nn_search(model_entry) == "ivf" and getattr(model.model, "tiler", None) is None:
+        index = load_or_build_index(model.model, ckpt_path, model_entry)
+        if index is not None:
+            attach_index(model.model, index)
+    return model.to(torch.device(device))
+
+# Registro di processo: i checkpoint restano in memoria tra una richiesta e l'altra
+model_registry = ModelRegistry(
+    resolve_checkpoint=_resolve_entry_checkpoint,
+    load_model=_load_entry_for_inference,
+)
 
+def _warm_new_entries(new: AnomalibConfig, old: AnomalibConfig):
+    '''Prima di adottare la nuova configurazione: carica i modelli appena abilitati.'''
+    previous = {entry["name"] for entry in old.enabled}
+    _resident_models([entry for entry in new.enabled if entry["name"] not in previous])
+
+def _apply_reloaded_entries(new: AnomalibConfig, old: AnomalibConfig):
+    '''Dopo il reload: libera i modelli disattivati e ricarica subito quelli con entry modificate.'''
+    active = {entry["name"] for entry in new.enabled}
+    for entry in old.enabled:
+        if entry["name"] not in active and model_registry.evict(entry["name"]):
+            logger.info(f"🧹 Modello {entry['name']} disattivato, rimosso dal registro")
+    _resident_models(new.enabled)
+
+def warm_enabled_models() -> int:
+    '''Carica nel registro i modelli abilitati e supportati e avvia l'hot reload del YAML; restituisce quanti sono pronti.'''
+    store = config_store(CONFIGS_DIR / "anomalib_models.yaml")
+    store.add_hooks(before_swap=_warm_new_entries, after_swap=_apply_reloaded_entries)
+    store.watch()
+    return len(_resident_models(store.current.enabled))
 
 def _extract_anomaly_tensor(model_output) -> torch.Tensor | None:
     """Estrae un tensor dall'output del modello Anomalib."""
@@ -231,75 +263,215 @@ def _extract_anomaly_tensor(model_output) -> torch.Tensor | None:
 
     return tensor
 
-def run_anomalib(image_path: Path) -> Path | None:
-    models = load_anomalib_models_config(CONFIGS_DIR / "anomalib_models.yaml")
-    if not models:
-        logger.error("Nessun modello attivo trovato.")
-        return None
-
-    image_cv = cv2.imread(str(image_path))
-    image_rgb = cv2.cvtColor(image_cv, cv2.COLOR_BGR2RGB)
-    image_pil = Image.fromarray(image_rgb)
-
-    output_path = DATA_DIR / "anomalib"
-    output_path.mkdir(parents=True, exist_ok=True)
-
-    paths = []
-
+def _resident_models(models: list[dict]) -> list[PlannedModel]:
+    '''Recupera dal registro i modelli abilitati e supportati in inferenza.'''
+    planned = []
     for model_entry in models:
         model_name = model_entry["model"]
 
-        if model_name == "Padim":
-            ckpt_path = get_latest_ckpt_path("Padim", "hazelnut_toy")
-            model = load_checkpoint_with_fallback(Padim, ckpt_path, model_entry)
-        elif model_name == "Patchcore":
-            ckpt_path = get_latest_ckpt_path("Patchcore", "hazelnut_toy")
-            model = load_checkpoint_with_fallback(Patchcore, ckpt_path, model_entry)
-        else:
+        if model_name not in INFERENCE_MODEL_CLASSES:
             logger.warning(f"🔕 Modello {model_name} non supportato in run_anomalib per ora.")
             continue
 
+        model = model_registry.get(model_entry)
         if model is None:
             logger.error(f"❌ Impossibile inizializzare il modello {model_entry['name']}")
             continue
 
-        model.eval()
+        planned.append(PlannedModel(entry=model_entry, model=model))
+    return planned
+
+def _extract_pred_scores(model_output, anomaly_tensor: torch.Tensor) -> torch.Tensor:
+    """Score a livello immagine: `pred_score` se il modello lo fornisce, altrimenti il massimo della mappa."""
+    scores = None
+    if isinstance(model_output, dict):
+        scores = model_output.get("pred_score", model_output.get("pred_scores"))
+    elif hasattr(model_output, "pred_score"):
+        scores = getattr(model_output, "pred_score")
+
+    if scores is None:
+        return anomaly_tensor.reshape(anomaly_tensor.shape[0], -1).amax(dim=1)
+    return torch.as_tensor(scores).reshape(-1)
 
-        transform = transforms.Compose([
-            transforms.Resize((model_entry["size"], model_entry["size"])),
-            transforms.ToTensor(),
-        ])
-        input_tensor = transform(image_pil).unsqueeze(0)
+def _metric_value(metric, attribute: str) -> float | None:
+    value = getattr(metric, attribute, None) if metric is not None else None
+    if value is None:
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if np.isfinite(value) else None
+
+def checkpoint_thresholds(model) -> dict:
+    """Soglie e statistiche di normalizzazione salvate nel checkpoint Lightning."""
+    normalization = getattr(model, "normalization_metrics", None)
+    return {
+        "image": _metric_value(getattr(model, "image_threshold", None), "value"),
+        "pixel": _metric_value(getattr(model, "pixel_threshold", None), "value"),
+        "min": _metric_value(normalization, "min"),
+        "max": _metric_value(normalization, "max"),
+    }
+
+def _model_thresholds(model, model_entry: dict) -> dict:
+    """Soglie e statistiche di normalizzazione del modello (sovrascrivibili da YAML)."""
+    baked = getattr(model, "thresholds", None)  # modelli esportati: metadati dell'export
+    thresholds = dict(baked) if isinstance(baked, dict) else checkpoint_thresholds(model)
+    if model_entry.get("threshold") is not None:
+        thresholds["image"] = float(model_entry["threshold"])
+    if model_entry.get("pixel_threshold") is not None:
+        thresholds["pixel"] = float(model_entry["pixel_threshold"])
+    if thresholds["pixel"] is None:
+        thresholds["pixel"] = thresholds["image"]
+    return thresholds
+
+def _normalize_score(score: float, thresholds: dict) -> float | None:
+    """Normalizzazione min-max centrata sulla soglia, come nel post-processing di Anomalib."""
+    threshold, low, high = thresholds["image"], thresholds["min"], thresholds["max"]
+    if threshold is None or low is None or high is None or high <= low:
+        return None
+    return float(np.clip((score - threshold) / (high - low) + 0.5, 0.0, 1.0))
+
+def _map_stats(anomaly_map: np.ndarray, pixel_threshold: float | None) -> dict:
+    stats = {
+        "min": float(anomaly_map.min()),
+        "max": float(anomaly_map.max()),
+        "mean": float(anomaly_map.mean()),
+        "p95": float(np.percentile(anomaly_map, 95)),
+        "height": int(anomaly_map.shape[0]),
+        "width": int(anomaly_map.shape[1]),
+    }
+    if pixel_threshold is not None:
+        stats["anomalous_area_ratio"] = float((anomaly_map >= pixel_threshold).mean())
+    return stats
+
+@dataclass
+class AnomalibResult:
+    """Esito di un modello Anomalib su un frame, senza dover decodificare immagini."""
+    name: str
+    model: str
+    frame_id: str
+    score: float
+    normalized_score: float | None
+    threshold: float | None
+    is_anomalous: bool | None
+    map_stats: dict
+    overlay: StoredImage | None = None
+    anomaly_map: np.ndarray | None = field(default=None, repr=False)  # risoluzione del modello
+
+    @property
+    def overlay_path(self) -> Path | None:
+        return self.overlay.path if self.overlay else None
+
+    @property
+    def pred_label(self) -> str | None:
+        if self.is_anomalous is None:
+            return None
+        return "anomalous" if self.is_anomalous else "normal"
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "model": self.model,
+            "frame_id": self.frame_id,
+            "score": self.score,
+            "normalized_score": self.normalized_score,
+            "threshold": self.threshold,
+            "pred_label": self.pred_label,
+            "map_stats": self.map_stats,
+            "overlay": self.overlay_path.name if self.overlay_path else None,
+        }
+
+def analyze_anomalib_batch(
+    frames: list,
+    render_overlays: bool | list[bool] = True,
+    models: list[dict] | None = None,
+) -> list[list[AnomalibResult]]:
+    '''Esegue i modelli abilitati (o le entry `models`) su un batch di frame e restituisce score, label e overlay per frame.'''
+    if isinstance(render_overlays, bool):
+        render_overlays = [render_overlays] * len(frames)
+
+    results: list[list[AnomalibResult]] = [[] for _ in frames]
+
+    if models is None:
+        models = load_anomalib_models_config(CONFIGS_DIR / "anomalib_models.yaml")
+    if not models:
+        logger.error("Nessun modello attivo trovato.")
+        return results
+
+    frames = [as_frame(frame) for frame in frames]
+    valid = [index for index, frame in enumerate(frames) if frame is not None]
+    if len(valid) != len(frames):
+        logger.error("❌ Frame in ingresso non valido.")
+    if not valid:
+        return results
+
+    planned = _resident_models(models)
+    if not planned:
+        return results
 
-        device = next(model.parameters()).device
-        input_tensor = input_tensor.to(device)
+    # Un preprocessing per risoluzione e un'estrazione di feature per backbone condiviso
+    with span("anomalib_forward"):
+        outputs = run_inference_plan(build_inference_plan(planned), [frames[index].image for index in valid])
 
-        with torch.no_grad():
-            if hasattr(model, "model"):
-                output = model.model(input_tensor)
-            else:
-                output = model(input_tensor)
+    for item in planned:
+        model_name = item.entry["model"]
+        output = outputs.get(item.name)
 
         anomaly_tensor = _extract_anomaly_tensor(output)
         if anomaly_tensor is None:
             logger.error("❌ Output del modello privo di anomaly map utilizzabile.")
             continue
-
-        anomaly_map = (anomaly_tensor.cpu().squeeze().numpy() * 255).astype(np.uint8)
-        anomaly_map_resized = cv2.resize(anomaly_map, (image_cv.shape[1], image_cv.shape[0]))
-        
-        # heatmap_color = cv2.applyColorMap(anomaly_map_resized, cv2.COLORMAP_JET)
-        # overlay = cv2.addWeighted(image_cv, 0.6, heatmap_color, 0.4, 0)
-        
-        # Color anomaly map con overlay e contorni
-        overlay = color_anomaly_map(anomaly_map_resized, image_cv)
-
-        filename = f"anomalib_{model_name.lower()}_{uuid.uuid4().hex}.jpg"
-        final_path = output_path / filename
-        cv2.imwrite(str(final_path), overlay)
-        logger.info(f"✅ Output {model_name} salvato in: {final_path}")
-        paths.append(final_path)
-
-    if not paths:
-        return None
-    return paths[0]  # oppure return all paths
+        if anomaly_tensor.ndim == 2:
+            anomaly_tensor = anomaly_tensor.unsqueeze(0)
+
+        scores = _extract_pred_scores(output, anomaly_tensor).cpu().numpy()
+        thresholds = _model_thresholds(item.model, item.entry)
+        # Score normalizzato già calcolato nel grafo esportato, se la soglia non è sovrascritta da YAML
+        baked_normalized = None
+        if isinstance(output, dict) and "normalized_score" in output and item.entry.get("threshold") is None:
+            baked_normalized = torch.as_tensor(output["normalized_score"]).reshape(-1).cpu().numpy()
+
+        for position, index in enumerate(valid):
+            frame = frames[index]
+            raw_map = anomaly_tensor[position].cpu().numpy()
+            score = float(scores[position])
+            result = AnomalibResult(
+                name=item.name,
+                model=model_name,
+                frame_id=frame.frame_id,
+                score=score,
+                normalized_score=(
+                    float(baked_normalized[position]) if baked_normalized is not None
+                    else _normalize_score(score, thresholds)
+                ),
+                threshold=thresholds["image"],
+                is_anomalous=None if thresholds["image"] is None else bool(score >= thresholds["image"]),
+                map_stats=_map_stats(raw_map, thresholds["pixel"]),
+                anomaly_map=raw_map,
+            )
+            results[index].append(result)
+
+            if not render_overlays[index]:
+                continue
+
+            # Color anomaly map con overlay e contorni (soglia calcolata alla risoluzione del modello)
+            with span("colormap"):
+                overlay = color_anomaly_map(raw_map, frame.image)
+
+            filename = f"anomalib_{model_name.lower()}_{frame.frame_id}_{uuid.uuid4().hex[:8]}.jpg"
+            result.overlay = store_result("anomalib", filename, overlay, is_defect=result.is_anomalous)
+            logger.info(f"✅ Output {model_name} pronto: {filename}", extra=PER_FRAME)
+
+    return results
+
+def run_anomalib_batch(frames: list) -> list[StoredImage | None]:
+    '''Come analyze_anomalib_batch, ma restituisce solo il primo overlay di ogni frame.'''
+    overlays = []
+    for frame_results in analyze_anomalib_batch(frames, render_overlays=True):
+        rendered = [result.overlay for result in frame_results if result.overlay is not None]
+        overlays.append(rendered[0] if rendered else None)
+    return overlays
+
+def run_anomalib(frame: Frame | np.ndarray | Path) -> StoredImage | None:
+    return run_anomalib_batch([frame])[0]
@@ -1,59 +1,151 @@
-from flask import Flask, send_from_directory, jsonify, send_file, request
+from flask import Flask, Response, g, send_from_directory, jsonify, send_file, request, url_for, stream_with_context
 import os
 from dotenv import load_dotenv
 
+# Prima degli import del progetto: logger, metriche e camera leggono la configurazione all'import
+load_dotenv()
+
 from utils.paths import FRONTEND_DIR, DATASETS_DIR
-from utils.logger import get_logger
+from utils.logger import PER_FRAME, bind_log_context, get_logger, reset_log_context
 from utils.paths import DATA_DIR
+from utils.storage import RESULT_FOLDERS
+from utils.lazy import warm_from_env
+from utils import metrics
 
-from pathlib import Path
-
-from camera import capture_image
-from yolo import run_yolo
-from sam import run_sam
-
-from anomalib_runner import train_enabled_models, run_anomalib
+from io import BytesIO
+import atexit
+import json
+import time
+import uuid
 
+from inference_service import ServiceError
 
-# Carica le variabili da .env (es. porta, debug mode)
-load_dotenv()
 
 # Inizializza il logger
 logger = get_logger()
 
-# Memorizza l'ultimo scatto per consentire anteprima e inferenze coerenti
-last_captured_image: Path | None = None
-
-
-def _capture_and_store_image() -> Path | None:
-    """Effettua uno scatto e aggiorna il riferimento globale."""
-    global last_captured_image
-    image_path = capture_image()
-    if image_path is not None and image_path.exists():
-        last_captured_image = image_path
-    return image_path
-
+# Con INFERENCE_ADDRESS camera e modelli vivono nel processo inference_server.py,
+# condiviso da tutti i worker HTTP; altrimenti girano in questo processo.
+INFERENCE_ADDRESS = os.getenv('INFERENCE_ADDRESS', '').strip()
+
+if INFERENCE_ADDRESS:
+    from inference_server import InferenceClient
+    inference = InferenceClient(INFERENCE_ADDRESS, timeout_s=float(os.getenv('INFERENCE_TIMEOUT_S', '120')))
+    logger.info(f"🔌 Using shared inference server at {INFERENCE_ADDRESS}")
+    # Le latenze HTTP di tutti i worker finiscono nel registro del processo di inferenza, letto da /metrics
+    metrics_forwarder = metrics.MetricsForwarder(
+        lambda observations: inference.call("record_metrics", timeout_s=5, observations=observations)
+    )
+
+    def observe_request(elapsed: float, series: tuple):
+        metrics_forwarder.observe(metrics.HTTP_REQUEST_SECONDS, elapsed, series)
+else:
+    from inference_service import InferenceService
+    inference = InferenceService()
+    # Rilascia camera, batcher e scritture in coda quando il processo termina
+    atexit.register(inference.close)
+    observe_request = metrics.HTTP_REQUEST_SECONDS.observe
+
+
+def _use_last(default: str = 'false') -> bool:
+    return request.args.get('use_last', default).lower() == 'true'
+
+
+def _jpeg_response(snapshot: dict):
+    """Invia al client un JPEG già codificato in memoria."""
+    response = send_file(BytesIO(snapshot["jpeg"]), mimetype='image/jpeg')
+    response.headers['X-Frame-Id'] = snapshot["frame_id"]
+    # Span misurati dal processo di inferenza, se separato
+    metrics.add_timings(snapshot.get("timings"))
+    return response
+
+
+def _mjpeg_parts(stream: str, max_fps: float | None = None):
+    """Genera le parti multipart di uno stream MJPEG leggendo i frame già codificati dal servizio."""
+    seq = 0
+    min_interval = 1.0 / max_fps if max_fps else 0.0
+    while True:
+        started = time.monotonic()
+        try:
+            frame = inference.watch(stream, after=seq)
+        except ServiceError as e:
+            logger.warning(f"⚠️ Closing {stream} stream: {e.message}")
+            return
+        if frame is None:
+            continue
+        seq, jpeg = frame
+        yield (
+            b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: "
+            + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n"
+        )
+        # Un client può chiedere meno fps dell'encoder condiviso
+        remaining = min_interval - (time.monotonic() - started)
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+def _mjpeg_response(stream: str):
+    response = Response(
+        stream_with_context(_mjpeg_parts(stream, request.args.get('fps', type=float))),
+        mimetype='multipart/x-mixed-replace; boundary=frame',
+    )
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+def _sse_events(stream: str):
+    """Server-sent events: un messaggio per ogni nuovo esito pubblicato dal servizio."""
+    seq = 0
+    while True:
+        try:
+            published = inference.watch(stream, after=seq)
+        except ServiceError as e:
+            yield f"event: end\ndata: {json.dumps({'error': e.message})}\n\n"
+            return
+        if published is None:
+            yield ": keepalive\n\n"
+            continue
+        seq, event = published
+        yield f"id: {seq}\ndata: {json.dumps(event)}\n\n"
 
-def _get_image(prefer_last: bool) -> Path | None:
-    """Restituisce l'immagine da usare per l'inferenza.
-
-    Se `prefer_last` è True prova ad usare l'ultimo scatto memorizzato,
-    altrimenti ne effettua uno nuovo.
-    """
-    global last_captured_image
-
-    if prefer_last and last_captured_image and last_captured_image.exists():
-        logger.info(f"♻️  Using cached preview image: {last_captured_image.name}")
-        return last_captured_image
-
-    if prefer_last:
-        logger.warning("⚠️ No cached preview available, capturing a fresh frame.")
-
-    return _capture_and_store_image()
 
 # Crea l'app Flask
 app = Flask(__name__, static_folder=str(FRONTEND_DIR), static_url_path='')
 
+@app.errorhandler(ServiceError)
+def service_error(error: ServiceError):
+    return jsonify({"error": error.message, **error.details}), error.status
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.trace_token = metrics.begin_trace()
+    # Id della richiesta nei log (anche del processo di inferenza); il client può passarne uno suo
+    g.request_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex[:12]
+    g.log_tokens = bind_log_context(request_id=g.request_id)
+
+@app.teardown_request
+def clear_log_context(_error=None):
+    tokens = g.pop('log_tokens', None)
+    if tokens is not None:
+        reset_log_context(tokens)
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    timings = metrics.end_trace(g.pop('trace_token', None))
+    if 'request_id' in g:
+        response.headers['X-Request-Id'] = g.request_id
+    if started is None or not metrics.ENABLED:
+        return response
+    elapsed = time.perf_counter() - started
+    # Per gli stream (MJPEG, SSE) è il tempo fino all'invio degli header
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    observe_request(elapsed, metrics.labels(route=route, method=request.method, status=response.status_code))
+    if metrics.TIMING_HEADERS:
+        response.headers['Server-Timing'] = metrics.server_timing(timings, elapsed)
+    return response
+
 # Rotta per servire il file index.html
 @app.route('/')
 def index():
@@ -62,84 +154,163 @@ def index():
 
 @app.route('/api/ping')
 def ping():
-    logger.info("Received ping request")
+    logger.info("Received ping request", extra=PER_FRAME)
     return jsonify({"message": "pong"}), 200
 
+@app.route('/api/ready')
+def ready():
+    """Stato di caricamento dei modelli: 200 solo quando sono tutti pronti."""
+    payload = inference.call("ready", timeout_s=5)
+    return jsonify(payload), 200 if payload["ready"] else 503
+
 @app.route('/api/preview')
 def preview():
-    image_path = _capture_and_store_image()
+    return _jpeg_response(inference.call("preview"))
 
-    if image_path is None or not image_path.exists():
-        logger.error("❌ Unable to capture preview.")
-        return jsonify({"error": "Preview capture failure"}), 500
 
-    logger.info("✅ Preview ready, sending to frontend.")
-    return send_file(image_path, mimetype='image/jpeg')
+@app.route('/api/stream.mjpg')
+def preview_stream():
+    """Anteprima live MJPEG: un solo encoder condiviso da tutti gli spettatori."""
+    return _mjpeg_response("preview")
 
+@app.route('/api/stream/metrics')
+def stream_metrics():
+    return jsonify(inference.call("stream_metrics")), 200
+
+@app.route('/api/inspection/start', methods=['POST'])
+def inspection_start():
+    """Avvia l'ispezione continua: {"pipeline": "yolo" | "anomalib" | "both", "every_n": 1}."""
+    body = request.get_json(silent=True) or {}
+    every_n = body.get("every_n", request.args.get('every_n', 1))
+    try:
+        every_n = int(every_n) if not isinstance(every_n, (bool, float)) else None
+    except (TypeError, ValueError):
+        every_n = None
+    if every_n is None or every_n < 1:
+        return jsonify({"error": "'every_n' must be a positive integer"}), 400
+    status = inference.call(
+        "inspection_start",
+        pipeline=body.get("pipeline", request.args.get('pipeline', 'anomalib')),
+        every_n=every_n,
+    )
+    return jsonify(status), 200
+
+@app.route('/api/inspection/stop', methods=['POST'])
+def inspection_stop():
+    return jsonify(inference.call("inspection_stop")), 200
+
+@app.route('/api/inspection/status')
+def inspection_status():
+    return jsonify(inference.call("inspection_status")), 200
+
+@app.route('/api/inspection/stream.mjpg')
+def inspection_stream():
+    """Overlay annotati dell'ispezione continua in MJPEG."""
+    return _mjpeg_response("inspection_frames")
+
+@app.route('/api/inspection/events')
+def inspection_events():
+    """Esiti dell'ispezione continua (score, detection, latenze) come server-sent events."""
+    response = Response(stream_with_context(_sse_events("inspection_events")), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/api/yolo-snapshot')
 def yolo_snapshot():
-    reuse_last = request.args.get('use_last', 'false').lower() == 'true'
-    image_path = _get_image(reuse_last)
-
-    if image_path is None or not image_path.exists():
-        logger.error("❌ Unable to capture frame for YOLO.")
-        return jsonify({"error": "Capture error"}), 500
-
-    prediction_path = run_yolo(image_path)
-
-    if prediction_path is None or not prediction_path.exists():
-        logger.error("❌ YOLO inference failed.")
-        return jsonify({"error": "YOLO inference error"}), 500
-
-    logger.info("✅ YOLO snapshot ready, sending to frontend.")
-    return send_file(prediction_path, mimetype='image/jpeg')
+    return _jpeg_response(inference.call("yolo", use_last=_use_last()))
 
 @app.route('/api/sam-snapshot')
 def sam_snapshot():
-    reuse_last = request.args.get('use_last', 'false').lower() == 'true'
-    image_path = _get_image(reuse_last)
-
-    if image_path is None:
-        logger.error("❌ Unable to capture frame for SAM.")
-        return jsonify({"error": "Capture error"}), 500
-
-    prediction_path = run_sam(image_path)
-
-    if prediction_path is None or not prediction_path.exists():
-        logger.error("❌ SAM segmentation failed.")
-        return jsonify({"error": "SAM inference error"}), 500
-
-    logger.info("✅ SAM snapshot ready, sending to frontend.")
-    return send_file(prediction_path, mimetype='image/jpeg')
+    return _jpeg_response(inference.call("sam", use_last=_use_last()))
+
+@app.route('/api/yolo-sam-snapshot')
+def yolo_sam_snapshot():
+    conf = request.args.get('conf', type=float)
+    return _jpeg_response(inference.call("yolo_sam", use_last=_use_last(), conf=conf))
+
+@app.route('/api/sam/prompt', methods=['POST'])
+def sam_prompt():
+    """Segmentazione SAM guidata da punti/box; riusa l'embedding del frame se già calcolato."""
+    body = request.get_json(silent=True) or {}
+    return _jpeg_response(inference.call(
+        "sam_prompt",
+        points=body.get("points"),
+        labels=body.get("labels"),
+        boxes=body.get("boxes"),
+        use_last=_use_last('true'),
+    ))
+
+@app.route('/api/sam/cache')
+def sam_cache():
+    return jsonify(inference.call("sam_cache")), 200
 
 @app.route('/api/anomalib_snapshot', methods=['GET', 'POST'])
 def anomalib_snapshot():
-    try:
-        reuse_last = request.args.get('use_last', 'false').lower() == 'true'
-        image_path = _get_image(reuse_last)
-
-        if image_path is None:
-            logger.error("❌ Unable to capture frame for Anomalib.")
-            return jsonify({"error": "Capture error"}), 500
-
-        prediction_path = run_anomalib(image_path)
-
-        if prediction_path is None or not prediction_path.exists():
-            logger.error("❌ Anomalib inference failed.")
-            return jsonify({"error": "Anomalib inference error"}), 500
-
-        logger.info("✅ Anomalib snapshot ready, sending to frontend.")
-        return send_file(prediction_path, mimetype='image/jpeg')
-    except Exception as e:
-        logger.exception("❌ Anomalib error:")
-        return jsonify({"error": str(e)}), 500
-
-
-
-# Avvio dell'applicazione se eseguito direttamente
+    return _jpeg_response(inference.call("anomalib_snapshot", use_last=_use_last()))
+
+
+@app.route('/api/anomalib/scores', methods=['GET', 'POST'])
+def anomalib_scores():
+    """Esito strutturato di tutti i modelli Anomalib attivi (score, label, statistiche)."""
+    with_overlays = request.args.get('overlays', 'false').lower() == 'true'
+    payload = inference.call("anomalib_scores", use_last=_use_last(), overlays=with_overlays)
+    for model in payload["models"]:
+        overlay_name = model.pop("overlay_name")
+        model["overlay_url"] = (
+            url_for('result_file', folder='anomalib', filename=overlay_name) if overlay_name else None
+        )
+    return jsonify(payload), 200
+
+@app.route('/api/anomalib/config', methods=['GET', 'POST'])
+def anomalib_config():
+    """Entry attive, errori e avvisi di validazione di anomalib_models.yaml (POST: ricarica subito)."""
+    return jsonify(inference.call("anomalib_config", reload=request.method == 'POST')), 200
+
+@app.route('/api/results/<folder>/<path:filename>')
+def result_file(folder: str, filename: str):
+    if folder not in RESULT_FOLDERS:
+        return jsonify({"error": "Unknown result folder"}), 404
+    return send_from_directory(DATA_DIR / folder, filename)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Istogrammi per stadio e per rotta in formato Prometheus."""
+    if not metrics.ENABLED:
+        return jsonify({"error": "Metrics disabled"}), 404
+    # Con il processo di inferenza separato è l'unico registro (span e latenze HTTP di tutti i worker):
+    # ogni scrape vede le stesse serie qualunque worker risponda
+    snapshot = inference.call("metrics", timeout_s=5) if INFERENCE_ADDRESS else metrics.snapshot()
+    return Response(metrics.render_prometheus(snapshot), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/storage/metrics')
+def storage_metrics():
+    return jsonify(inference.call("storage_metrics")), 200
+
+@app.route('/api/batching/metrics')
+def batching_metrics():
+    return jsonify(inference.call("batching_metrics")), 200
+
+@app.route('/api/camera/start', methods=['POST'])
+def camera_start():
+    return jsonify(inference.call("camera_start")), 200
+
+@app.route('/api/camera/stop', methods=['POST'])
+def camera_stop():
+    return jsonify(inference.call("camera_stop")), 200
+
+@app.route('/api/camera/health')
+def camera_health():
+    health = inference.call("camera_health")
+    return jsonify(health), 200 if health["running"] else 503
+
+# Avvio dell'applicazione se eseguito direttamente (server di sviluppo; in produzione vedi wsgi.py)
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))  # Usa la porta definita in .env o 5000 di default
     debug = os.getenv('DEBUG', 'true').lower() == 'true' # Usa il debug mode definito in .env o true di default
     logger.info(f"Starting VisionCheck on port {port} (debug={debug})")
+    # Con il reloader di debug il warmup parte solo nel processo che serve le richieste;
+    # con un inference server esterno è quest'ultimo a caricare i modelli
+    if not INFERENCE_ADDRESS and (not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        warm_from_env()
     app.run(host='0.0.0.0', port=port, debug=debug)
@@ -0,0 +1,305 @@
+'''Ispezione offline di una cartella di immagini con Anomalib e/o YOLO.
+
+Pipeline produttore/consumatore a code limitate: più thread decodificano le
+immagini, il thread principale le raggruppa in batch per l'inferenza (un
+forward per batch, come il micro-batching del server) e un pool separato
+disegna e scrive gli overlay. Ogni batch completato viene aggiunto subito a
+results.csv, quindi un'esecuzione interrotta riparte con --resume dalle
+immagini mancanti. A fine run stampa immagini/s e i tempi per stadio.
+
+    python batch_inspect.py ../datasets/hazelnut_toy/crack --pipeline anomalib
+    python batch_inspect.py ../data/images --pipeline both --overlays --format parquet --resume
+'''
+import argparse
+import csv
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+
+from utils.paths import CONFIGS_DIR
+from utils.frames import Frame
+from utils.logger import get_logger
+
+logger = get_logger('visioncheck')
+
+PIPELINES = ("anomalib", "yolo", "both")
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff"}
+BASE_COLUMNS = ("path", "frame_id", "width", "height", "status", "label")
+YOLO_COLUMNS = ("yolo_detections", "yolo_max_conf", "yolo_classes")
+
+
+def list_images(input_dir: Path, recursive: bool = False) -> list[Path]:
+    paths = input_dir.rglob("*") if recursive else input_dir.glob("*")
+    return sorted(path for path in paths if path.is_file() and path.suffix.lower() in IMAGE_SUFFIXES)
+
+
+def result_columns(pipeline: str, model_names: list[str]) -> list[str]:
+    columns = list(BASE_COLUMNS)
+    if pipeline in ("anomalib", "both"):
+        for name in model_names:
+            columns += [f"{name}_score", f"{name}_normalized", f"{name}_label"]
+    if pipeline in ("yolo", "both"):
+        columns += YOLO_COLUMNS
+    return columns
+
+
+def completed_paths(csv_path: Path, columns: list[str]) -> set[str]:
+    '''Immagini elaborate con successo nel CSV di una run precedente con le stesse colonne.
+
+    Le righe con errore (es. decode_error di un file ancora in scrittura)
+    vengono tolte dal CSV, così la ripresa le rielabora senza duplicati.
+    '''
+    with open(csv_path, newline="") as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames != columns:
+            raise SystemExit(
+                f"❌ {csv_path} ha colonne diverse da quelle attuali (pipeline o modelli cambiati): "
+                "rilanciare senza --resume o cambiare --output"
+            )
+        rows = list(reader)
+    completed = [row for row in rows if row["status"] == "ok"]
+    if len(completed) < len(rows):
+        logger.info(f"🔁 {len(rows) - len(completed)} immagini con errore nella run precedente, da rielaborare")
+        temporary = csv_path.with_suffix(".csv.tmp")
+        with open(temporary, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(completed)
+        temporary.replace(csv_path)
+    return {row["path"] for row in completed}
+
+
+class StageTimer:
+    '''Tempo cumulato per stadio, aggiornato da più thread.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals: dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+
+
+class BatchInspector:
+    def __init__(self, args):
+        self.args = args
+        self.input_dir = Path(args.input).resolve()
+        self.output_dir = Path(args.output) if args.output else Path("results") / "batch" / self.input_dir.name
+        self.overlay_dir = self.output_dir / "overlays"
+        self.csv_path = self.output_dir / "results.csv"
+        self.timer = StageTimer()
+        self.processed = 0
+        self.failed = 0
+        self._write_slots = threading.BoundedSemaphore(args.queue)
+
+        # Entry lette una volta sola: colonne del CSV e modelli eseguiti restano allineati anche se il YAML cambia durante la run
+        self.models: list[dict] = []
+        if args.pipeline in ("anomalib", "both"):
+            from anomalib_runner import load_anomalib_models_config
+
+            self.models = load_anomalib_models_config(CONFIGS_DIR / "anomalib_models.yaml")
+        self.model_names = [entry["name"] for entry in self.models]
+        self.columns = result_columns(args.pipeline, self.model_names)
+
+    # --- stadi della pipeline -------------------------------------------------
+
+    def _decode_worker(self, paths: queue.Queue, frames: queue.Queue):
+        while True:
+            path = paths.get()
+            if path is None:
+                frames.put(None)
+                return
+            start = time.perf_counter()
+            image = cv2.imread(str(path))
+            self.timer.add("decode", time.perf_counter() - start)
+            relative = path.relative_to(self.input_dir).as_posix()
+            frame = Frame(image=image, frame_id=path.stem, source=relative) if image is not None else None
+            frames.put((relative, frame))  # si blocca se l'inferenza è indietro: memoria limitata
+
+    def _infer(self, frames: list[Frame]) -> tuple[list, list]:
+        anomalib_results, detections = [[] for _ in frames], [None] * len(frames)
+        if self.args.pipeline in ("anomalib", "both"):
+            from anomalib_runner import analyze_anomalib_batch
+
+            start = time.perf_counter()
+            anomalib_results = analyze_anomalib_batch(frames, render_overlays=False, models=self.models)
+            self.timer.add("anomalib", time.perf_counter() - start)
+        if self.args.pipeline in ("yolo", "both"):
+            from yolo import predict_frames
+
+            start = time.perf_counter()
+            detections = predict_frames(frames) or [None] * len(frames)
+            self.timer.add("yolo", time.perf_counter() - start)
+        return anomalib_results, detections
+
+    def _row(self, relative: str, frame: Frame, results: list, detection) -> dict:
+        height, width = frame.image.shape[:2]
+        row = {"path": relative, "frame_id": frame.frame_id, "width": width, "height": height, "status": "ok"}
+        labels = []
+        for result in results:
+            row[f"{result.name}_score"] = round(result.score, 6)
+            row[f"{result.name}_normalized"] = round(result.normalized_score, 6) if result.normalized_score is not None else None
+            row[f"{result.name}_label"] = result.pred_label
+            labels.append(result.is_anomalous)
+        if detection is not None:
+            boxes = detection.boxes
+            names = detection.names
+            confidences = [float(value) for value in boxes.conf.tolist()] if boxes is not None else []
+            classes = [names[int(value)] for value in boxes.cls.tolist()] if boxes is not None else []
+            row["yolo_detections"] = len(confidences)
+            row["yolo_max_conf"] = round(max(confidences), 4) if confidences else None
+            row["yolo_classes"] = ";".join(f"{name}:{conf:.2f}" for name, conf in zip(classes, confidences))
+        if any(label is True for label in labels):
+            row["label"] = "anomalous"
+        elif labels and all(label is False for label in labels):
+            row["label"] = "normal"
+        return row
+
+    def _write_overlay(self, frame: Frame, results: list, detection):
+        try:
+            start = time.perf_counter()
+            image = frame.image
+            if results and results[0].anomaly_map is not None:
+                from heatmap import color_anomaly_map
+
+                image = color_anomaly_map(results[0].anomaly_map, image)
+            if detection is not None:
+                image = detection.plot(img=image.copy())
+            output = self.overlay_dir / f"{Path(frame.source).with_suffix('').as_posix().replace('/', '__')}.jpg"
+            cv2.imwrite(str(output), image, [cv2.IMWRITE_JPEG_QUALITY, self.args.quality])
+            self.timer.add("write", time.perf_counter() - start)
+        except Exception:
+            logger.exception(f"❌ Overlay non scritto per {frame.source}:")
+        finally:
+            self._write_slots.release()
+
+    # --- esecuzione -----------------------------------------------------------
+
+    def run(self) -> dict:
+        args = self.args
+        paths = list_images(self.input_dir, args.recursive)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        if args.overlays:
+            self.overlay_dir.mkdir(parents=True, exist_ok=True)
+
+        done = completed_paths(self.csv_path, self.columns) if args.resume and self.csv_path.exists() else set()
+        todo = [path for path in paths if path.relative_to(self.input_dir).as_posix() not in done]
+        logger.info(f"📂 {self.input_dir}: {len(paths)} immagini, {len(done)} già elaborate, {len(todo)} da fare")
+        if not todo:
+            return self._summary(0.0)
+
+        path_queue: queue.Queue = queue.Queue()
+        for path in todo:
+            path_queue.put(path)
+        for _ in range(args.decode_workers):
+            path_queue.put(None)
+        frame_queue: queue.Queue = queue.Queue(maxsize=args.queue)
+        for _ in range(args.decode_workers):
+            threading.Thread(target=self._decode_worker, args=(path_queue, frame_queue), daemon=True).start()
+
+        append = bool(done)
+        start = last_report = time.perf_counter()
+        with open(self.csv_path, "a" if append else "w", newline="") as f, \
+                ThreadPoolExecutor(max_workers=args.write_workers, thread_name_prefix="batch-write") as writers:
+            writer = csv.DictWriter(f, fieldnames=self.columns, extrasaction="ignore")
+            if not append:
+                writer.writeheader()
+
+            finished, batch = 0, []
+            try:
+                while finished < args.decode_workers:
+                    item = frame_queue.get()
+                    if item is None:
+                        finished += 1
+                    else:
+                        batch.append(item)
+                    if batch and (len(batch) >= args.batch_size or finished == args.decode_workers):
+                        self._process(batch, writer, writers)
+                        f.flush()
+                        batch = []
+                    if time.perf_counter() - last_report >= 10:
+                        last_report = time.perf_counter()
+                        rate = self.processed / (last_report - start)
+                        logger.info(f"⏱️  {self.processed}/{len(todo)} immagini, {rate:.1f} img/s, coda {frame_queue.qsize()}")
+            except KeyboardInterrupt:
+                logger.warning(f"⏹️ Interrotto: {self.processed} immagini salvate, riprendere con --resume")
+        elapsed = time.perf_counter() - start
+
+        summary = self._summary(elapsed)
+        if args.format == "parquet":
+            summary["parquet"] = write_parquet(self.csv_path)
+        (self.output_dir / "summary.json").write_text(json.dumps(summary, indent=2))
+        return summary
+
+    def _process(self, batch: list, writer: csv.DictWriter, writers: ThreadPoolExecutor):
+        rows = []
+        valid = [(relative, frame) for relative, frame in batch if frame is not None]
+        for relative, frame in batch:
+            if frame is None:
+                rows.append({"path": relative, "status": "decode_error"})
+                self.failed += 1
+        if valid:
+            frames = [frame for _, frame in valid]
+            anomalib_results, detections = self._infer(frames)
+            for (relative, frame), results, detection in zip(valid, anomalib_results, detections):
+                rows.append(self._row(relative, frame, results, detection))
+                if self.args.overlays:
+                    self._write_slots.acquire()  # al massimo `queue` overlay in attesa di scrittura
+                    writers.submit(self._write_overlay, frame, results, detection)
+        writer.writerows(rows)
+        self.processed += len(batch)
+
+    def _summary(self, elapsed: float) -> dict:
+        return {
+            "input": str(self.input_dir),
+            "csv": str(self.csv_path),
+            "processed": self.processed,
+            "decode_errors": self.failed,
+            "elapsed_s": round(elapsed, 2),
+            "images_per_s": round(self.processed / elapsed, 2) if elapsed > 0 else None,
+            # Tempi cumulati: decode e write sono sommati su più thread, quindi possono superare elapsed_s
+            "stage_s": {stage: round(total, 2) for stage, total in self.timer.totals.items()},
+        }
+
+
+def write_parquet(csv_path: Path) -> str | None:
+    '''Converte il CSV in Parquet (richiede pandas + pyarrow, dipendenze opzionali).'''
+    try:
+        import pandas as pd
+
+        parquet_path = csv_path.with_suffix(".parquet")
+        pd.read_csv(csv_path).to_parquet(parquet_path, index=False)
+    except ImportError as e:
+        logger.error(f"❌ Parquet non disponibile ({e}): pip install pandas pyarrow. Il CSV resta in {csv_path}")
+        return None
+    return str(parquet_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="cartella di immagini")
+    parser.add_argument("--pipeline", choices=PIPELINES, default="anomalib")
+    parser.add_argument("--output", help="cartella dei risultati (default: results/batch/<nome cartella>)")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--decode-workers", type=int, default=4)
+    parser.add_argument("--write-workers", type=int, default=2)
+    parser.add_argument("--queue", type=int, default=32, help="immagini decodificate e overlay in attesa, al massimo")
+    parser.add_argument("--overlays", action="store_true", help="salva anche gli overlay in <output>/overlays")
+    parser.add_argument("--quality", type=int, default=90, help="qualità JPEG degli overlay")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--resume", action="store_true", help="salta le immagini già elaborate in results.csv (quelle con errore vengono riprovate)")
+    parser.add_argument("--recursive", action="store_true")
+    args = parser.parse_args()
+
+    summary = BatchInspector(args).run()
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
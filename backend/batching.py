@@ -0,0 +1,173 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from utils.logger import get_logger
+
+logger = get_logger()
+
+
+class BatcherOverloaded(RuntimeError):
+    '''La coda del batcher è piena: la richiesta viene rifiutata subito.'''
+
+
+class MicroBatcher:
+    '''Raccoglie richieste concorrenti e le esegue in un unico forward batched.
+
+    Un thread dedicato prende il primo elemento in coda e attende al massimo
+    `max_wait_ms` (o finché il batch non è pieno) prima di chiamare
+    `process_batch`, che riceve la lista degli input e deve restituire una
+    lista di risultati nello stesso ordine. Ogni chiamante riceve il proprio
+    risultato tramite una Future.
+    '''
+
+    def __init__(
+        self,
+        name: str,
+        process_batch: Callable[[list], list],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        max_queue: int = 256,
+        window_s: float = 60.0,
+    ):
+        self.name = name
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_s = max(0.0, max_wait_ms) / 1000.0
+        self.window_s = window_s
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        self._running = False
+
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._errors = 0
+        self._rejected = 0
+        self._max_batch_seen = 0
+        self._recent: deque = deque()  # (fine batch, elementi, durata forward, attesa media)
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._running = True
+                self._thread = threading.Thread(target=self._loop, name=f"batcher-{self.name}", daemon=True)
+                self._thread.start()
+
+    def submit_async(self, item: Any) -> Future:
+        '''Accoda un input e restituisce la Future del relativo risultato.'''
+        self._ensure_started()
+        future: Future = Future()
+        try:
+            self._queue.put_nowait((item, future, time.perf_counter()))
+        except queue.Full:
+            with self._stats_lock:
+                self._rejected += 1
+            raise BatcherOverloaded(f"{self.name} batcher queue is full")
+        return future
+
+    def submit(self, item: Any, timeout: float | None = None) -> Any:
+        '''Accoda un input e attende il risultato (rilancia l'eventuale eccezione).'''
+        return self.submit_async(item).result(timeout=timeout)
+
+    def _collect(self) -> list:
+        first = self._queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait_s
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._running = False
+                break
+            batch.append(item)
+        return batch
+
+    def _loop(self):
+        while self._running:
+            batch = self._collect()
+            if not batch:
+                break
+
+            inputs = [item for item, _, _ in batch]
+            started = time.perf_counter()
+            waited = sum(started - enqueued for _, _, enqueued in batch) / len(batch)
+            try:
+                results = self.process_batch(inputs)
+                if len(results) != len(batch):
+                    raise RuntimeError(f"{self.name}: expected {len(batch)} results, got {len(results)}")
+            except Exception as e:
+                logger.exception(f"❌ Batch {self.name} failed:")
+                with self._stats_lock:
+                    self._errors += len(batch)
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            elapsed = time.perf_counter() - started
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+            with self._stats_lock:
+                self._batches += 1
+                self._items += len(batch)
+                self._max_batch_seen = max(self._max_batch_seen, len(batch))
+                self._recent.append((time.time(), len(batch), elapsed, waited))
+                self._trim_window()
+
+    def _trim_window(self):
+        horizon = time.time() - self.window_s
+        while self._recent and self._recent[0][0] < horizon:
+            self._recent.popleft()
+
+    def stop(self):
+        '''Ferma il thread dopo aver smaltito gli elementi già in coda.'''
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+    def metrics(self) -> dict:
+        '''Throughput, dimensione media dei batch e profondità della coda.'''
+        with self._stats_lock:
+            self._trim_window()
+            window_items = sum(n for _, n, _, _ in self._recent)
+            window_batches = len(self._recent)
+            return {
+                "name": self.name,
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait_s * 1000,
+                "queue_depth": self._queue.qsize(),
+                "batches_total": self._batches,
+                "items_total": self._items,
+                "errors_total": self._errors,
+                "rejected_total": self._rejected,
+                "max_batch_seen": self._max_batch_seen,
+                "window_s": self.window_s,
+                "throughput_items_per_s": round(window_items / self.window_s, 3),
+                "avg_batch_size": round(window_items / window_batches, 2) if window_batches else 0,
+                "avg_forward_ms": round(1000 * sum(d for _, _, d, _ in self._recent) / window_batches, 2) if window_batches else 0,
+                "avg_queue_wait_ms": round(1000 * sum(w for _, _, _, w in self._recent) / window_batches, 2) if window_batches else 0,
+            }
+
+
+def batcher_from_env(name: str, process_batch: Callable[[list], list]) -> MicroBatcher:
+    '''Crea un batcher leggendo i limiti da variabili d'ambiente (es. YOLO_MAX_BATCH).'''
+    prefix = name.upper()
+    return MicroBatcher(
+        name=name,
+        process_batch=process_batch,
+        max_batch_size=int(os.getenv(f"{prefix}_MAX_BATCH", "8")),
+        max_wait_ms=float(os.getenv(f"{prefix}_MAX_WAIT_MS", "10")),
+        max_queue=int(os.getenv(f"{prefix}_MAX_QUEUE", "256")),
+    )
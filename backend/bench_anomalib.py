@@ -0,0 +1,97 @@
+'''Benchmark dei backend di inferenza Anomalib: PyTorch eager contro ONNX Runtime e OpenVINO.
+
+Per ogni entry misura la latenza del forward (preprocessing escluso) con i
+backend disponibili e verifica che score e anomaly map coincidano con il
+percorso Torch.
+
+    python anomalib_export.py --names padim_512
+    python bench_anomalib.py --names padim_512 --batch-sizes 1,4 --repeats 20
+'''
+import argparse
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+
+from utils.paths import CONFIGS_DIR, DATASETS_DIR
+from anomalib_backends import ExportWrapper, artifact_path, load_exported_model
+from anomalib_planner import preprocess_batch
+from anomalib_runner import (
+    INFERENCE_MODEL_CLASSES,
+    checkpoint_thresholds,
+    get_latest_ckpt_path,
+    load_checkpoint_with_fallback,
+    select_model_entries,
+)
+from bench_heatmap import time_call
+
+
+def load_images(dataset: str, count: int) -> list[np.ndarray]:
+    '''Immagini "good" del dataset; rumore se il dataset non è disponibile.'''
+    paths = sorted((DATASETS_DIR / dataset / "good").glob("*"))[:count]
+    images = [image for image in (cv2.imread(str(path)) for path in paths) if image is not None]
+    rng = np.random.default_rng(0)
+    while len(images) < count:
+        images.append(rng.integers(0, 255, size=(480, 640, 3), dtype=np.uint8))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default=str(CONFIGS_DIR / "anomalib_models.yaml"))
+    parser.add_argument("--names", help="entry da misurare separate da virgola (default: quelle abilitate)")
+    parser.add_argument("--dataset", default="hazelnut_toy")
+    parser.add_argument("--batch-sizes", default="1,4")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=0, help="thread di torch (0 = default)")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    entries = select_model_entries(Path(args.config), args.names)
+
+    batch_sizes = [int(value) for value in args.batch_sizes.split(",")]
+    images = load_images(args.dataset, max(batch_sizes))
+
+    print(f"{'entry':<24} {'backend':<9} {'batch':>5} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'ms/img':>8} {'max Δscore':>11} {'max Δmap':>10}")
+    for entry in entries:
+        model_class = INFERENCE_MODEL_CLASSES.get(entry["model"])
+        ckpt_path = get_latest_ckpt_path(entry["model"], args.dataset)
+        if model_class is None or ckpt_path is None:
+            continue
+        model = load_checkpoint_with_fallback(model_class, ckpt_path, entry)
+        if model is None:
+            continue
+        # Stesso post-processing del grafo esportato, così i risultati sono confrontabili
+        reference = ExportWrapper(getattr(model.eval(), "model", model), checkpoint_thresholds(model)).eval()
+
+        backends = {"torch": lambda tensor: dict(zip(reference.output_names, reference(tensor)))}
+        for backend in ("onnx", "openvino"):
+            artifact = artifact_path(ckpt_path, entry["name"], backend)
+            if not artifact.exists():
+                continue
+            try:
+                backends[backend] = load_exported_model(artifact)
+            except ImportError as e:
+                print(f"{entry['name']:<24} {backend:<9} non disponibile: {e}")
+
+        for batch_size in batch_sizes:
+            tensor = preprocess_batch(images[:batch_size], int(entry["size"]), torch.device("cpu"))
+            with torch.no_grad():
+                expected = backends["torch"](tensor)
+                for backend, run in backends.items():
+                    timings = time_call(lambda: run(tensor), args.repeats)
+                    output = run(tensor)
+                    score_delta = float((output["pred_score"] - expected["pred_score"]).abs().max())
+                    map_delta = float((output["anomaly_map"] - expected["anomaly_map"]).abs().max())
+                    print(
+                        f"{entry['name']:<24} {backend:<9} {batch_size:>5} {timings.mean():>9.1f} "
+                        f"{np.percentile(timings, 50):>9.1f} {np.percentile(timings, 95):>9.1f} "
+                        f"{timings.mean() / batch_size:>8.1f} {score_delta:>11.2e} {map_delta:>10.2e}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+'''Benchmark del rendering dell'anomaly map alle risoluzioni dei sensori in uso.
+
+Confronta color_anomaly_map (LUT + soglia a risoluzione nativa) con
+l'implementazione precedente basata su matplotlib applicata a piena risoluzione.
+
+    python bench_heatmap.py --repeats 20
+'''
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from heatmap import color_anomaly_map
+
+# (nome, larghezza, altezza)
+SENSORS = [
+    ("5MP", 2592, 1944),
+    ("12MP", 4000, 3000),
+]
+
+
+def legacy_color_anomaly_map(anomaly_map: np.ndarray, image: np.ndarray) -> np.ndarray:
+    '''Versione precedente: colormap matplotlib e percentile sulla mappa già riscalata.'''
+    from matplotlib.colors import LinearSegmentedColormap
+
+    anomaly_map = cv2.resize((anomaly_map * 255).astype(np.uint8), (image.shape[1], image.shape[0]))
+    norm_map = cv2.normalize(anomaly_map, None, 0, 1.0, cv2.NORM_MINMAX, dtype=cv2.CV_32F)
+    colors = [
+        (0.0, (0.45, 0.0, 0.5)),
+        (0.3, (0.8, 0.2, 0.6)),
+        (0.6, (1.0, 0.7, 0.3)),
+        (1.0, (1.0, 0.4, 0.0)),
+    ]
+    cmap = LinearSegmentedColormap.from_list("patchcore", colors)
+    colored = (cmap(norm_map)[..., :3] * 255).astype(np.uint8)
+    overlay = cv2.addWeighted(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), 0.6, colored, 0.4, 0)
+    threshold = np.percentile(anomaly_map, 90)
+    _, binary_mask = cv2.threshold(anomaly_map, threshold, 255, cv2.THRESH_BINARY)
+    contours, _ = cv2.findContours(binary_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cv2.drawContours(overlay, contours, -1, (255, 100, 0), max(2, int(image.shape[0] / 100)))
+    return overlay
+
+
+def synthetic_inputs(width: int, height: int, map_size: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    '''Frame rumoroso e anomaly map con due "difetti" gaussiani.'''
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 255, size=(height, width, 3), dtype=np.uint8)
+    yy, xx = np.mgrid[0:map_size, 0:map_size].astype(np.float32) / map_size
+    anomaly_map = 0.1 * rng.random((map_size, map_size), dtype=np.float32)
+    for cx, cy in ((0.3, 0.4), (0.7, 0.65)):
+        anomaly_map += np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / 0.005)
+    return image, anomaly_map / anomaly_map.max()
+
+
+def time_call(fn, repeats: int, warmup: int = 2) -> np.ndarray:
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.array(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--map-size", type=int, default=512, help="risoluzione nativa della anomaly map")
+    parser.add_argument("--skip-legacy", action="store_true", help="non misura la versione matplotlib")
+    args = parser.parse_args()
+
+    print(f"{'sensore':<8} {'impl':<8} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, width, height in SENSORS:
+        image, anomaly_map = synthetic_inputs(width, height, args.map_size)
+        candidates = [("lut", lambda: color_anomaly_map(anomaly_map, image))]
+        if not args.skip_legacy:
+            candidates.append(("legacy", lambda: legacy_color_anomaly_map(anomaly_map, image)))
+
+        for impl, fn in candidates:
+            timings = time_call(fn, args.repeats)
+            print(
+                f"{name:<8} {impl:<8} {timings.mean():>9.1f} "
+                f"{np.percentile(timings, 50):>9.1f} {np.percentile(timings, 95):>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+'''Benchmark riproducibile di tutti i percorsi di inferenza.
+
+Usa le immagini di datasets/hazelnut_toy ridimensionate alle risoluzioni
+richieste e, per l'acquisizione, una "camera" sintetica (le stesse immagini in
+JPEG, decodificate in loop a frame rate fisso come una camera MJPG). Per ogni suite, risoluzione e numero di thread misura
+p50/p95/p99, media e throughput; il cold start (import + caricamento modello +
+prima inferenza) viene misurato in un processo separato, così non dipende
+dall'ordine delle suite. I risultati vanno in un JSON con i metadati
+dell'ambiente; `compare` confronta due file e segnala le regressioni
+(exit code 1, utilizzabile in CI).
+
+    python benchmark.py run --suites capture,heatmap,yolo --sizes 640x480,1920x1080 --threads 1,4 --capture-fps 30
+    python benchmark.py run --suites anomalib --entries padim_512 --repeats 50
+    python benchmark.py compare results/benchmarks/base.json results/benchmarks/bench_20240101_120000.json
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Prima degli import del progetto: i risultati non devono finire in data/ né essere serviti dalla cache
+os.environ.setdefault("DATA_DIR", str(Path(tempfile.gettempdir()) / "visioncheck-benchmark"))
+os.environ.setdefault("SAVE_CAPTURES", "false")
+os.environ.setdefault("SAM_EMBEDDING_CACHE_MB", "0")
+
+import cv2
+import numpy as np
+
+from utils.paths import CONFIGS_DIR, DATASETS_DIR
+from utils.frames import Frame
+
+SUITES = ("capture", "heatmap", "yolo", "sam", "anomalib")
+RESULTS_DIR = Path("results") / "benchmarks"
+# metrica -> +1 se peggiora crescendo, -1 se peggiora calando
+COMPARED_METRICS = {"p50_ms": 1, "p95_ms": 1, "p99_ms": 1, "throughput_per_s": -1}
+
+
+def parse_size(value: str) -> tuple[int, int]:
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def dataset_frames(size: tuple[int, int], count: int, dataset: str = "hazelnut_toy") -> list[Frame]:
+    '''Immagini del dataset (good poi crack, ordine fisso) alla risoluzione richiesta.'''
+    paths = sorted((DATASETS_DIR / dataset / "good").glob("*")) + sorted((DATASETS_DIR / dataset / "crack").glob("*"))
+    images = [image for image in (cv2.imread(str(path)) for path in paths) if image is not None]
+    if not images:
+        images = [np.random.default_rng(0).integers(0, 255, size=(512, 512, 3), dtype=np.uint8)]
+    frames = []
+    for index in range(count):
+        image = cv2.resize(images[index % len(images)], size, interpolation=cv2.INTER_AREA)
+        frames.append(Frame(image=image, frame_id=f"bench{index:04d}", source="benchmark"))
+    return frames
+
+
+class SyntheticCapture:
+    '''Al posto di cv2.VideoCapture: JPEG del dataset decodificati a `fps` fissi e in loop, come una camera MJPG.
+
+    Un file video letto alla massima velocità misurerebbe la decodifica del
+    file e, a fine file, il percorso di riconnessione della CameraSession.
+    '''
+
+    def __init__(self, jpegs: list[bytes], fps: float):
+        self.jpegs = jpegs
+        self.interval = 1.0 / fps
+        self._index = 0
+        self._next_due = time.perf_counter()
+        self._opened = True
+
+    def isOpened(self) -> bool:
+        return self._opened
+
+    def release(self):
+        self._opened = False
+
+    def read(self):
+        delay = self._next_due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_due = max(self._next_due + self.interval, time.perf_counter())
+        jpeg = self.jpegs[self._index % len(self.jpegs)]
+        self._index += 1
+        image = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return image is not None, image
+
+
+def synthetic_session(size: tuple[int, int], fps: float, frames: int = 120):
+    '''CameraSession che legge da una SyntheticCapture invece che da un device.'''
+    from camera import CameraSession
+
+    jpegs = [cv2.imencode(".jpg", frame.image)[1].tobytes() for frame in dataset_frames(size, frames)]
+
+    class SyntheticSession(CameraSession):
+        def _open(self) -> bool:
+            self._cap = SyntheticCapture(jpegs, fps)
+            return True
+
+    return SyntheticSession(source=f"synthetic:{size[0]}x{size[1]}@{fps:g}fps")
+
+
+def set_threads(threads: int):
+    cv2.setNumThreads(threads)
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(threads)
+
+
+def summarize(timings_ms: list[float], items_per_call: int = 1) -> dict:
+    timings = np.asarray(timings_ms)
+    return {
+        "repeats": len(timings),
+        "mean_ms": round(float(timings.mean()), 3),
+        "p50_ms": round(float(np.percentile(timings, 50)), 3),
+        "p95_ms": round(float(np.percentile(timings, 95)), 3),
+        "p99_ms": round(float(np.percentile(timings, 99)), 3),
+        "throughput_per_s": round(1000 * items_per_call / float(timings.mean()), 2) if timings.mean() > 0 else None,
+    }
+
+
+def time_frames(fn, frames: list[Frame], repeats: int, warmup: int) -> list[float]:
+    '''Chiama fn su frame diversi a ogni ripetizione; solleva RuntimeError se fn restituisce None.'''
+    for index in range(warmup):
+        if fn(frames[index % len(frames)]) is None:
+            raise RuntimeError("percorso non disponibile (modello non caricato?)")
+    timings = []
+    for index in range(repeats):
+        frame = frames[(warmup + index) % len(frames)]
+        start = time.perf_counter()
+        fn(frame)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+# --- suite ---------------------------------------------------------------------
+
+def suite_cases(suite: str, entries: list[dict]) -> list[tuple[str, object]]:
+    '''(case, funzione frame -> risultato) per la suite; le suite di inferenza importano i moduli solo qui.'''
+    if suite == "heatmap":
+        from bench_heatmap import synthetic_inputs
+        from heatmap import color_anomaly_map
+
+        _, anomaly_map = synthetic_inputs(16, 16, 256)
+        return [("color_anomaly_map", lambda frame: color_anomaly_map(anomaly_map, frame.image))]
+    if suite == "yolo":
+        from yolo import run_yolo
+
+        return [("run_yolo", run_yolo)]
+    if suite == "sam":
+        from sam import run_sam
+
+        return [("run_sam", run_sam)]
+    if suite == "anomalib":
+        from anomalib_runner import analyze_anomalib_batch
+
+        def runner(entry):
+            # Come run_anomalib, limitato a una sola entry
+            def run(frame):
+                results = analyze_anomalib_batch([frame], render_overlays=True, models=[entry])[0]
+                return results or None
+            return run
+
+        return [(entry["name"], runner(entry)) for entry in entries]
+    raise ValueError(f"Suite sconosciuta: {suite}")
+
+
+def bench_capture(size: tuple[int, int], repeats: int, fps: float = 30.0) -> dict:
+    '''Avvio della CameraSession e attesa del frame successivo, come un consumatore che elabora ogni frame nuovo.
+
+    La latenza è il tempo fino al prossimo frame fresco (wait_for_frame dopo
+    l'ultimo visto); il throughput sono i frame nuovi ricevuti al secondo, che
+    resta sotto `fps` se grab e decodifica non tengono il ritmo della sorgente.
+    '''
+    session = synthetic_session(size, fps)
+    start = time.perf_counter()
+    if not session.start() or session.wait_for_frame(timeout=5.0) is None:
+        raise RuntimeError("sorgente sintetica non apribile")
+    cold_start_s = time.perf_counter() - start
+    try:
+        last_index = session.latest()[0]
+        first_index = last_index
+        timings, ages = [], []
+        started = time.perf_counter()
+        for _ in range(repeats):
+            start = time.perf_counter()
+            latest = session.wait_for_frame(newer_than=last_index, timeout=5.0)
+            if latest is None:
+                raise RuntimeError("la sorgente sintetica ha smesso di produrre frame")
+            timings.append((time.perf_counter() - start) * 1000)
+            ages.append((time.time() - latest[1]) * 1000)
+            last_index = latest[0]
+        elapsed = time.perf_counter() - started
+        health = session.health()
+        result = summarize(timings)
+        result["throughput_per_s"] = round(repeats / elapsed, 2)
+        result["source_fps"] = fps
+        result["frame_age_p50_ms"] = round(float(np.percentile(ages, 50)), 3)
+        # Frame prodotti dalla sorgente ma mai visti dal consumatore
+        result["skipped_frames"] = last_index - first_index - repeats
+        result["reconnects"] = health["reconnects"]
+        result["cold_start_s"] = round(cold_start_s, 3)
+        return result
+    finally:
+        session.stop()
+
+
+def cold_start(suite: str, case: str, size: tuple[int, int], threads: int) -> float | None:
+    '''Import + caricamento + prima chiamata, in un processo pulito.'''
+    command = [sys.executable, __file__, "probe", "--suite", suite, "--case", case, "--size", f"{size[0]}x{size[1]}", "--threads", str(threads)]
+    try:
+        output = subprocess.run(command, capture_output=True, text=True, timeout=600, cwd=Path(__file__).parent)
+        return json.loads(output.stdout.strip().splitlines()[-1])["cold_start_s"]
+    except (subprocess.TimeoutExpired, ValueError, IndexError, KeyError):
+        return None
+
+
+def probe(args):
+    set_threads(args.threads)
+    frame = dataset_frames(parse_size(args.size), 1)[0]
+    start = time.perf_counter()
+    entries = _anomalib_entries(args.case) if args.suite == "anomalib" else []
+    cases = dict(suite_cases(args.suite, entries))
+    result = cases[args.case](frame)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"cold_start_s": round(elapsed, 3) if result is not None else None}))
+
+
+def _anomalib_entries(names: str | None) -> list[dict]:
+    from anomalib_runner import select_model_entries
+
+    return select_model_entries(CONFIGS_DIR / "anomalib_models.yaml", names)
+
+
+def _environment() -> dict:
+    from importlib import metadata
+
+    versions = {}
+    for package in ("numpy", "opencv-python", "torch", "ultralytics", "anomalib", "segment-anything", "onnxruntime"):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            pass
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.TimeoutExpired):
+        commit = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "packages": versions,
+    }
+
+
+def run(args) -> Path:
+    suites = [suite.strip() for suite in args.suites.split(",")]
+    sizes = [parse_size(value) for value in args.sizes.split(",")]
+    thread_counts = [int(value) for value in args.threads.split(",")]
+    entries = _anomalib_entries(args.entries) if "anomalib" in suites else []
+
+    results = []
+
+    def record(suite, case, size, threads, **values):
+        row = {"suite": suite, "case": case, "size": f"{size[0]}x{size[1]}", "threads": threads, **values}
+        results.append(row)
+        if "error" in row:
+            print(f"{suite:<9} {case:<28} {row['size']:>10} {threads:>3}  ✗ {row['error']}")
+        else:
+            cold = f"{row['cold_start_s']:.2f}s" if row.get("cold_start_s") is not None else "-"
+            print(
+                f"{suite:<9} {case:<28} {row['size']:>10} {threads:>3} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+                f"{row['p99_ms']:>9.2f} {row['throughput_per_s'] or 0:>9.1f} {cold:>8}"
+            )
+
+    print(f"{'suite':<9} {'case':<28} {'size':>10} {'thr':>3} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'per s':>9} {'cold':>8}")
+    for suite in suites:
+        if suite not in SUITES:
+            print(f"⚠️ Suite sconosciuta: {suite}")
+            continue
+        if suite == "capture":
+            for size in sizes:
+                try:
+                    record(suite, "camera_session", size, 0, **bench_capture(size, args.repeats, args.capture_fps))
+                except Exception as e:
+                    record(suite, "camera_session", size, 0, error=str(e))
+            continue
+
+        try:
+            cases = suite_cases(suite, entries)
+        except Exception as e:  # dipendenze opzionali mancanti
+            record(suite, "-", sizes[0], 0, error=f"{type(e).__name__}: {e}")
+            continue
+        for case, fn in cases:
+            for threads in thread_counts:
+                set_threads(threads)
+                for size in sizes:
+                    frames = dataset_frames(size, args.warmup + args.repeats)
+                    try:
+                        values = summarize(time_frames(fn, frames, args.repeats, args.warmup))
+                    except Exception as e:
+                        record(suite, case, size, threads, error=str(e))
+                        continue
+                    if not args.no_cold and suite != "heatmap":
+                        values["cold_start_s"] = cold_start(suite, case, size, threads)
+                    record(suite, case, size, threads, **values)
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"bench_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    settings = {key: value for key, value in vars(args).items() if key not in ("command", "handler")}
+    output.write_text(json.dumps({"environment": _environment(), "settings": settings, "results": results}, indent=2))
+    print(f"\n📋 Risultati in {output}")
+    return output
+
+
+def compare(args) -> int:
+    '''Confronta due file di risultati; restituisce 1 se almeno un caso è peggiorato oltre la tolleranza.'''
+    def load(path):
+        data = json.loads(Path(path).read_text())
+        return data, {(row["suite"], row["case"], row["size"], row["threads"]): row for row in data["results"] if "error" not in row}
+
+    base_data, base = load(args.base)
+    new_data, new = load(args.new)
+    if base_data["environment"].get("processor") != new_data["environment"].get("processor"):
+        print("⚠️ I due file vengono da CPU diverse: il confronto è indicativo")
+
+    regressions = 0
+    print(f"{'suite':<9} {'case':<28} {'size':>10} {'thr':>3} {'metrica':<9} {'base':>9} {'nuovo':>9} {'delta':>8}")
+    for key in sorted(base.keys() & new.keys()):
+        for metric, direction in COMPARED_METRICS.items():
+            old_value, new_value = base[key].get(metric), new[key].get(metric)
+            if not old_value or new_value is None:
+                continue
+            delta = (new_value - old_value) / old_value
+            regressed = delta * direction > args.tolerance
+            regressions += regressed
+            if regressed or args.verbose:
+                flag = "  ⛔ regressione" if regressed else ""
+                print(f"{key[0]:<9} {key[1]:<28} {key[2]:>10} {key[3]:>3} {metric:<9} {old_value:>9.2f} {new_value:>9.2f} {delta:>+8.1%}{flag}")
+    for key in sorted(base.keys() - new.keys()):
+        print(f"{key[0]:<9} {key[1]:<28} {key[2]:>10} {key[3]:>3} assente nel nuovo file")
+
+    print(f"\n{regressions} regressioni oltre il {args.tolerance:.0%} su {len(base.keys() & new.keys())} casi confrontati")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="esegue le suite e scrive il JSON dei risultati")
+    run_parser.add_argument("--suites", default=",".join(SUITES))
+    run_parser.add_argument("--sizes", default="640x480,1280x720,1920x1080", help="risoluzioni dei frame LxA")
+    run_parser.add_argument("--threads", default="1,4", help="thread torch/OpenCV da provare")
+    run_parser.add_argument("--entries", help="entry Anomalib separate da virgola (default: quelle abilitate)")
+    run_parser.add_argument("--repeats", type=int, default=20)
+    run_parser.add_argument("--warmup", type=int, default=3)
+    run_parser.add_argument("--capture-fps", type=float, default=30.0, help="frame rate della camera sintetica (suite capture)")
+    run_parser.add_argument("--no-cold", action="store_true", help="salta la misura del cold start")
+    run_parser.add_argument("--output", help="file JSON (default: results/benchmarks/bench_<timestamp>.json)")
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser("compare", help="confronta due file di risultati")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--tolerance", type=float, default=0.10, help="peggioramento relativo ammesso")
+    compare_parser.add_argument("--verbose", action="store_true", help="mostra anche i casi non peggiorati")
+    compare_parser.set_defaults(handler=compare)
+
+    probe_parser = commands.add_parser("probe", help=argparse.SUPPRESS)
+    probe_parser.add_argument("--suite", required=True)
+    probe_parser.add_argument("--case", required=True)
+    probe_parser.add_argument("--size", required=True)
+    probe_parser.add_argument("--threads", type=int, default=1)
+    probe_parser.set_defaults(handler=probe)
+
+    args = parser.parse_args()
+    status = args.handler(args)
+    if args.command == "compare":
+        sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,199 @@
 import cv2
+import os
+import threading
 import time
+from collections import deque
 from pathlib import Path
-from utils.logger import get_logger
-import uuid
+from utils.logger import PER_FRAME, get_logger
 from utils.paths import DATA_DIR
+from utils.frames import Frame
+from utils.storage import image_writer
+from utils.metrics import span
 
 logger = get_logger('camera')
 
-def capture_image():
-    filename = uuid.uuid4().hex + ".jpg"  # Genera un nome unico per l'immagine
-    save_path = Path(DATA_DIR) / 'images' / filename  # Percorso dove salvare l'immagine
-    save_path.parent.mkdir(parents=True, exist_ok=True)  # Crea la cartella se non esiste
-    
-    cap = cv2.VideoCapture(0)  # Usa la webcam predefinita
-    
-    if not cap.isOpened():
-        logger.error("❌ Unable to access the camera")
-        return None
-    
-    ret, frame = cap.read() # Legge un frame dalla webcam
-    
-    if not ret:
+# Salva su disco (in background) ogni scatto acquisito
+SAVE_CAPTURES = os.getenv("SAVE_CAPTURES", "true").lower() == "true"
+
+
+class CameraSession:
+    '''Sessione di acquisizione persistente con un thread che legge in continuo.
+
+    Il device viene aperto una sola volta; il thread di grab riempie un piccolo
+    ring buffer così che chi chiede un frame riceve subito il più recente,
+    senza pagare apertura del device e warmup dell'esposizione.
+    '''
+
+    def __init__(self, source: int | str = 0, buffer_size: int = 4, reconnect_after: int = 30):
+        self.source = source
+        self.buffer_size = buffer_size
+        self.reconnect_after = reconnect_after  # letture fallite consecutive prima di riaprire
+
+        self._buffer: deque = deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+        self._cap = None
+        self._thread: threading.Thread | None = None
+        self._running = False
+
+        self._frames_grabbed = 0
+        self._read_failures = 0
+        self._consecutive_failures = 0
+        self._reconnects = 0
+        self._started_at: float | None = None
+        self._fps = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._running and self._thread is not None and self._thread.is_alive()
+
+    def _open(self) -> bool:
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            cap.release()
+            return False
+        self._cap = cap
+        return True
+
+    def _release(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+    def start(self, timeout: float = 5.0) -> bool:
+        '''Apre il device e avvia il thread di grab; attende il primo frame.'''
+        with self._cond:
+            if self.running:
+                return True
+            if not self._open():
+                logger.error("❌ Unable to access the camera")
+                return False
+            self._running = True
+            self._started_at = time.time()
+            self._thread = threading.Thread(target=self._grab_loop, name="camera-grabber", daemon=True)
+            self._thread.start()
+
+        logger.info(f"🎥 Camera session started on source {self.source}")
+        if self.wait_for_frame(timeout=timeout) is None:
+            logger.warning("⚠️ Camera opened but no frame received yet.")
+        return True
+
+    def stop(self, timeout: float = 2.0):
+        '''Ferma il thread di grab e rilascia il device.'''
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+        self._thread = None
+        self._release()
+        self._buffer.clear()
+        logger.info("🛑 Camera session stopped")
+
+    def _grab_loop(self):
+        last_tick = time.perf_counter()
+        while self._running:
+            ret, frame = self._cap.read() if self._cap is not None else (False, None)
+            now = time.time()
+
+            if not ret:
+                self._read_failures += 1
+                self._consecutive_failures += 1
+                if self._consecutive_failures >= self.reconnect_after:
+                    logger.warning("⚠️ Too many failed reads, reopening the camera.")
+                    self._release()
+                    self._reconnects += 1
+                    self._consecutive_failures = 0
+                    if not self._open():
+                        time.sleep(0.5)
+                else:
+                    time.sleep(0.01)
+                continue
+
+            self._consecutive_failures = 0
+            tick = time.perf_counter()
+            # Media mobile esponenziale del frame rate effettivo
+            instant = 1.0 / max(tick - last_tick, 1e-6)
+            self._fps = instant if self._fps == 0 else 0.9 * self._fps + 0.1 * instant
+            last_tick = tick
+
+            with self._cond:
+                self._frames_grabbed += 1
+                self._buffer.append((self._frames_grabbed, now, frame))
+                self._cond.notify_all()
+
+        self._release()
+
+    def latest(self):
+        '''Restituisce (indice, timestamp, frame) più recente o None.'''
+        with self._cond:
+            return self._buffer[-1] if self._buffer else None
+
+    def wait_for_frame(self, newer_than: int = 0, timeout: float = 1.0):
+        '''Attende un frame con indice maggiore di `newer_than`.'''
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._running:
+                if self._buffer and self._buffer[-1][0] > newer_than:
+                    return self._buffer[-1]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return None
+
+    def read(self, timeout: float = 1.0):
+        '''(indice, timestamp, frame) più recente, avviando la sessione se necessario.'''
+        if not self.running and not self.start():
+            return None
+        return self.latest() or self.wait_for_frame(timeout=timeout)
+
+    def health(self) -> dict:
+        '''Stato della sessione per diagnostica.'''
+        latest = self.latest()
+        return {
+            "source": self.source,
+            "running": self.running,
+            "opened": self._cap is not None and self._cap.isOpened(),
+            "fps": round(self._fps, 2),
+            "frames_grabbed": self._frames_grabbed,
+            "read_failures": self._read_failures,
+            "reconnects": self._reconnects,
+            "buffered_frames": len(self._buffer),
+            "last_frame_age_ms": round((time.time() - latest[1]) * 1000, 1) if latest else None,
+            "uptime_s": round(time.time() - self._started_at, 1) if self._started_at and self.running else 0,
+        }
+
+
+def _camera_source() -> int | str:
+    source = os.getenv("CAMERA_SOURCE", "0")
+    return int(source) if source.isdigit() else source
+
+
+# Sessione condivisa da tutto il processo
+camera_session = CameraSession(
+    source=_camera_source(),
+    buffer_size=int(os.getenv("CAMERA_BUFFER_SIZE", "4")),
+)
+
+
+def capture_frame() -> Frame | None:
+    '''Restituisce il frame più recente della sessione, senza passare dal disco.'''
+    with span("capture"):
+        latest = camera_session.read()  # Frame più recente dalla sessione persistente
+
+    if latest is None:
         logger.error("❌ Failed to capture image")
-        cap.release()
         return None
-    
-    # Salva l'immagine catturata
-    cv2.imwrite(str(save_path), frame)
-    logger.info(f"✅ Image saved to {save_path}")
-    cap.release()  # Rilascia la webcam
-    return save_path
+
+    _, timestamp, image = latest
+    frame = Frame(image=image, timestamp=timestamp, source=f"camera:{camera_session.source}")
+
+    # Archiviazione opzionale e asincrona dello scatto
+    if SAVE_CAPTURES:
+        save_path = Path(DATA_DIR) / 'images' / f"{frame.frame_id}.jpg"
+        image_writer.submit(save_path, frame.image)
+
+    logger.info(f"✅ Frame {frame.frame_id} captured", extra=PER_FRAME)
+    return frame
@@ -0,0 +1,240 @@
+'''Cache su disco delle attivazioni del backbone, condivisa tra le run di training.
+
+Padim, Patchcore e gli altri modelli con backbone congelato ricalcolano a
+ogni run le stesse feature sulle stesse immagini. La cache le salva una volta
+in file raw memory-mappati, uno per layer:
+
+    datasets/.cache/features/<backbone>_<size>_<layer1-layer2...>_<dtype>/
+        index.json        hash immagine -> riga, forma delle righe per layer
+        <layer>.bin       righe [C, H, W] consecutive
+
+La chiave di ogni immagine è l'hash del tensore che entra nel backbone (dopo
+resize e normalizzazione), quindi trasformazioni diverse o augmentation
+producono semplicemente nuove righe. Più processi possono scrivere nella
+stessa cartella: le aggiunte sono serializzate da un lock su file.
+
+    python feature_cache.py             # elenco delle cache con righe e dimensione
+    python feature_cache.py --clear
+    python feature_cache.py --check     # la cache si installa su Padim e Patchcore (richiede anomalib)
+'''
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from utils.paths import DATASETS_DIR
+from utils.logger import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: niente lock, una sola run per cache alla volta
+    fcntl = None
+
+logger = get_logger('anomalib')
+
+FEATURE_CACHE_DIR = DATASETS_DIR / ".cache" / "features"
+
+
+def image_key(image) -> str:
+    '''Hash del tensore [C, H, W] così come entra nel backbone.'''
+    data = image.detach().cpu().contiguous().numpy()
+    return hashlib.blake2b(data.tobytes() + str(data.shape).encode(), digest_size=16).hexdigest()
+
+
+class FeatureCache:
+    '''Attivazioni per (backbone, layers, size) indicizzate per hash dell'immagine.'''
+
+    def __init__(self, backbone: str, layers: list[str], size: int, dtype: str = "float32", root: Path | None = None):
+        self.layers = list(layers)
+        self.dtype = np.dtype(dtype)
+        self.directory = (root or FEATURE_CACHE_DIR) / f"{backbone}_{size}_{'-'.join(self.layers)}_{self.dtype.name}"
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._index: dict[str, int] = {}
+        self._shapes: dict[str, tuple] = {}
+        self._rows = 0
+        self._maps: dict[str, np.memmap] = {}
+        self._reload()
+
+    def _layer_path(self, layer: str) -> Path:
+        return self.directory / f"{layer}.bin"
+
+    def _reload(self):
+        path = self.directory / "index.json"
+        if not path.exists():
+            return
+        state = json.loads(path.read_text())
+        self._index = state["index"]
+        self._shapes = {layer: tuple(shape) for layer, shape in state["shapes"].items()}
+        self._rows = state["rows"]
+
+    @contextmanager
+    def _locked(self):
+        with open(self.directory / ".lock", "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _memmap(self, layer: str) -> np.memmap:
+        mapped = self._maps.get(layer)
+        if mapped is None or len(mapped) < self._rows:
+            mapped = np.memmap(self._layer_path(layer), dtype=self.dtype, mode="r", shape=(self._rows, *self._shapes[layer]))
+            self._maps[layer] = mapped
+        return mapped
+
+    def lookup(self, keys: list[str]) -> list[int | None]:
+        rows = [self._index.get(key) for key in keys]
+        if any(row is None for row in rows):
+            # Un altro processo potrebbe averle già aggiunte
+            self._reload()
+            rows = [self._index.get(key) for key in keys]
+        return rows
+
+    def read(self, rows: list[int]) -> dict[str, np.ndarray]:
+        return {layer: np.asarray(self._memmap(layer)[rows]) for layer in self.layers}
+
+    def append(self, keys: list[str], features: dict):
+        '''Aggiunge le feature [N, C, H, W] delle immagini non ancora in cache.'''
+        with self._locked():
+            self._reload()
+            new = {}
+            for position, key in enumerate(keys):
+                if key not in self._index and key not in new:
+                    new[key] = position
+            if not new:
+                return
+            positions = list(new.values())
+            for layer in self.layers:
+                values = features[layer][positions].detach().cpu().numpy().astype(self.dtype)
+                shape = self._shapes.setdefault(layer, tuple(values.shape[1:]))
+                if tuple(values.shape[1:]) != shape:
+                    raise ValueError(f"Forma delle feature di {layer} cambiata: {values.shape[1:]} invece di {shape}")
+                path = self._layer_path(layer)
+                with open(path, "ab") as f:
+                    # Scarta eventuali righe scritte a metà da un processo interrotto
+                    f.truncate(self._rows * values[0].nbytes)
+                    f.write(values.tobytes())
+            for offset, key in enumerate(new):
+                self._index[key] = self._rows + offset
+            self._rows += len(new)
+
+            state = {"rows": self._rows, "shapes": self._shapes, "index": self._index}
+            temporary = self.directory / "index.json.tmp"
+            temporary.write_text(json.dumps(state))
+            os.replace(temporary, self.directory / "index.json")
+
+    def stats(self) -> dict:
+        return {"directory": str(self.directory), "rows": self._rows, "hits": self.hits, "misses": self.misses}
+
+
+def install_feature_cache(torch_model, size: int, dtype: str = "float32", root: Path | None = None) -> FeatureCache | None:
+    '''Fa leggere al feature extractor del modello le attivazioni dalla cache.
+
+    Sostituisce solo il forward dell'istanza, non il modulo: lo state_dict e
+    quindi il checkpoint restano identici a quelli di un training normale.
+    '''
+    import torch
+
+    extractor = getattr(torch_model, "feature_extractor", None)
+    backbone = getattr(extractor, "backbone", None)
+    layers = getattr(extractor, "layers", None)
+    if not isinstance(backbone, str) or not layers:
+        return None
+    if getattr(torch_model, "tiler", None) is not None:
+        return None
+    # TimmFeatureExtractor congela il backbone con il flag `requires_grad` e torch.no_grad(),
+    # non con requires_grad_(False): i parametri risultano comunque addestrabili
+    if getattr(extractor, "requires_grad", False):
+        logger.info(f"🔕 Backbone {backbone} addestrabile: feature cache non applicabile.")
+        return None
+
+    cache = FeatureCache(backbone, list(layers), size, dtype, root)
+    compute = extractor.forward
+
+    def cached_forward(images: torch.Tensor) -> dict:
+        keys = [image_key(image) for image in images]
+        rows = cache.lookup(keys)
+        missing = [position for position, row in enumerate(rows) if row is None]
+        cache.hits += len(keys) - len(missing)
+        cache.misses += len(missing)
+        if missing:
+            with torch.no_grad():
+                cache.append([keys[position] for position in missing], compute(images[missing]))
+            rows = cache.lookup(keys)
+        # Anche le feature appena calcolate passano dalla cache: tutte le run vedono gli stessi valori
+        return {
+            layer: torch.from_numpy(values).to(device=images.device, dtype=torch.float32)
+            for layer, values in cache.read(rows).items()
+        }
+
+    extractor.forward = cached_forward
+    logger.info(f"💾 Feature cache {cache.directory.name}: {cache.stats()['rows']} immagini già presenti")
+    return cache
+
+
+def check_install(size: int = 64) -> bool:
+    '''Installa la cache su Padim e Patchcore appena costruiti e verifica miss e poi hit sulle stesse immagini.'''
+    import tempfile
+
+    import torch
+    from anomalib.models.image.padim.torch_model import PadimModel
+    from anomalib.models.image.patchcore.torch_model import PatchcoreModel
+
+    models = {
+        "Padim": lambda: PadimModel(layers=["layer1", "layer2", "layer3"], backbone="resnet18", pre_trained=False),
+        "Patchcore": lambda: PatchcoreModel(layers=["layer2", "layer3"], backbone="wide_resnet50_2", pre_trained=False),
+    }
+    images = torch.rand(2, 3, size, size)
+    ok = True
+    with tempfile.TemporaryDirectory() as root:
+        for name, build in models.items():
+            model = build()
+            cache = install_feature_cache(model, size, root=Path(root))
+            if cache is None:
+                logger.error(f"❌ {name}: feature cache non installata")
+                ok = False
+                continue
+            model.feature_extractor(images)
+            model.feature_extractor(images)
+            if (cache.misses, cache.hits) != (2, 2):
+                logger.error(f"❌ {name}: attesi 2 miss e 2 hit, trovati {cache.misses} miss e {cache.hits} hit")
+                ok = False
+                continue
+            logger.info(f"✅ {name}: feature cache installata ({cache.misses} miss, {cache.hits} hit)")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clear", action="store_true", help="elimina tutte le cache delle feature")
+    parser.add_argument("--check", action="store_true", help="verifica che la cache si installi su Padim e Patchcore")
+    args = parser.parse_args()
+
+    if args.check:
+        raise SystemExit(0 if check_install() else 1)
+    if args.clear:
+        shutil.rmtree(FEATURE_CACHE_DIR, ignore_errors=True)
+        logger.info(f"🗑️  Feature cache eliminata: {FEATURE_CACHE_DIR}")
+        return
+
+    directories = sorted(path for path in FEATURE_CACHE_DIR.glob("*") if path.is_dir()) if FEATURE_CACHE_DIR.exists() else []
+    print(f"{'cache':<60} {'righe':>7} {'MB':>9}")
+    for directory in directories:
+        index = directory / "index.json"
+        rows = json.loads(index.read_text())["rows"] if index.exists() else 0
+        size = sum(path.stat().st_size for path in directory.glob("*.bin"))
+        print(f"{directory.name:<60} {rows:>7} {size / 1024 ** 2:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+'''Configurazione gunicorn: worker HTTP leggeri + un unico processo di inferenza.
+
+    cd backend && gunicorn -c gunicorn.conf.py wsgi:app
+
+Il master avvia inference_server.py (salvo INFERENCE_SPAWN=false, se il
+processo è gestito a parte, es. da systemd) e lo termina all'uscita. Ogni
+processo scrive i propri file di log (LOG_FILE_SUFFIX, vedi utils/logger.py):
+logs/<logger>.inference.log per il server, logs/<logger>.web-<pid>.log per i worker.
+'''
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_WORKERS", "4"))
+# Thread per worker: le richieste attendono l'IPC, non la CPU
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "8"))
+timeout = int(float(os.getenv("INFERENCE_TIMEOUT_S", "120"))) + 30
+
+_inference_process: subprocess.Popen | None = None
+
+
+def _inference_ready(address: str, timeout_s: float) -> bool:
+    '''Una richiesta camera_health sul canale del server, con zmq e un contesto usa e getta.
+
+    Il master non importa i moduli del progetto (logger, servizio, client): il
+    loro stato, thread del logger e contesto ZMQ compresi, verrebbe ereditato
+    dai worker al fork senza funzionare.
+    '''
+    import zmq
+
+    context = zmq.Context()
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    try:
+        socket.connect(address)
+        socket.send_json({"op": "camera_health", "kwargs": {}})
+        if not socket.poll(int(1000 * timeout_s), zmq.POLLIN):
+            return False
+        return json.loads(socket.recv_multipart()[0]).get("ok", False)
+    finally:
+        socket.close(linger=0)
+        context.term()
+
+
+def on_starting(server):
+    global _inference_process
+    if os.getenv("INFERENCE_SPAWN", "true").lower() != "true":
+        return
+
+    backend_dir = Path(__file__).resolve().parent
+    _inference_process = subprocess.Popen(
+        [sys.executable, str(backend_dir / "inference_server.py")],
+        cwd=backend_dir,
+        env={**os.environ, "LOG_FILE_SUFFIX": "inference"},
+    )
+
+    # Attende che il server risponda prima di accettare richieste HTTP (indirizzo come in inference_server.py)
+    address = os.getenv("INFERENCE_ADDRESS", "").strip() or "ipc:///tmp/visioncheck-inference.sock"
+    deadline = time.monotonic() + float(os.getenv("INFERENCE_START_TIMEOUT_S", "60"))
+    while time.monotonic() < deadline:
+        if _inference_process.poll() is not None:
+            raise RuntimeError(f"Inference server exited with code {_inference_process.returncode}")
+        if _inference_ready(address, timeout_s=1):
+            server.log.info(f"Inference server ready (pid {_inference_process.pid})")
+            return
+    raise RuntimeError("Inference server did not start in time")
+
+
+def post_fork(server, worker):
+    # Prima che il worker importi l'app (e quindi utils/logger.py)
+    os.environ["LOG_FILE_SUFFIX"] = f"web-{worker.pid}"
+
+
+def on_exit(server):
+    if _inference_process is not None and _inference_process.poll() is None:
+        _inference_process.terminate()
+        try:
+            _inference_process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            _inference_process.kill()
@@ -0,0 +1,70 @@
+import cv2
+import numpy as np
+
+# Colormap personalizzata (viola → magenta → arancio), stop in RGB
+COLOR_STOPS = [
+    (0.0, (0.45, 0.0, 0.5)),    # viola
+    (0.3, (0.8, 0.2, 0.6)),     # magenta
+    (0.6, (1.0, 0.7, 0.3)),     # arancio chiaro
+    (1.0, (1.0, 0.4, 0.0)),     # arancio intenso
+]
+
+CONTOUR_COLOR = (0, 100, 255)  # arancione in BGR
+
+
+def build_colormap_lut(stops=COLOR_STOPS) -> np.ndarray:
+    '''LUT 256x1x3 (BGR, uint8) equivalente a una LinearSegmentedColormap a 256 livelli.'''
+    positions = np.array([position for position, _ in stops])
+    rgb = np.array([color for _, color in stops])
+    levels = np.linspace(0.0, 1.0, 256)
+    channels = [np.interp(levels, positions, rgb[:, channel]) for channel in (2, 1, 0)]  # RGB → BGR
+    lut = np.stack(channels, axis=-1) * 255.0
+    return np.clip(np.rint(lut), 0, 255).astype(np.uint8).reshape(256, 1, 3)
+
+
+# Calcolata una sola volta all'import
+COLORMAP_LUT = build_colormap_lut()
+
+
+def _scale_contours(contours, scale_x: float, scale_y: float) -> list[np.ndarray]:
+    if scale_x == 1.0 and scale_y == 1.0:
+        return list(contours)
+    scale = np.array([scale_x, scale_y], dtype=np.float32)
+    return [np.rint(contour.astype(np.float32) * scale).astype(np.int32) for contour in contours]
+
+
+def color_anomaly_map(anomaly_map: np.ndarray, image: np.ndarray | None = None, percentile: float = 90.0) -> np.ndarray:
+    """Colora l'anomaly map con una colormap personalizzata (viola → magenta → arancione) + contorni arancioni.
+
+    La mappa può avere la risoluzione nativa del modello: normalizzazione, soglia
+    e contorni sono calcolati lì, e solo la mappa già quantizzata in uint8 viene
+    portata alla risoluzione dell'immagine. Restituisce un'immagine BGR.
+    """
+    anomaly_map = np.asarray(anomaly_map, dtype=np.float32)
+    map_h, map_w = anomaly_map.shape[:2]
+    out_h, out_w = (image.shape[0], image.shape[1]) if image is not None else (map_h, map_w)
+
+    # Normalizzazione della anomaly map (a risoluzione nativa) in 0..255
+    norm_map = cv2.normalize(anomaly_map, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    if (map_h, map_w) != (out_h, out_w):
+        norm_map = cv2.resize(norm_map, (out_w, out_h), interpolation=cv2.INTER_LINEAR)
+
+    colored = cv2.LUT(cv2.cvtColor(norm_map, cv2.COLOR_GRAY2BGR), COLORMAP_LUT)
+
+    # Se l'immagine di input è disponibile, facciamo l'overlay
+    if image is not None:
+        overlay = cv2.addWeighted(image, 0.6, colored, 0.4, 0)  # maggiore saturazione per un overlay più visibile
+    else:
+        overlay = colored
+
+    # Soglia dinamica (90° percentile) e contorni calcolati sulla mappa nativa, poi riscalati
+    threshold = np.percentile(anomaly_map, percentile)
+    binary_mask = (anomaly_map > threshold).astype(np.uint8)
+    contours, _ = cv2.findContours(binary_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    contours = _scale_contours(contours, out_w / map_w, out_h / map_h)
+
+    # Disegna contorni arancioni spessi
+    thickness = max(2, int(out_h / 100))
+    cv2.drawContours(overlay, contours, -1, CONTOUR_COLOR, thickness)
+
+    return overlay
@@ -0,0 +1,328 @@
+'''Processo di inferenza condiviso dai worker HTTP di produzione.
+
+Camera e modelli vengono caricati una sola volta qui; i worker (gunicorn,
+vedi wsgi.py) inoltrano ogni operazione via ZMQ su un canale locale.
+
+    python inference_server.py          # INFERENCE_ADDRESS, INFERENCE_THREADS da .env
+
+Protocollo: la richiesta è un JSON {"op", "kwargs", "context"} (context: id per i
+log, vedi utils/logger.py); la risposta è un JSON
+{"ok", "result" | "error", "status", "details"} seguito, per gli snapshot,
+da un secondo frame con i byte JPEG (niente pickle sul canale).
+
+Anteprima e ispezione continua non passano dal canale richiesta/risposta: il
+server pubblica ogni frame ed esito una volta sola su un socket PUB
+(INFERENCE_STREAM_ADDRESS) come [nome, JSON {"seq", "active", "json"}, dati];
+ogni worker HTTP lo riceve con un solo SUB e lo ridistribuisce ai propri
+spettatori (StreamRelay). Ogni secondo arriva anche un messaggio senza dati
+con lo stato degli stream.
+'''
+import json
+import os
+import queue
+import signal
+import threading
+import time
+
+import zmq
+from dotenv import load_dotenv
+
+# Prima degli import del progetto: camera e batcher leggono la configurazione all'import
+load_dotenv()
+
+from utils.logger import current_log_context, get_logger, log_context
+from utils.lazy import warm_from_env
+from inference_service import InferenceService, ServiceError
+from streaming import LatestStream
+
+logger = get_logger()
+
+# ipc:// usa un socket Unix (permessi del filesystem); su Windows usare tcp://127.0.0.1:<porta>
+DEFAULT_ADDRESS = "ipc:///tmp/visioncheck-inference.sock"
+DEFAULT_STREAM_ADDRESS = "ipc:///tmp/visioncheck-stream.sock"
+
+
+def inference_address() -> str:
+    return os.getenv("INFERENCE_ADDRESS", "").strip() or DEFAULT_ADDRESS
+
+
+def stream_address() -> str:
+    return os.getenv("INFERENCE_STREAM_ADDRESS", "").strip() or DEFAULT_STREAM_ADDRESS
+
+
+def _dumps(payload: dict) -> bytes:
+    return json.dumps(payload).encode()
+
+
+def _encode_reply(result) -> list[bytes]:
+    '''Separa i byte JPEG dal resto del risultato, che viaggia come JSON.'''
+    if isinstance(result, dict) and isinstance(result.get("jpeg"), (bytes, bytearray)):
+        header = {"ok": True, "result": {key: value for key, value in result.items() if key != "jpeg"}, "jpeg": True}
+        return [_dumps(header), bytes(result["jpeg"])]
+    return [_dumps({"ok": True, "result": result})]
+
+
+def _decode_reply(parts: list[bytes]):
+    header = json.loads(parts[0])
+    if not header["ok"]:
+        raise ServiceError(header["error"], header.get("status", 500), header.get("details"))
+    result = header["result"]
+    if header.get("jpeg"):
+        result["jpeg"] = parts[1]
+    return result
+
+
+def _encode_stream(name: str, seq: int | None, value, active: bool) -> list[bytes]:
+    header = {"seq": seq, "active": active, "json": not isinstance(value, (bytes, bytearray))}
+    parts = [name.encode(), _dumps(header)]
+    if value is not None:
+        parts.append(bytes(value) if not header["json"] else _dumps(value))
+    return parts
+
+
+class InferenceServer:
+    '''ROUTER sul canale esterno, DEALER interno e un pool di thread REP che servono le operazioni.
+
+    Più thread permettono ai batcher del servizio di raccogliere in un unico
+    forward le richieste che arrivano in parallelo dai diversi worker HTTP.
+    Gli stream vanno invece su un PUB a parte, senza occupare i thread REP.
+    '''
+
+    def __init__(self, service, address: str, threads: int = 8, publish_address: str | None = None):
+        self.service = service
+        self.address = address
+        self.publish_address = publish_address
+        self.threads = max(1, threads)
+        self.context = zmq.Context.instance()
+        self._backend_address = f"inproc://inference-workers-{id(self)}"
+
+    def _worker(self):
+        socket = self.context.socket(zmq.REP)
+        socket.connect(self._backend_address)
+        try:
+            while True:
+                request = socket.recv_json()
+                op = request.get("op", "")
+                try:
+                    # Request id del worker HTTP, per ritrovare la richiesta nei log di entrambi i processi
+                    with log_context(**(request.get("context") or {})):
+                        reply = _encode_reply(self.service.call(op, **(request.get("kwargs") or {})))
+                except ServiceError as e:
+                    reply = [_dumps(
+                        {"ok": False, "error": e.message, "status": e.status, "details": e.details}
+                    )]
+                except Exception as e:
+                    logger.exception(f"❌ Unable to serve {op}:")
+                    reply = [_dumps({"ok": False, "error": str(e), "status": 500})]
+                socket.send_multipart(reply)
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            socket.close(linger=0)
+
+    def _publisher(self):
+        '''Inoltra sul PUB ogni valore pubblicato dagli stream del servizio, più lo stato ogni secondo.'''
+        socket = self.context.socket(zmq.PUB)
+        # Uno spettatore lento perde frame invece di accumularli in memoria (latest-frame-wins)
+        socket.setsockopt(zmq.SNDHWM, 8)
+        socket.bind(self.publish_address)
+        streams = self.service.streams()
+        pending = queue.SimpleQueue()
+        for name, stream in streams.items():
+            stream.subscribe(lambda seq, value, name=name: pending.put((name, seq, value)))
+
+        next_status = 0.0
+        try:
+            while True:
+                try:
+                    name, seq, value = pending.get(timeout=0.5)
+                    socket.send_multipart(_encode_stream(name, seq, value, self.service.stream_active(name)))
+                except queue.Empty:
+                    pass
+                if time.monotonic() >= next_status:
+                    next_status = time.monotonic() + 1.0
+                    for name, stream in streams.items():
+                        socket.send_multipart(_encode_stream(name, stream.seq, None, self.service.stream_active(name)))
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            socket.close(linger=0)
+
+    def serve_forever(self):
+        '''Blocca finché il contesto ZMQ non viene terminato (vedi stop()).'''
+        frontend = self.context.socket(zmq.ROUTER)
+        backend = self.context.socket(zmq.DEALER)
+        frontend.bind(self.address)
+        backend.bind(self._backend_address)
+
+        for index in range(self.threads):
+            threading.Thread(target=self._worker, name=f"inference-{index}", daemon=True).start()
+        if self.publish_address:
+            threading.Thread(target=self._publisher, name="inference-publisher", daemon=True).start()
+
+        logger.info(
+            f"✅ Inference server listening on {self.address} ({self.threads} threads), streams on {self.publish_address}"
+        )
+        try:
+            zmq.proxy(frontend, backend)
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            frontend.close(linger=0)
+            backend.close(linger=0)
+            logger.info("🛑 Inference server stopped")
+
+    def stop(self):
+        self.context.term()
+
+
+class StreamRelay:
+    '''Lato worker HTTP: un thread SUB riceve gli stream del server e li ripubblica su LatestStream locali.
+
+    Ogni frame attraversa l'IPC una volta per worker, non per spettatore, e
+    gli spettatori attendono nel proprio thread HTTP senza occupare il server.
+    L'encoder di anteprima resta attivo finché il worker lo tiene in vita con
+    stream_keepalive (al più una chiamata ogni `keepalive_s`).
+    '''
+
+    # Oltre questo intervallo senza stato dal server lo si chiede con una chiamata
+    STATUS_MAX_AGE_S = 3.0
+
+    def __init__(self, client: "InferenceClient", address: str, keepalive_s: float = 2.0):
+        self.client = client
+        self.address = address
+        self.keepalive_s = keepalive_s
+        self.streams = {name: LatestStream() for name in InferenceService.STREAMS}
+        self._active: dict[str, bool] = {}
+        self._status_at: dict[str, float] = {}
+        self._last_keepalive = 0.0
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="stream-relay", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        socket = self.client.context.socket(zmq.SUB)
+        socket.setsockopt(zmq.RCVHWM, 8)
+        socket.setsockopt(zmq.SUBSCRIBE, b"")
+        socket.connect(self.address)
+        try:
+            while True:
+                name, header, *data = socket.recv_multipart()
+                name = name.decode()
+                if name not in self.streams:
+                    continue
+                header = json.loads(header)
+                self._active[name] = header["active"]
+                self._status_at[name] = time.monotonic()
+                if data:
+                    self.streams[name].publish(json.loads(data[0]) if header["json"] else data[0])
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            socket.close(linger=0)
+
+    def _keepalive(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_keepalive < self.keepalive_s:
+                return
+            self._last_keepalive = now
+        try:
+            self.client.call("stream_keepalive", timeout_s=5)
+        except ServiceError:
+            self._last_keepalive = 0.0
+            raise
+
+    def _inspection_running(self, name: str) -> bool:
+        if time.monotonic() - self._status_at.get(name, 0.0) > self.STATUS_MAX_AGE_S:
+            # Relay appena avviato o server muto: lo stato si chiede esplicitamente
+            self._active[name] = self.client.call("inspection_status", timeout_s=5)["running"]
+            self._status_at[name] = time.monotonic()
+        return self._active[name]
+
+    def watch(self, name: str, after: int = 0, timeout: float = 2.0) -> tuple | None:
+        '''Stesso contratto di InferenceService.watch(), servito dai LatestStream del worker.'''
+        self._ensure_started()
+        if name == "preview":
+            self._keepalive()
+        elif not self._inspection_running(name):
+            raise ServiceError("Inspection not running", 409)
+        return self.streams[name].wait(after, timeout)
+
+
+class InferenceClient:
+    '''Lato worker HTTP: stessa interfaccia call()/watch() di InferenceService, eseguita nel processo di inferenza.
+
+    Ogni thread usa il proprio socket REQ; in caso di timeout il socket viene
+    scartato (un REQ senza risposta non può più inviare) e ricreato alla
+    chiamata successiva. Gli stream arrivano dal PUB del server (StreamRelay).
+    '''
+
+    def __init__(self, address: str, timeout_s: float = 120.0, publish_address: str | None = None):
+        self.address = address
+        self.timeout_s = timeout_s
+        self.context = zmq.Context.instance()
+        self._local = threading.local()
+        self.relay = StreamRelay(self, publish_address or stream_address())
+
+    def _socket(self):
+        socket = getattr(self._local, "socket", None)
+        if socket is None:
+            socket = self.context.socket(zmq.REQ)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(self.address)
+            self._local.socket = socket
+        return socket
+
+    def _discard_socket(self):
+        socket = getattr(self._local, "socket", None)
+        if socket is not None:
+            socket.close(linger=0)
+            self._local.socket = None
+
+    def call(self, op: str, timeout_s: float | None = None, **kwargs):
+        socket = self._socket()
+        socket.send_json({"op": op, "kwargs": kwargs, "context": current_log_context()})
+        if not socket.poll(int(1000 * (timeout_s or self.timeout_s)), zmq.POLLIN):
+            self._discard_socket()
+            logger.error(f"❌ Inference server did not answer {op} in time ({self.address})")
+            raise ServiceError("Inference server unavailable", 503)
+        return _decode_reply(socket.recv_multipart())
+
+    def watch(self, name: str, after: int = 0, timeout: float = 2.0) -> tuple | None:
+        return self.relay.watch(name, after, timeout)
+
+
+def main():
+    service = InferenceService()
+    server = InferenceServer(
+        service,
+        address=inference_address(),
+        threads=int(os.getenv("INFERENCE_THREADS", "8")),
+        publish_address=stream_address(),
+    )
+
+    def shutdown(signum, _frame):
+        logger.info(f"🛑 Received signal {signum}, shutting down inference server")
+        # term() attende la chiusura dei socket del proxy, che gira proprio nel thread principale
+        threading.Thread(target=server.stop, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # I modelli si caricano una volta sola, qui, e non in ogni worker HTTP
+    warm_from_env()
+
+    try:
+        server.serve_forever()
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+from typing import Any
+
+from utils.logger import PER_FRAME, frame_id_var, get_logger, log_context
+from utils.frames import Frame, encode_jpeg
+from utils.storage import image_writer
+from utils.lazy import READY, readiness, register_lazy, warm_in_background
+from utils import metrics
+
+from camera import capture_frame, camera_session
+from yolo import run_yolo_batch
+from sam import run_sam, run_sam_prompt, embedding_cache
+from yolo_sam import run_yolo_sam
+
+from batching import BatcherOverloaded, batcher_from_env
+from anomalib_config import config_store
+from streaming import preview_encoder
+from inspection import inspection_from_env
+
+logger = get_logger()
+
+
+class ServiceError(Exception):
+    '''Errore di un'operazione di inferenza, con lo status HTTP da restituire al client.'''
+
+    def __init__(self, message: str, status: int = 500, details: dict | None = None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.details = details or {}
+
+
+def _load_anomalib_runtime():
+    '''Importa torch/anomalib e carica i modelli abilitati solo quando servono.'''
+    import anomalib_runner
+    anomalib_runner.warm_enabled_models()
+    return anomalib_runner
+
+anomalib_runtime = register_lazy("anomalib", _load_anomalib_runtime)
+
+
+def _analyze_anomalib(items: list) -> list:
+    runtime = anomalib_runtime.get()
+    if runtime is None:
+        raise RuntimeError("Anomalib runtime not available")
+    return runtime.analyze_anomalib_batch([frame for frame, _ in items], [overlay for _, overlay in items])
+
+
+def _detect_yolo(items: list) -> list:
+    return run_yolo_batch([frame for frame, _ in items], [raw for _, raw in items])
+
+
+def _snapshot(frame: Frame, jpeg: bytes) -> dict:
+    return {"frame_id": frame.frame_id, "timestamp": frame.timestamp, "jpeg": jpeg}
+
+
+class InferenceService:
+    '''Camera, modelli e batcher del processo, esposti come operazioni con risultati serializzabili.
+
+    Con il server di sviluppo l'app chiama il servizio direttamente; in
+    produzione vive in un unico processo (inference_server.py) e i worker
+    HTTP lo raggiungono via IPC, senza duplicare i pesi dei modelli.
+    '''
+
+    # Operazioni invocabili tramite call()
+    OPERATIONS = (
+        "ready", "preview", "yolo", "sam", "yolo_sam", "sam_prompt",
+        "anomalib_snapshot", "anomalib_scores", "sam_cache", "storage_metrics",
+        "batching_metrics", "camera_start", "camera_stop", "camera_health", "warmup",
+        "stream_keepalive", "stream_metrics", "inspection_start", "inspection_stop",
+        "inspection_status", "metrics", "record_metrics", "anomalib_config",
+    )
+
+    # Stream condivisi (vedi watch()): non passano da call(), in produzione li pubblica il server via ZMQ PUB
+    STREAMS = ("preview", "inspection_frames", "inspection_events")
+
+    def __init__(self):
+        # Memorizza l'ultimo scatto per consentire anteprima e inferenze coerenti
+        self.last_frame: Frame | None = None
+        # Le richieste concorrenti vengono raccolte in batch per modello
+        self.yolo_batcher = batcher_from_env("yolo", _detect_yolo)
+        self.anomalib_batcher = batcher_from_env("anomalib", _analyze_anomalib)
+        # Ispezione continua sulla stessa sessione camera, con gli stessi batcher delle richieste
+        self.inspection = inspection_from_env(camera_session, self.yolo_batcher, self.anomalib_batcher)
+
+    def call(self, op: str, timeout_s: float | None = None, **kwargs) -> Any:
+        '''Esegue un'operazione per nome; ogni errore diventa un ServiceError.
+
+        `timeout_s` serve solo al client IPC: in locale la chiamata è diretta.
+        Con METRICS_TIMING_HEADERS gli snapshot JPEG riportano in `timings` gli
+        span misurati durante l'operazione.
+        '''
+        if op not in self.OPERATIONS:
+            raise ServiceError(f"Unknown operation: {op}", 404)
+        try:
+            with log_context(), metrics.trace() as timings:
+                result = getattr(self, op)(**kwargs)
+            if timings and isinstance(result, dict) and "jpeg" in result:
+                result["timings"] = timings
+            return result
+        except ServiceError:
+            raise
+        except Exception as e:
+            logger.exception(f"❌ {op} error:")
+            raise ServiceError(str(e)) from e
+
+    def close(self):
+        self.inspection.stop()
+        camera_session.stop()
+        self.yolo_batcher.stop()
+        self.anomalib_batcher.stop()
+        image_writer.flush()
+
+    def _capture_and_store_frame(self) -> Frame | None:
+        '''Effettua uno scatto e aggiorna il riferimento all'ultimo frame.'''
+        frame = capture_frame()
+        if frame is not None:
+            self.last_frame = frame
+            frame_id_var.set(frame.frame_id)
+        return frame
+
+    def _get_frame(self, prefer_last: bool, label: str) -> Frame:
+        '''Restituisce il frame da usare per l'inferenza.
+
+        Se `prefer_last` è True prova ad usare l'ultimo scatto memorizzato,
+        altrimenti ne effettua uno nuovo.
+        '''
+        last_frame = self.last_frame
+        if prefer_last and last_frame is not None:
+            frame_id_var.set(last_frame.frame_id)
+            logger.info(f"♻️  Using cached preview frame: {last_frame.frame_id}", extra=PER_FRAME)
+            return last_frame
+
+        if prefer_last:
+            logger.warning("⚠️ No cached preview available, capturing a fresh frame.")
+
+        frame = self._capture_and_store_frame()
+        if frame is None:
+            logger.error(f"❌ Unable to capture frame for {label}.")
+            raise ServiceError("Capture error")
+        return frame
+
+    def _submit(self, batcher, item, label: str):
+        try:
+            # Attesa in coda + forward batched, che gira nel thread del batcher
+            with metrics.span(f"{batcher.name}_batch"):
+                return batcher.submit(item)
+        except BatcherOverloaded:
+            logger.warning(f"⚠️ {label} queue full, rejecting request.")
+            raise ServiceError(f"{label} queue full", 503)
+
+    def ready(self) -> dict:
+        '''Stato di caricamento dei modelli.'''
+        models = readiness()
+        payload = {"ready": all(status["state"] == READY for status in models.values()), "models": models}
+        if anomalib_runtime.state == READY:
+            payload["anomalib_models"] = anomalib_runtime.get().model_registry.stats()
+        return payload
+
+    def warmup(self, names: list[str] | None = None) -> dict:
+        warm_in_background(names)
+        return readiness()
+
+    def preview(self) -> dict:
+        frame = self._capture_and_store_frame()
+        if frame is None:
+            logger.error("❌ Unable to capture preview.")
+            raise ServiceError("Preview capture failure")
+
+        with metrics.span("jpeg_encode", folder="preview"):
+            payload = encode_jpeg(frame.image)
+        if payload is None:
+            logger.error("❌ Unable to encode preview.")
+            raise ServiceError("JPEG encoding failure")
+
+        logger.info("✅ Preview ready, sending to frontend.", extra=PER_FRAME)
+        return _snapshot(frame, payload)
+
+    def yolo(self, use_last: bool = False) -> dict:
+        frame = self._get_frame(use_last, "YOLO")
+        prediction = self._submit(self.yolo_batcher, (frame, False), "YOLO")
+        if prediction is None:
+            logger.error("❌ YOLO inference failed.")
+            raise ServiceError("YOLO inference error")
+
+        logger.info("✅ YOLO snapshot ready, sending to frontend.", extra=PER_FRAME)
+        return _snapshot(frame, prediction.jpeg)
+
+    def sam(self, use_last: bool = False) -> dict:
+        frame = self._get_frame(use_last, "SAM")
+        prediction = run_sam(frame)
+        if prediction is None:
+            logger.error("❌ SAM segmentation failed.")
+            raise ServiceError("SAM inference error")
+
+        logger.info("✅ SAM snapshot ready, sending to frontend.", extra=PER_FRAME)
+        return _snapshot(frame, prediction.jpeg)
+
+    def yolo_sam(self, use_last: bool = False, conf: float | None = None) -> dict:
+        frame = self._get_frame(use_last, "YOLO+SAM")
+        prediction = run_yolo_sam(frame, conf=conf)
+        if prediction is None:
+            logger.error("❌ YOLO+SAM segmentation failed.")
+            raise ServiceError("YOLO+SAM inference error")
+
+        logger.info("✅ YOLO+SAM snapshot ready, sending to frontend.", extra=PER_FRAME)
+        return _snapshot(frame, prediction.jpeg)
+
+    def sam_prompt(self, points=None, labels=None, boxes=None, use_last: bool = True) -> dict:
+        '''Segmentazione SAM guidata da punti/box; riusa l'embedding del frame se già calcolato.'''
+        if not points and not boxes:
+            raise ServiceError("Provide 'points' and/or 'boxes'", 400)
+
+        frame = self._get_frame(use_last, "SAM")
+        prediction = run_sam_prompt(frame, points=points, point_labels=labels, boxes=boxes)
+        if prediction is None:
+            logger.error("❌ SAM prompt segmentation failed.")
+            raise ServiceError("SAM inference error")
+
+        logger.info("✅ SAM prompt segmentation ready, sending to frontend.", extra=PER_FRAME)
+        return _snapshot(frame, prediction.jpeg)
+
+    def anomalib_snapshot(self, use_last: bool = False) -> dict:
+        frame = self._get_frame(use_last, "Anomalib")
+        results = self._submit(self.anomalib_batcher, (frame, True), "Anomalib")
+
+        overlays = [result.overlay for result in results if result.overlay is not None]
+        if not overlays:
+            logger.error("❌ Anomalib inference failed.")
+            raise ServiceError("Anomalib inference error")
+
+        logger.info("✅ Anomalib snapshot ready, sending to frontend.", extra=PER_FRAME)
+        return _snapshot(frame, overlays[0].jpeg)
+
+    def anomalib_scores(self, use_last: bool = False, overlays: bool = False) -> dict:
+        '''Esito strutturato di tutti i modelli Anomalib attivi (score, label, statistiche).'''
+        frame = self._get_frame(use_last, "Anomalib")
+        results = self._submit(self.anomalib_batcher, (frame, overlays), "Anomalib")
+        if not results:
+            logger.error("❌ Anomalib inference failed.")
+            raise ServiceError("Anomalib inference error")
+
+        labels = [result.is_anomalous for result in results if result.is_anomalous is not None]
+        return {
+            "frame_id": frame.frame_id,
+            "timestamp": frame.timestamp,
+            "anomalous": any(labels) if labels else None,
+            "models": [
+                {**result.to_dict(), "overlay_name": result.overlay_path.name if result.overlay_path else None}
+                for result in results
+            ],
+        }
+
+    def streams(self) -> dict:
+        '''LatestStream per nome: anteprima codificata, overlay ed esiti dell'ispezione continua.'''
+        return {
+            "preview": preview_encoder.stream,
+            "inspection_frames": self.inspection.overlays,
+            "inspection_events": self.inspection.events,
+        }
+
+    def stream_active(self, name: str) -> bool:
+        return camera_session.running if name == "preview" else self.inspection.running
+
+    def stream_keepalive(self) -> dict:
+        '''Avvia l'encoder di anteprima o ne rinvia lo stop: i worker HTTP lo chiamano finché hanno spettatori.'''
+        if not preview_encoder.ensure_started():
+            raise ServiceError("Camera not available", 503)
+        return {"seq": preview_encoder.stream.seq}
+
+    def watch(self, name: str, after: int = 0, timeout: float = 2.0) -> tuple | None:
+        '''(seq, valore) più recente di `after` sullo stream `name`; None se non arriva nulla entro `timeout`.
+
+        Attende nel thread del chiamante: è il percorso del server di sviluppo,
+        con i worker di produzione lo stesso contratto è servito da StreamRelay.
+        '''
+        if name == "preview":
+            self.stream_keepalive()
+        elif not self.inspection.running:
+            raise ServiceError("Inspection not running", 409)
+        return self.streams()[name].wait(after, timeout)
+
+    def stream_metrics(self) -> dict:
+        return preview_encoder.metrics()
+
+    def inspection_start(self, pipeline: str = "anomalib", every_n: int = 1) -> dict:
+        try:
+            started = self.inspection.start(pipeline, every_n)
+        except ValueError as e:
+            raise ServiceError(str(e), 400)
+        if not started:
+            raise ServiceError("Camera start failure", details=camera_session.health())
+        return self.inspection.status()
+
+    def inspection_stop(self) -> dict:
+        self.inspection.stop()
+        return self.inspection.status()
+
+    def inspection_status(self) -> dict:
+        return self.inspection.status()
+
+    def anomalib_config(self, reload: bool = False) -> dict:
+        '''Report di validazione di anomalib_models.yaml; `reload` forza la rilettura del file.'''
+        store = config_store()
+        if reload:
+            store.reload(force=True)
+        return store.status()
+
+    def sam_cache(self) -> dict:
+        return embedding_cache.stats()
+
+    def storage_metrics(self) -> dict:
+        return image_writer.metrics()
+
+    def metrics(self) -> dict:
+        '''Istogrammi e contatori del processo di inferenza (vedi utils/metrics.py).'''
+        return metrics.snapshot()
+
+    def record_metrics(self, observations: list) -> dict:
+        '''Osservazioni inviate dai worker HTTP (latenza per rotta), registrate qui per un /metrics unico.'''
+        metrics.record(observations)
+        return {"recorded": len(observations)}
+
+    def batching_metrics(self) -> dict:
+        return {
+            "yolo": self.yolo_batcher.metrics(),
+            "anomalib": self.anomalib_batcher.metrics(),
+        }
+
+    def camera_start(self) -> dict:
+        if not camera_session.start():
+            logger.error("❌ Unable to start camera session.")
+            raise ServiceError("Camera start failure", details=camera_session.health())
+        return camera_session.health()
+
+    def camera_stop(self) -> dict:
+        camera_session.stop()
+        return camera_session.health()
+
+    def camera_health(self) -> dict:
+        return camera_session.health()
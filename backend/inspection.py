@@ -0,0 +1,235 @@
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+import numpy as np
+
+from utils.logger import get_logger, log_context
+from utils.frames import Frame, encode_jpeg
+from utils.storage import store_result
+
+from batching import BatcherOverloaded, MicroBatcher
+from camera import CameraSession
+from heatmap import color_anomaly_map
+from streaming import LatestStream, downscale
+
+logger = get_logger()
+
+PIPELINES = ("yolo", "anomalib", "both")
+
+# Fasi misurate per ogni frame ispezionato
+STAGES = ("queue", "yolo", "anomalib", "render", "encode", "end_to_end")
+
+
+class InspectionLoop:
+    '''Ispezione continua: un thread esegue la pipeline scelta su un frame ogni N della sessione camera.
+
+    Si lavora sempre sull'ultimo frame disponibile (latest-frame-wins): se
+    l'inferenza è più lenta della camera i frame intermedi vengono scartati e
+    contati, invece di accumulare ritardo. Overlay (MJPEG) ed esiti (eventi
+    JSON) vengono pubblicati su due LatestStream condivisi dagli spettatori.
+    I forward passano dai batcher del servizio, che serializzano l'accesso ai
+    modelli con le richieste HTTP concorrenti.
+    '''
+
+    def __init__(
+        self,
+        session: CameraSession,
+        yolo_batcher: MicroBatcher,
+        anomalib_batcher: MicroBatcher,
+        quality: int = 75,
+        width: int = 960,
+        window: int = 200,
+        save_defects: bool = False,
+    ):
+        self.session = session
+        self.yolo_batcher = yolo_batcher
+        self.anomalib_batcher = anomalib_batcher
+        self.quality = quality
+        self.width = width
+        self.save_defects = save_defects
+
+        self.overlays = LatestStream()
+        self.events = LatestStream()
+
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._running = False
+        self.pipeline: str | None = None
+        self.every_n = 1
+
+        self._latencies = {stage: deque(maxlen=window) for stage in STAGES}
+        self._completed: deque = deque(maxlen=window)  # istanti di fine elaborazione, per gli fps
+        self._counters = {"processed": 0, "dropped_stale": 0, "skipped_every_n": 0, "errors": 0, "anomalous": 0}
+        self._started_at: float | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._running and self._thread is not None and self._thread.is_alive()
+
+    def start(self, pipeline: str = "anomalib", every_n: int = 1) -> bool:
+        if pipeline not in PIPELINES:
+            raise ValueError(f"Unknown pipeline '{pipeline}', expected one of {', '.join(PIPELINES)}")
+        self.stop()
+        if not self.session.running and not self.session.start():
+            return False
+
+        with self._lock:
+            self.pipeline = pipeline
+            self.every_n = max(1, int(every_n))
+            for values in self._latencies.values():
+                values.clear()
+            self._completed.clear()
+            self._counters = dict.fromkeys(self._counters, 0)
+            self._started_at = time.time()
+            self._running = True
+            self._thread = threading.Thread(target=self._loop, name="inspection", daemon=True)
+            self._thread.start()
+
+        logger.info(f"🔍 Continuous inspection started: {pipeline}, every {self.every_n} frame(s)")
+        return True
+
+    def stop(self, timeout: float = 5.0):
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout=timeout)
+        logger.info("🛑 Continuous inspection stopped")
+
+    def _loop(self):
+        last_index = 0
+        last_processed = -self.every_n
+        while self._running:
+            latest = self.session.wait_for_frame(newer_than=last_index, timeout=1.0)
+            if latest is None:
+                if not self.session.running:
+                    logger.error("❌ Camera session lost, stopping inspection.")
+                    self._running = False
+                continue
+
+            index, timestamp, image = latest
+            # Frame acquisiti dalla camera mentre la pipeline era occupata
+            if last_index:
+                self._counters["dropped_stale"] += max(0, index - last_index - 1)
+            last_index = index
+
+            if index - last_processed < self.every_n:
+                self._counters["skipped_every_n"] += 1
+                continue
+            last_processed = index
+
+            frame = Frame(image=image, timestamp=timestamp, source=f"camera:{self.session.source}")
+            try:
+                with log_context(frame_id=frame.frame_id):
+                    self._inspect(frame)
+            except BatcherOverloaded as e:
+                self._counters["errors"] += 1
+                logger.warning(f"⚠️ Inspection frame skipped: {e}")
+            except Exception:
+                self._counters["errors"] += 1
+                logger.exception("❌ Inspection error:")
+
+    def _record(self, stage: str, seconds: float):
+        self._latencies[stage].append(seconds * 1000)
+
+    def _inspect(self, frame: Frame):
+        self._record("queue", time.time() - frame.timestamp)
+        annotated = frame.image
+        event = {"frame_id": frame.frame_id, "timestamp": frame.timestamp, "pipeline": self.pipeline}
+
+        anomalib_results = []
+        if self.pipeline in ("anomalib", "both"):
+            start = time.perf_counter()
+            anomalib_results = self.anomalib_batcher.submit((frame, False))
+            self._record("anomalib", time.perf_counter() - start)
+
+            labels = [result.is_anomalous for result in anomalib_results if result.is_anomalous is not None]
+            event["anomalous"] = any(labels) if labels else None
+            event["models"] = [result.to_dict() for result in anomalib_results]
+
+        detections = None
+        if self.pipeline in ("yolo", "both"):
+            start = time.perf_counter()
+            detections = self.yolo_batcher.submit((frame, True))
+            if detections is None:
+                raise RuntimeError("YOLO inference failed")
+            self._record("yolo", time.perf_counter() - start)
+
+            boxes = detections.boxes
+            event["detections"] = [
+                {"class": detections.names[int(cls)], "confidence": float(conf), "box": [float(v) for v in box]}
+                for box, conf, cls in zip(boxes.xyxy.tolist(), boxes.conf.tolist(), boxes.cls.tolist())
+            ] if boxes is not None else []
+
+        start = time.perf_counter()
+        maps = [result for result in anomalib_results if result.anomaly_map is not None]
+        if maps:
+            annotated = color_anomaly_map(maps[0].anomaly_map, annotated)
+        if detections is not None:
+            annotated = detections.plot(img=np.ascontiguousarray(annotated))
+        self._record("render", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        jpeg = encode_jpeg(downscale(annotated, self.width), quality=self.quality)
+        self._record("encode", time.perf_counter() - start)
+
+        if event.get("anomalous"):
+            self._counters["anomalous"] += 1
+            if self.save_defects:
+                filename = f"inspection_{frame.frame_id}_{uuid.uuid4().hex[:8]}.jpg"
+                store_result("anomalib", filename, annotated, is_defect=True)
+
+        self._counters["processed"] += 1
+        self._completed.append(time.monotonic())
+        self._record("end_to_end", time.time() - frame.timestamp)
+
+        if jpeg is not None:
+            self.overlays.publish(jpeg)
+        event["latency_ms"] = {
+            stage: round(values[-1], 1) for stage, values in self._latencies.items() if values
+        }
+        self.events.publish(event)
+
+    def _fps(self) -> float:
+        if len(self._completed) < 2:
+            return 0.0
+        span = self._completed[-1] - self._completed[0]
+        return (len(self._completed) - 1) / span if span > 0 else 0.0
+
+    def status(self) -> dict:
+        latencies = {}
+        for stage, values in self._latencies.items():
+            if not values:
+                continue
+            samples = np.array(values)
+            latencies[stage] = {
+                "mean": round(float(samples.mean()), 2),
+                "p50": round(float(np.percentile(samples, 50)), 2),
+                "p95": round(float(np.percentile(samples, 95)), 2),
+            }
+        return {
+            "running": self.running,
+            "pipeline": self.pipeline,
+            "every_n": self.every_n,
+            "fps": round(self._fps(), 2),
+            "camera_fps": self.session.health()["fps"],
+            "uptime_s": round(time.time() - self._started_at, 1) if self._started_at and self.running else 0,
+            **self._counters,
+            "latency_ms": latencies,
+        }
+
+
+def inspection_from_env(session: CameraSession, yolo_batcher: MicroBatcher, anomalib_batcher: MicroBatcher) -> InspectionLoop:
+    return InspectionLoop(
+        session,
+        yolo_batcher,
+        anomalib_batcher,
+        quality=int(os.getenv("INSPECTION_QUALITY", os.getenv("STREAM_QUALITY", "75"))),
+        width=int(os.getenv("INSPECTION_WIDTH", os.getenv("STREAM_WIDTH", "960"))),
+        save_defects=os.getenv("INSPECTION_SAVE_DEFECTS", "false").lower() == "true",
+    )
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable
+
+from utils.logger import get_logger
+
+logger = get_logger('anomalib')
+
+
+def _entry_hash(model_entry: dict) -> str:
+    '''Hash stabile dell'entry YAML, per accorgersi di modifiche ai parametri.'''
+    payload = json.dumps(model_entry, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def _checkpoint_fingerprint(ckpt_path: Path | None) -> tuple:
+    '''Fingerprint economico del checkpoint (path, mtime, dimensione).'''
+    if ckpt_path is None:
+        return (None, None, None)
+    try:
+        stat = ckpt_path.stat()
+    except OSError:
+        return (str(ckpt_path), None, None)
+    return (str(ckpt_path.resolve()), stat.st_mtime_ns, stat.st_size)
+
+
+def estimate_model_bytes(model) -> int:
+    '''Stima la memoria occupata dal modello (parametri + buffer, es. memory bank).'''
+    if isinstance(getattr(model, "nbytes", None), int):
+        return model.nbytes  # modelli esportati: dimensione dell'artefatto
+    total = 0
+    for tensors in (getattr(model, "parameters", None), getattr(model, "buffers", None)):
+        if tensors is None:
+            continue
+        for tensor in tensors():
+            total += tensor.numel() * tensor.element_size()
+    index = getattr(getattr(model, "model", model), "nn_index", None)
+    if index is not None:
+        total += index.nbytes  # indice IVF di Patchcore: non è un buffer del modulo
+    return total
+
+
+@dataclass
+class RegisteredModel:
+    '''Modello residente in memoria con i metadati usati per invalidazione ed eviction.'''
+    name: str
+    model: Any
+    fingerprint: tuple
+    device: str
+    nbytes: int
+    load_seconds: float
+    loaded_at: float = field(default_factory=time.time)
+    hits: int = 0
+
+
+class ModelRegistry:
+    '''Registro di processo che tiene i modelli caricati una sola volta.
+
+    Ogni modello è identificato dal campo `name` dell'entry YAML. Viene
+    ricaricato solo se cambia il checkpoint (mtime/dimensione) o l'entry
+    stessa, e quando la somma delle memorie supera `memory_budget_mb`
+    vengono scartati i modelli usati meno di recente (LRU).
+    '''
+
+    def __init__(
+        self,
+        resolve_checkpoint: Callable[[dict], Path | None],
+        load_model: Callable[[dict, Path | None, str], Any],
+        memory_budget_mb: float | None = None,
+        default_device: str | None = None,
+    ):
+        self._resolve_checkpoint = resolve_checkpoint
+        self._load_model = load_model
+        if memory_budget_mb is None:
+            memory_budget_mb = float(os.getenv("ANOMALIB_MEMORY_BUDGET_MB", "0"))
+        self.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        self.default_device = default_device or os.getenv("ANOMALIB_DEVICE", "cpu")
+
+        self._models: OrderedDict[str, RegisteredModel] = OrderedDict()
+        self._lock = threading.RLock()
+        self._load_locks: dict[str, threading.Lock] = {}
+
+    def _device_for(self, model_entry: dict) -> str:
+        return model_entry.get("device") or self.default_device
+
+    def _fingerprint(self, model_entry: dict) -> tuple[tuple, Path | None]:
+        ckpt_path = self._resolve_checkpoint(model_entry)
+        fingerprint = _checkpoint_fingerprint(ckpt_path) + (_entry_hash(model_entry), self._device_for(model_entry))
+        return fingerprint, ckpt_path
+
+    def _load_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._load_locks.setdefault(name, threading.Lock())
+
+    def get(self, model_entry: dict):
+        '''Restituisce il modello per l'entry, caricandolo solo se necessario.'''
+        name = model_entry["name"]
+        fingerprint, ckpt_path = self._fingerprint(model_entry)
+
+        with self._lock:
+            cached = self._models.get(name)
+            if cached is not None and cached.fingerprint == fingerprint:
+                self._models.move_to_end(name)
+                cached.hits += 1
+                return cached.model
+
+        # Un lock per modello: richieste concorrenti aspettano lo stesso caricamento
+        with self._load_lock(name):
+            with self._lock:
+                cached = self._models.get(name)
+                if cached is not None and cached.fingerprint == fingerprint:
+                    self._models.move_to_end(name)
+                    cached.hits += 1
+                    return cached.model
+
+            if cached is not None:
+                logger.info(f"🔄 Checkpoint o configurazione cambiati per {name}, ricarico il modello.")
+
+            device = self._device_for(model_entry)
+            start = time.perf_counter()
+            model = self._load_model(model_entry, ckpt_path, device)
+            if model is None:
+                return None
+            model.eval()
+            elapsed = time.perf_counter() - start
+
+            registered = RegisteredModel(
+                name=name,
+                model=model,
+                fingerprint=fingerprint,
+                device=device,
+                nbytes=estimate_model_bytes(model),
+                load_seconds=elapsed,
+            )
+            with self._lock:
+                self._models[name] = registered
+                self._models.move_to_end(name)
+                self._enforce_budget(keep=name)
+
+            logger.info(
+                f"📦 Modello {name} residente su {device} "
+                f"({registered.nbytes / 1024 ** 2:.1f} MB, caricato in {elapsed:.2f}s)"
+            )
+            return model
+
+    def _enforce_budget(self, keep: str | None = None):
+        '''Scarta i modelli meno usati finché si rientra nel budget di memoria.'''
+        if self.memory_budget_bytes <= 0:
+            return
+        while self.total_bytes() > self.memory_budget_bytes:
+            victim = next((name for name in self._models if name != keep), None)
+            if victim is None:
+                logger.warning(f"⚠️ Il modello {keep} da solo supera il budget di memoria configurato.")
+                return
+            evicted = self._models.pop(victim)
+            logger.info(f"🧹 Evict LRU del modello {victim} ({evicted.nbytes / 1024 ** 2:.1f} MB)")
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            return sum(entry.nbytes for entry in self._models.values())
+
+    def evict(self, name: str) -> bool:
+        with self._lock:
+            return self._models.pop(name, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+    def stats(self) -> dict:
+        '''Stato del registro, utile per diagnostica ed endpoint di health.'''
+        with self._lock:
+            return {
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "total_bytes": sum(entry.nbytes for entry in self._models.values()),
+                "models": [
+                    {
+                        "name": entry.name,
+                        "device": entry.device,
+                        "backend": getattr(entry.model, "backend", "torch"),
+                        "bytes": entry.nbytes,
+                        "load_seconds": round(entry.load_seconds, 3),
+                        "loaded_at": entry.loaded_at,
+                        "hits": entry.hits,
+                    }
+                    for entry in self._models.values()
+                ],
+            }
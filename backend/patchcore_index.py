@@ -0,0 +1,414 @@
+'''Indice IVF per la ricerca nearest-neighbour di Patchcore, solo CPU e solo torch.
+
+La memory bank viene suddivisa con k-means in `n_lists` celle; ogni patch
+viene confrontata solo con le celle dei `nprobe` centroidi più vicini invece
+che con tutta la bank. I vettori sono salvati in float16 (metà memoria) e
+convertiti in float32 solo per le celle visitate. L'indice si costruisce al
+termine del training (o al primo caricamento) e vive accanto al checkpoint:
+results/Patchcore/<dataset>/latest/weights/nn_index/<entry>.pt
+
+    python patchcore_index.py build --names patchcore_256
+    python patchcore_index.py compare --names patchcore_256 --nprobe 4,8,16
+    python patchcore_index.py bench --bank-size 20000 --dim 1536 --nprobe 4,8,16   # bank sintetica, senza checkpoint
+'''
+import argparse
+import json
+import math
+import platform
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils.paths import CONFIGS_DIR
+from utils.logger import get_logger
+
+logger = get_logger('anomalib')
+
+NN_SEARCH_MODES = ("exact", "ivf")
+
+
+def entry_nn_search(model_entry: dict) -> str:
+    if model_entry.get("model") != "Patchcore":
+        return "exact"
+    mode = str(model_entry.get("nn_search", "exact")).lower()
+    if mode not in NN_SEARCH_MODES:
+        logger.warning(f"⚠️ nn_search '{mode}' sconosciuto per {model_entry['name']}, uso exact.")
+        return "exact"
+    return mode
+
+
+def index_path(ckpt_path: Path, entry_name: str) -> Path:
+    return ckpt_path.parent.parent / "nn_index" / f"{entry_name}.pt"
+
+
+def checkpoint_stamp(ckpt_path: Path) -> dict:
+    stat = ckpt_path.stat()
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _nearest_centroid(vectors: torch.Tensor, centroids: torch.Tensor, chunk: int = 8192) -> torch.Tensor:
+    return torch.cat([
+        torch.cdist(vectors[start:start + chunk], centroids).argmin(dim=1)
+        for start in range(0, len(vectors), chunk)
+    ])
+
+
+def kmeans(vectors: torch.Tensor, n_lists: int, iterations: int = 10, seed: int = 0) -> tuple[torch.Tensor, torch.Tensor]:
+    '''K-means di Lloyd; restituisce centroidi e assegnazione di ogni vettore.'''
+    generator = torch.Generator().manual_seed(seed)
+    centroids = vectors[torch.randperm(len(vectors), generator=generator)[:n_lists]].clone()
+    for _ in range(iterations):
+        assignment = _nearest_centroid(vectors, centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, vectors)
+        counts = torch.bincount(assignment, minlength=len(centroids))
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled].unsqueeze(1).to(vectors.dtype)
+    return centroids, _nearest_centroid(vectors, centroids)
+
+
+class IVFIndex:
+    '''Inverted file index sulla memory bank di Patchcore.
+
+    I vettori sono ordinati per cella, quindi ogni cella è una slice contigua
+    di `bank` (offsets[i]:offsets[i + 1]). Le posizioni restituite da search()
+    si riferiscono a questo ordine.
+    '''
+
+    # Elementi float32 di query e vettori materializzati per blocco di celle in search() (~128 MB)
+    SEARCH_CHUNK_ELEMENTS = 1 << 25
+
+    def __init__(self, centroids: torch.Tensor, bank: torch.Tensor, offsets: torch.Tensor, nprobe: int = 8, metadata: dict | None = None):
+        self.centroids = centroids.float()
+        self.bank = bank
+        self.offsets = offsets.long()
+        self.sizes = self.offsets[1:] - self.offsets[:-1]
+        # Norme al quadrato dei vettori così come salvati (es. float16), per le distanze in search()
+        self.norms = torch.cat([
+            bank[start:start + 65536].float().pow(2).sum(1) for start in range(0, len(bank), 65536)
+        ]) if len(bank) else torch.empty(0)
+        self.nprobe = max(1, min(nprobe, len(centroids)))
+        self.metadata = metadata or {}
+
+    @classmethod
+    def build(
+        cls,
+        memory_bank: torch.Tensor,
+        n_lists: int | None = None,
+        dtype: torch.dtype = torch.float16,
+        iterations: int = 10,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        vectors = memory_bank.detach().float().cpu()
+        # Circa 4·√N celle: compromesso classico tra costo dei centroidi e dimensione delle celle
+        n_lists = n_lists or max(1, min(len(vectors), int(4 * math.sqrt(len(vectors)))))
+        start = time.perf_counter()
+        centroids, assignment = kmeans(vectors, n_lists, iterations, seed)
+        order = torch.argsort(assignment, stable=True)
+        counts = torch.bincount(assignment, minlength=n_lists)
+        offsets = torch.cat([torch.zeros(1, dtype=torch.long), counts.cumsum(0)])
+        logger.info(
+            f"🗂️  Indice IVF costruito: {len(vectors)} vettori, {n_lists} celle, "
+            f"{str(dtype).replace('torch.', '')}, {time.perf_counter() - start:.1f}s"
+        )
+        return cls(centroids, vectors[order].to(dtype), offsets, metadata={"n_vectors": len(vectors), "n_lists": n_lists})
+
+    @property
+    def nbytes(self) -> int:
+        return sum(tensor.numel() * tensor.element_size() for tensor in (self.centroids, self.bank, self.offsets, self.norms))
+
+    def save(self, path: Path, **metadata):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.metadata.update(metadata)
+        torch.save({
+            "centroids": self.centroids,
+            "bank": self.bank,
+            "offsets": self.offsets,
+            "metadata": self.metadata,
+        }, path)
+
+    @classmethod
+    def load(cls, path: Path, nprobe: int = 8) -> "IVFIndex":
+        state = torch.load(path, map_location="cpu")
+        return cls(state["centroids"], state["bank"], state["offsets"], nprobe=nprobe, metadata=state.get("metadata"))
+
+    def search(self, queries: torch.Tensor, k: int = 1) -> tuple[torch.Tensor, torch.Tensor]:
+        '''Distanze euclidee e posizioni dei k vicini approssimati per ogni riga di `queries`.
+
+        Le coppie (query, cella visitata) vengono ordinate per cella e le celle
+        raggruppate per classe di dimensione e di numero di query (potenze di
+        2): ogni gruppo è una sola baddbmm tra le query e i vettori delle sue
+        celle, letti una volta sola e con padding al più doppio. Il numero di
+        operazioni dipende quindi dai gruppi (poche decine), non dalle celle.
+        Le posizioni mancanti (meno di k candidati) valgono -1.
+        '''
+        device = queries.device
+        queries = queries.detach().float().cpu()
+        num_queries, dim = queries.shape
+        probes = torch.cdist(queries, self.centroids).topk(self.nprobe, dim=1, largest=False).indices
+
+        # Coppie ordinate per cella; rank = posizione della query tra quelle della stessa cella
+        order = torch.argsort(probes.flatten(), stable=True)
+        pair_queries = order // self.nprobe
+        cells, counts = torch.unique_consecutive(probes.flatten()[order], return_counts=True)
+        pair_cell = torch.arange(len(cells)).repeat_interleave(counts)
+        rank = torch.arange(len(order)) - (counts.cumsum(0) - counts).repeat_interleave(counts)
+        sizes = self.sizes[cells]
+        groups = torch.log2(sizes.clamp(min=1).float()).ceil().long() * 64 + torch.log2(counts.float()).ceil().long()
+        groups[sizes == 0] = -1
+
+        pair_distances = torch.full((len(order), k), float("inf"))
+        pair_positions = torch.full((len(order), k), -1, dtype=torch.long)
+        local = torch.full((len(cells),), -1, dtype=torch.long)
+        for group in groups.unique().tolist():
+            if group < 0:
+                continue
+            members = (groups == group).nonzero().squeeze(1)
+            width, depth = int(sizes[members].max()), int(counts[members].max())
+            step = max(1, self.SEARCH_CHUNK_ELEMENTS // ((width + depth) * dim))
+            for begin in range(0, len(members), step):
+                chunk = members[begin:begin + step]
+                local[chunk] = torch.arange(len(chunk))
+                selected = (local[pair_cell] >= 0).nonzero().squeeze(1)
+                cell_slot, query_slot = local[pair_cell[selected]], rank[selected]
+                local[chunk] = -1
+
+                grouped_queries = torch.zeros(len(chunk), depth, dim)
+                grouped_queries[cell_slot, query_slot] = queries[pair_queries[selected]]
+                steps = torch.arange(width)
+                valid = steps < sizes[chunk].unsqueeze(1)
+                positions = (self.offsets[cells[chunk]].unsqueeze(1) + steps).masked_fill(~valid, 0)
+                vectors = self.bank[positions].float()
+
+                # ||q - v||² = ||v||² - 2 q·v (+ ||q||², sommato dopo)
+                squared = torch.baddbmm(
+                    self.norms[positions].unsqueeze(1), grouped_queries, vectors.transpose(1, 2), alpha=-2
+                ).masked_fill(~valid.unsqueeze(1), float("inf"))
+                top = squared.topk(min(k, width), dim=2, largest=False)
+                found = top.values.shape[2]
+                pair_distances[selected, :found] = top.values[cell_slot, query_slot]
+                pair_positions[selected, :found] = positions[cell_slot].gather(1, top.indices[cell_slot, query_slot])
+
+        # Migliori k tra le celle visitate da ogni query
+        pair_distances += queries.pow(2).sum(1)[pair_queries].unsqueeze(1)
+        distances = torch.full((num_queries, self.nprobe, k), float("inf"))
+        positions = torch.full((num_queries, self.nprobe, k), -1, dtype=torch.long)
+        distances[pair_queries, order % self.nprobe] = pair_distances
+        positions[pair_queries, order % self.nprobe] = pair_positions
+        top = distances.flatten(1).topk(k, dim=1, largest=False)
+        best_positions = positions.flatten(1).gather(1, top.indices).masked_fill(top.values.isinf(), -1)
+        return top.values.clamp(min=0).sqrt().to(device), best_positions.to(device)
+
+    def anomaly_score(self, num_neighbors: int, patch_scores: torch.Tensor, positions: torch.Tensor, embedding: torch.Tensor) -> torch.Tensor:
+        '''Come PatchcoreModel.compute_anomaly_score, ma sui vettori dell'indice.'''
+        if num_neighbors == 1:
+            return patch_scores.amax(1)
+        device = patch_scores.device
+        patch_scores, positions = patch_scores.cpu(), positions.cpu()
+        batch_size, num_patches = patch_scores.shape
+        batch = torch.arange(batch_size)
+        max_patches = patch_scores.argmax(dim=1)
+        max_features = embedding.reshape(batch_size, num_patches, -1)[batch, max_patches].float().cpu()
+        score = patch_scores[batch, max_patches]
+        nn_sample = self.bank[positions[batch, max_patches]].float()
+        _, support = self.search(nn_sample, k=min(num_neighbors, len(self.bank)))
+        distances = torch.cdist(max_features.unsqueeze(1), self.bank[support.clamp(min=0)].float())
+        weights = (1 - F.softmax(distances.squeeze(1), 1))[..., 0]
+        return (weights * score).to(device)
+
+
+def load_or_build_index(torch_model, ckpt_path: Path, model_entry: dict) -> IVFIndex | None:
+    '''Indice dell'entry accanto al checkpoint; viene ricostruito se manca o se il checkpoint è cambiato.'''
+    path = index_path(ckpt_path, model_entry["name"])
+    nprobe = int(model_entry.get("nprobe", 8))
+    stamp = checkpoint_stamp(ckpt_path)
+    if path.exists():
+        index = IVFIndex.load(path, nprobe=nprobe)
+        if index.metadata.get("checkpoint") == stamp and index.metadata.get("params") == _index_params(model_entry):
+            return index
+        logger.info(f"🔄 Indice IVF di {model_entry['name']} non aggiornato (checkpoint o parametri cambiati), lo ricostruisco.")
+
+    memory_bank = getattr(torch_model, "memory_bank", None)
+    if memory_bank is None or memory_bank.numel() == 0:
+        logger.error(f"❌ Memory bank assente per {model_entry['name']}, impossibile costruire l'indice IVF.")
+        return None
+    index = build_entry_index(memory_bank, model_entry)
+    index.nprobe = max(1, min(nprobe, len(index.centroids)))
+    index.save(path, checkpoint=stamp)
+    return index
+
+
+def _index_params(model_entry: dict) -> dict:
+    '''Parametri dell'entry che cambiano il contenuto dell'indice (nprobe no: vale solo in ricerca).'''
+    return {
+        "memory_bank_dtype": str(model_entry.get("memory_bank_dtype", "float16")).lower(),
+        "n_lists": model_entry.get("n_lists"),
+    }
+
+
+def build_entry_index(memory_bank: torch.Tensor, model_entry: dict) -> IVFIndex:
+    params = _index_params(model_entry)
+    dtype = torch.float16 if params["memory_bank_dtype"] == "float16" else torch.float32
+    index = IVFIndex.build(memory_bank, n_lists=params["n_lists"], dtype=dtype)
+    index.metadata["params"] = params
+    return index
+
+
+def attach_index(torch_model, index: IVFIndex):
+    '''Sostituisce la memory bank FP32 del modello con l'indice (che ne tiene una copia compatta).'''
+    torch_model.nn_index = index
+    torch_model.memory_bank = torch.empty(0, index.bank.shape[1])
+
+
+def _compare(entries: list[dict], args):
+    from anomalib_eval import image_metrics, load_batches, split_dataset
+    from anomalib_planner import FEATURE_HEADS
+    from anomalib_runner import INFERENCE_MODEL_CLASSES, get_latest_ckpt_path, load_checkpoint_with_fallback
+
+    split = split_dataset(args.dataset, calibration_size=0, abnormal_dirs=tuple(args.abnormal_dirs.split(",")))
+    paths, labels = split.test_paths, split.test_labels
+    head = FEATURE_HEADS["Patchcore"]
+
+    print(f"{'entry':<28} {'search':<12} {'ms/img':>8} {'AUROC':>7} {'score corr':>10} {'max rel Δ':>10} {'map Δ':>8} {'MB':>7}")
+    for entry in entries:
+        ckpt_path = get_latest_ckpt_path(entry["model"], args.dataset)
+        model = load_checkpoint_with_fallback(INFERENCE_MODEL_CLASSES["Patchcore"], ckpt_path, entry)
+        if model is None:
+            continue
+        torch_model = model.eval().model
+        index = load_or_build_index(torch_model, ckpt_path, entry)
+        exact_bytes = torch_model.memory_bank.numel() * torch_model.memory_bank.element_size()
+
+        def run(batch):
+            features = torch_model.feature_extractor(batch)
+            return head(torch_model, {layer: features[layer] for layer in torch_model.layers}, batch.shape[-2:])
+
+        variants = [("exact", None, exact_bytes)] + [
+            (f"ivf/{nprobe}", nprobe, index.nbytes) for nprobe in (int(value) for value in args.nprobe.split(","))
+        ]
+        reference = None
+        for label, nprobe, nbytes in variants:
+            torch_model.nn_index = None
+            if nprobe is not None:
+                index.nprobe = nprobe
+                torch_model.nn_index = index
+            scores, maps, elapsed = [], [], 0.0
+            with torch.no_grad():
+                for batch in load_batches(paths, int(entry["size"]), args.batch_size):
+                    start = time.perf_counter()
+                    output = run(batch)
+                    elapsed += time.perf_counter() - start
+                    scores.append(output["pred_score"].reshape(-1))
+                    maps.append(output["anomaly_map"])
+            scores, maps = torch.cat(scores).numpy(), torch.cat(maps)
+            if reference is None:
+                reference = (scores, maps)
+            metrics = image_metrics(labels, scores)
+            relative = np.abs(scores - reference[0]) / np.maximum(np.abs(reference[0]), 1e-8)
+            map_delta = float((maps - reference[1]).abs().mean() / reference[1].abs().mean().clamp(min=1e-8))
+            print(
+                f"{entry['name']:<28} {label:<12} {1000 * elapsed / max(len(scores), 1):>8.1f} "
+                f"{metrics['auroc'] if metrics['auroc'] is not None else float('nan'):>7.4f} "
+                f"{float(np.corrcoef(scores, reference[0])[0, 1]) if len(scores) > 1 else 1.0:>10.4f} "
+                f"{float(relative.max()):>10.2e} {map_delta:>8.2e} {nbytes / 1024 ** 2:>7.1f}"
+            )
+
+
+def _bench(args):
+    '''Exact (cdist su tutta la bank FP32) contro IVF su una bank sintetica a cluster, come le patch di Patchcore.'''
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    centers = torch.randn(max(1, args.bank_size // 50), args.dim)
+    bank = centers[torch.randint(len(centers), (args.bank_size,))] + 0.5 * torch.randn(args.bank_size, args.dim)
+    # Patch di un'immagine di test: vicine a quelle normali, con qualche patch anomala
+    queries = bank[torch.randint(args.bank_size, (args.queries,))] + 0.3 * torch.randn(args.queries, args.dim)
+    queries[: args.queries // 20] += 2.0 * torch.randn(args.queries // 20, args.dim)
+
+    def timed_ms(fn) -> list[float]:
+        fn()
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def summary(timings: list[float]) -> dict:
+        timings = np.asarray(timings)
+        return {"p50_ms": round(float(np.percentile(timings, 50)), 2), "p95_ms": round(float(np.percentile(timings, 95)), 2)}
+
+    exact_distances = torch.cdist(queries, bank).min(dim=1).values
+    results = [{"search": "exact", **summary(timed_ms(lambda: torch.cdist(queries, bank).min(dim=1))),
+                "recall_at_1": 1.0, "max_rel_error": 0.0, "mb": round(bank.numel() * 4 / 1024 ** 2, 1)}]
+    dtype = torch.float16 if args.dtype == "float16" else torch.float32
+    index = IVFIndex.build(bank, n_lists=args.n_lists, dtype=dtype)
+    # Vicino esatto sugli stessi vettori dell'indice: la recall misura solo l'approssimazione IVF
+    stored_distances = torch.cdist(queries, index.bank.float()).min(dim=1).values
+    for nprobe in (int(value) for value in args.nprobe.split(",")):
+        index.nprobe = max(1, min(nprobe, len(index.centroids)))
+        distances = index.search(queries, k=1)[0][:, 0]
+        relative = (distances - exact_distances).abs() / exact_distances.clamp(min=1e-8)
+        results.append({
+            "search": f"ivf/{nprobe}",
+            **summary(timed_ms(lambda: index.search(queries, k=1))),
+            "recall_at_1": round(float((distances <= stored_distances * (1 + 1e-4)).float().mean()), 4),
+            "max_rel_error": round(float(relative.max()), 5),
+            "mb": round(index.nbytes / 1024 ** 2, 1),
+        })
+
+    print(f"{'search':<10} {'p50 ms':>8} {'p95 ms':>8} {'recall@1':>9} {'max rel Δ':>10} {'MB':>7}")
+    for row in results:
+        print(f"{row['search']:<10} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f} {row['recall_at_1']:>9.4f} {row['max_rel_error']:>10.2e} {row['mb']:>7.1f}")
+
+    output = Path(args.output) if args.output else Path("results") / "benchmarks" / f"patchcore_index_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    settings = {key: getattr(args, key) for key in ("bank_size", "dim", "queries", "n_lists", "dtype", "repeats")}
+    environment = {"python": platform.python_version(), "torch": torch.__version__, "threads": torch.get_num_threads(), "machine": platform.machine(), "processor": platform.processor()}
+    output.write_text(json.dumps({"environment": environment, "settings": settings, "results": results}, indent=2))
+    logger.info(f"📄 Risultati salvati in {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["build", "compare", "bench"])
+    parser.add_argument("--config", default=str(CONFIGS_DIR / "anomalib_models.yaml"))
+    parser.add_argument("--names", help="entry Patchcore separate da virgola (default: quelle abilitate)")
+    parser.add_argument("--dataset", default="hazelnut_toy")
+    parser.add_argument("--abnormal-dirs", default="crack")
+    parser.add_argument("--nprobe", default="4,8,16", help="valori di nprobe da confrontare (compare, bench)")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--bank-size", type=int, default=20000, help="vettori della bank sintetica (bench)")
+    parser.add_argument("--dim", type=int, default=1536, help="dimensione delle feature (bench; Patchcore wide_resnet50: 1536)")
+    parser.add_argument("--queries", type=int, default=1024, help="patch per immagine (bench; 256px: 32x32)")
+    parser.add_argument("--n-lists", type=int, default=None)
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--output", help="file JSON dei risultati (bench)")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        _bench(args)
+        return
+
+    from anomalib_runner import INFERENCE_MODEL_CLASSES, get_latest_ckpt_path, load_checkpoint_with_fallback, select_model_entries
+
+    entries = [entry for entry in select_model_entries(Path(args.config), args.names) if entry["model"] == "Patchcore"]
+    if args.command == "compare":
+        _compare(entries, args)
+        return
+
+    for entry in entries:
+        ckpt_path = get_latest_ckpt_path(entry["model"], args.dataset)
+        model = load_checkpoint_with_fallback(INFERENCE_MODEL_CLASSES["Patchcore"], ckpt_path, entry)
+        if model is None:
+            continue
+        index = build_entry_index(model.model.memory_bank, entry)
+        index.save(index_path(ckpt_path, entry["name"]), checkpoint=checkpoint_stamp(ckpt_path))
+        logger.info(f"✅ Indice IVF salvato per {entry['name']} ({index.nbytes / 1024 ** 2:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
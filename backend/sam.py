@@ -1,18 +1,121 @@
 import cv2
 import numpy as np
 import uuid
+import hashlib
+import threading
+from collections import OrderedDict
 from pathlib import Path
 import os
 
 from utils.paths import MODELS_DIR, DATA_DIR
-from utils.logger import get_logger
-
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
+from utils.logger import PER_FRAME, get_logger
+from utils.frames import Frame, as_frame
+from utils.storage import StoredImage, store_result
+from utils.lazy import register_lazy
+from utils.metrics import span
 
 logger = get_logger('sam')
 
-try:
+
+def image_hash(image: np.ndarray) -> str:
+    '''Hash del contenuto dell'immagine (pixel + forma), chiave della cache degli embedding.'''
+    digest = hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16)
+    digest.update(str(image.shape).encode())
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    '''Cache LRU degli embedding dell'encoder ViT, limitata in memoria.'''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    @staticmethod
+    def _nbytes(features) -> int:
+        return features.numel() * features.element_size()
+
+    def put(self, key: str, features, original_size: tuple, input_size: tuple):
+        nbytes = self._nbytes(features)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._nbytes(self._entries.pop(key)[0])
+            self._entries[key] = (features, original_size, input_size)
+            self._bytes += nbytes
+            # Evict LRU finché si rientra nel budget
+            while self._bytes > self.max_bytes and self._entries:
+                _, (evicted, _, _) = self._entries.popitem(last=False)
+                self._bytes -= self._nbytes(evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class CachedSamPredictor:
+    '''Avvolge un SamPredictor e riusa l'embedding se la stessa immagine è già stata codificata.
+
+    Tutto il resto (predict, predict_torch, transform, ...) è delegato al
+    predictor originale, così può sostituirlo anche nel generatore automatico.
+    '''
+
+    def __init__(self, predictor, cache: EmbeddingCache):
+        self._predictor = predictor
+        self.cache = cache
+        self.last_cache_hit = False
+
+    def __getattr__(self, name):
+        return getattr(self._predictor, name)
+
+    def set_image(self, image: np.ndarray, image_format: str = "RGB") -> None:
+        key = f"{image_format}:{image_hash(image)}"
+        cached = self.cache.get(key)
+        if cached is not None:
+            self._predictor.reset_image()
+            self._predictor.features, self._predictor.original_size, self._predictor.input_size = cached
+            self._predictor.is_image_set = True
+            self.last_cache_hit = True
+            return
+
+        self._predictor.set_image(image, image_format)
+        self.last_cache_hit = False
+        self.cache.put(key, self._predictor.features, self._predictor.original_size, self._predictor.input_size)
+
+
+embedding_cache = EmbeddingCache(max_bytes=int(float(os.getenv("SAM_EMBEDDING_CACHE_MB", "256")) * 1024 * 1024))
+
+# Il predictor è stateful (embedding corrente): un solo utilizzo alla volta
+_sam_lock = threading.Lock()
+
+
+def _load_sam():
+    '''Carica ViT-B e prepara predictor (con cache) e generatore automatico.'''
+    from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+
     sam = sam_model_registry["vit_b"](checkpoint=str(MODELS_DIR / "sam_vit_b.pth"))
+    predictor = CachedSamPredictor(SamPredictor(sam), embedding_cache)
     mask_generator = SamAutomaticMaskGenerator(
         model=sam,
         points_per_side=8,           # Di default è 32 (molto pesante)
@@ -20,45 +123,131 @@ try:
         stability_score_thresh=0.95,
         crop_n_layers=0,             # Evita i crop multi-scala (più leggeri)
     )
-    
-    logger.info("✅ SAM model loaded successfully")
-except Exception as e:
-    logger.error(f"❌ Failed to load SAM model: {e}")
-    sam = None
-    mask_generator = None
-    
-def run_sam(image_path: Path) -> Path | None:
-    '''Esegue il modello SAM su un'immagine e salva i risultati.'''
-    
-    
+    mask_generator.predictor = predictor  # anche la generazione automatica usa la cache
+    return predictor, mask_generator
+
+
+sam_model = register_lazy("sam", _load_sam)
+
+
+def _draw_masks(image_rgb: np.ndarray, masks) -> np.ndarray:
+    '''Disegna i contorni delle maschere binarie su una copia dell'immagine RGB.'''
+    annotated = image_rgb.copy()
+    for seg in masks:
+        contours, _ = cv2.findContours(seg.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        cv2.drawContours(annotated, contours, -1, (0, 255, 0), 1)  # verde
+    return annotated
+
+
+def run_sam(frame: Frame | np.ndarray | Path) -> StoredImage | None:
+    '''Esegue il modello SAM su un frame e salva i risultati.'''
+    _, mask_generator = sam_model.get() or (None, None)
     if mask_generator is None:
         logger.error("SAM non è stato inizializzato.")
         return None
-    
-    image = cv2.imread(str(image_path)) # Legge l'immagine da file
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # Converte da BGR a RGB per SAM
-        
-    if image is None:
-        logger.error(f"❌ Impossibile leggere l'immagine da {image_path}")
+
+    frame = as_frame(frame)
+    if frame is None:
+        logger.error("❌ Impossibile leggere il frame in ingresso")
         return None
-    
+
+    image = cv2.cvtColor(frame.image, cv2.COLOR_BGR2RGB)  # Converte da BGR a RGB per SAM
+
     try:
-        masks = mask_generator.generate(image)
-        logger.info(f"✅ {len(masks)} masks generated")
+        with _sam_lock, span("sam_generate"):
+            masks = mask_generator.generate(image)
+        logger.info(f"✅ {len(masks)} masks generated", extra=PER_FRAME)
     except Exception as e:
         logger.error(f"❌ Errore durante la generazione delle maschere: {e}")
         return None
-    
-    
-    annotated = image.copy()
-    for mask in masks:
-        seg = mask['segmentation'] # Crea una maschera binaria
-        contours, _ = cv2.findContours(seg.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cv2.drawContours(annotated, contours, -1, (0, 255, 0), 1)  # verde
-        
-        filename = f"sam_{uuid.uuid4().hex}.jpg"
-        os.makedirs(DATA_DIR / 'sam', exist_ok=True)  # Assicura che la cartella esista
-        output_path = DATA_DIR / 'sam' / filename
-        cv2.imwrite(str(output_path), annotated)
-        logger.info(f"Salvato risultato SAM in: {output_path.name}")
-        return output_path   
\ No newline at end of file
+
+    with span("sam_render"):
+        annotated = _draw_masks(image, [mask['segmentation'] for mask in masks])
+
+    filename = f"sam_{frame.frame_id}_{uuid.uuid4().hex[:8]}.jpg"
+    stored = store_result('sam', filename, cv2.cvtColor(annotated, cv2.COLOR_RGB2BGR))
+    logger.info(f"Risultato SAM accodato per il salvataggio: {filename}", extra=PER_FRAME)
+    return stored
+
+
+def segment_prompts(
+    frame: Frame | np.ndarray | Path,
+    points: list | None = None,
+    point_labels: list | None = None,
+    boxes: list | None = None,
+) -> tuple[np.ndarray, np.ndarray] | None:
+    '''Segmenta a partire da prompt (punti e/o box in pixel), riusando l'embedding in cache.
+
+    Restituisce (maschere N×H×W booleane, score N). Più box vengono decodificati
+    insieme in un'unica chiamata batched del mask decoder.
+    '''
+    predictor, _ = sam_model.get() or (None, None)
+    if predictor is None:
+        logger.error("SAM non è stato inizializzato.")
+        return None
+
+    frame = as_frame(frame)
+    if frame is None:
+        logger.error("❌ Impossibile leggere il frame in ingresso")
+        return None
+
+    point_coords = np.asarray(points, dtype=np.float32) if points else None
+    if point_coords is not None:
+        point_labels = np.asarray(point_labels if point_labels else [1] * len(point_coords), dtype=np.int64)
+    box_array = np.asarray(boxes, dtype=np.float32).reshape(-1, 4) if boxes else None
+
+    if point_coords is None and box_array is None:
+        logger.error("❌ Nessun prompt fornito a SAM")
+        return None
+
+    image = cv2.cvtColor(frame.image, cv2.COLOR_BGR2RGB)
+    with _sam_lock:
+        with span("sam_embedding"):
+            predictor.set_image(image)
+        logger.info(f"{'♻️  Cached' if predictor.last_cache_hit else '🧮 Computed'} SAM embedding for {frame.frame_id}", extra=PER_FRAME)
+
+        if box_array is not None and len(box_array) > 1:
+            if point_coords is not None:
+                logger.warning("⚠️ Con più box i prompt a punti vengono ignorati")
+            import torch
+
+            with torch.no_grad():
+                boxes_tensor = torch.as_tensor(box_array, device=predictor.device)
+                boxes_tensor = predictor.transform.apply_boxes_torch(boxes_tensor, image.shape[:2])
+                masks, scores, _ = predictor.predict_torch(
+                    point_coords=None,
+                    point_labels=None,
+                    boxes=boxes_tensor,
+                    multimask_output=False,
+                )
+            return masks[:, 0].cpu().numpy(), scores[:, 0].cpu().numpy()
+
+        masks, scores, _ = predictor.predict(
+            point_coords=point_coords,
+            point_labels=point_labels,
+            box=box_array[0] if box_array is not None else None,
+            multimask_output=False,
+        )
+    return masks, scores
+
+
+def run_sam_prompt(frame: Frame | np.ndarray | Path, **prompts) -> StoredImage | None:
+    '''Segmentazione guidata da prompt, con salvataggio dell'immagine annotata.'''
+    frame = as_frame(frame)
+    if frame is None:
+        logger.error("❌ Impossibile leggere il frame in ingresso")
+        return None
+
+    try:
+        segmented = segment_prompts(frame, **prompts)
+    except Exception as e:
+        logger.error(f"❌ Errore durante la segmentazione con prompt: {e}")
+        return None
+    if segmented is None:
+        return None
+
+    masks, _ = segmented
+    annotated = _draw_masks(frame.image, masks)
+
+    filename = f"sam_prompt_{frame.frame_id}_{uuid.uuid4().hex[:8]}.jpg"
+    return store_result('sam', filename, annotated)
@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+from typing import Any, Callable
+
+import cv2
+import numpy as np
+
+from utils.logger import get_logger
+from utils.frames import encode_jpeg
+
+from camera import CameraSession, camera_session
+
+logger = get_logger('camera')
+
+
+def downscale(image: np.ndarray, width: int) -> np.ndarray:
+    '''Riduce l'immagine alla larghezza indicata mantenendo le proporzioni (0 = nativa).'''
+    if width <= 0 or image.shape[1] <= width:
+        return image
+    height = max(1, round(image.shape[0] * width / image.shape[1]))
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+
+class LatestStream:
+    '''Ultimo valore pubblicato (JPEG o evento), condiviso da tutti gli spettatori.
+
+    Chi pubblica codifica una volta sola; ogni spettatore attende un numero di
+    sequenza più recente di quello già ricevuto, quindi i client lenti saltano
+    frame invece di accumulare ritardo. I subscriber (es. il publisher ZMQ del
+    processo di inferenza) ricevono ogni valore nel thread di chi pubblica.
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._value: Any = None
+        self._subscribers: list[Callable[[int, Any], None]] = []
+        self.published_at: float | None = None
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def subscribe(self, callback: Callable[[int, Any], None]):
+        '''callback(seq, valore) a ogni publish(); deve essere rapido, gira nel thread di chi pubblica.'''
+        self._subscribers.append(callback)
+
+    def publish(self, value: Any) -> int:
+        with self._cond:
+            self._seq += 1
+            seq = self._seq
+            self._value = value
+            self.published_at = time.time()
+            self._cond.notify_all()
+        for callback in self._subscribers:
+            callback(seq, value)
+        return seq
+
+    def wait(self, after: int = 0, timeout: float = 1.0) -> tuple[int, Any] | None:
+        '''Restituisce (seq, valore) appena è disponibile un valore con seq > `after`.'''
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > after and self._value is not None, timeout):
+                return None
+            return self._seq, self._value
+
+
+class PreviewEncoder:
+    '''Un solo thread che codifica i frame della sessione camera per tutti gli stream di anteprima.
+
+    Il thread parte alla prima richiesta e si ferma da solo quando nessuno
+    chiede frame per `idle_s` secondi; frame rate, larghezza e qualità JPEG
+    sono fissati qui, così il costo di codifica non dipende dal numero di
+    spettatori.
+    '''
+
+    def __init__(
+        self,
+        session: CameraSession,
+        fps: float = 10.0,
+        quality: int = 70,
+        width: int = 960,
+        idle_s: float = 10.0,
+    ):
+        self.session = session
+        self.fps = max(0.1, fps)
+        self.quality = quality
+        self.width = width
+        self.idle_s = idle_s
+
+        self.stream = LatestStream()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._last_request = 0.0
+
+        self._encoded = 0
+        self._encode_seconds = 0.0
+
+    def ensure_started(self) -> bool:
+        '''Avvia l'encoder se serve e rinvia lo stop per inattività; False se la camera non parte.'''
+        self._last_request = time.monotonic()
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return True
+            if not self.session.running and not self.session.start():
+                return False
+            self._thread = threading.Thread(target=self._loop, name="preview-encoder", daemon=True)
+            self._thread.start()
+            logger.info(f"📺 Preview stream started ({self.fps:g} fps, width {self.width or 'native'}, quality {self.quality})")
+            return True
+
+    def _loop(self):
+        interval = 1.0 / self.fps
+        last_index = 0
+        next_due = time.monotonic()
+        while time.monotonic() - self._last_request < self.idle_s:
+            latest = self.session.wait_for_frame(newer_than=last_index, timeout=1.0)
+            if latest is None:
+                if not self.session.running:
+                    break
+                continue
+
+            # Limita il frame rate: i frame intermedi della camera vengono saltati
+            now = time.monotonic()
+            if now < next_due:
+                time.sleep(next_due - now)
+                latest = self.session.latest() or latest
+            next_due = max(next_due + interval, time.monotonic())
+
+            last_index = latest[0]
+            start = time.perf_counter()
+            jpeg = encode_jpeg(downscale(latest[2], self.width), quality=self.quality)
+            if jpeg is None:
+                continue
+            self._encode_seconds += time.perf_counter() - start
+            self._encoded += 1
+            self.stream.publish(jpeg)
+
+        logger.info("🛑 Preview stream stopped")
+
+    def next_frame(self, after: int = 0, timeout: float = 2.0) -> tuple[int, bytes] | None:
+        '''Primo frame codificato più recente di `after`; None se la camera non produce frame.'''
+        if not self.ensure_started():
+            return None
+        return self.stream.wait(after, timeout)
+
+    def metrics(self) -> dict:
+        return {
+            "running": self._thread is not None and self._thread.is_alive(),
+            "fps": self.fps,
+            "width": self.width,
+            "quality": self.quality,
+            "frames_encoded": self._encoded,
+            "avg_encode_ms": round(1000 * self._encode_seconds / self._encoded, 2) if self._encoded else 0,
+            "last_frame_age_ms": (
+                round((time.time() - self.stream.published_at) * 1000, 1) if self.stream.published_at else None
+            ),
+        }
+
+
+# Encoder condiviso da tutti gli stream di anteprima del processo
+preview_encoder = PreviewEncoder(
+    camera_session,
+    fps=float(os.getenv("STREAM_FPS", "10")),
+    quality=int(os.getenv("STREAM_QUALITY", "70")),
+    width=int(os.getenv("STREAM_WIDTH", "960")),
+    idle_s=float(os.getenv("STREAM_IDLE_S", "10")),
+)
@@ -0,0 +1,317 @@
+'''Sweep di iperparametri dei modelli Anomalib con pruning e frontiera di Pareto accuratezza/latenza.
+
+Le griglie sono in configs/anomalib_sweeps.yaml: ogni sweep è un'entry di
+anomalib_models.yaml più un campo `grid` (le chiavi con il punto, es.
+`model_params.num_neighbors`, finiscono nei sotto-dizionari). Tutte le
+combinazioni vengono addestrate su frazioni crescenti delle immagini good di
+training (`--rungs`) e valutate su un test split fisso (good escluse dal
+training + anomale); dopo ogni rung quelle nettamente peggiori della migliore
+vengono scartate. L'obiettivo è il false positive rate alla soglia che
+raggiunge il recall richiesto sulle anomale (`--target-recall`).
+
+Le configurazioni arrivate all'ultimo rung vengono misurate in latenza CPU
+una alla volta, così le misure non si disturbano. Il report
+results/sweeps/<sweep>/report_<timestamp>.{csv,md} segna la frontiera di Pareto;
+recommended.yaml contiene l'entry più veloce entro `--max-fpr`, con la soglia
+già impostata, pronta da copiare in anomalib_models.yaml.
+
+    python sweep.py --sweep patchcore_grid --target-recall 0.95 --max-fpr 0.1
+'''
+import argparse
+import copy
+import csv
+import itertools
+import math
+import os
+import shutil
+import time
+from pathlib import Path
+
+import yaml
+
+from utils.paths import CONFIGS_DIR, DATASETS_DIR
+from utils.logger import get_logger
+from train_scheduler import TrainTask, fit_task, plan_workers, run_tasks
+
+logger = get_logger('anomalib')
+
+SWEEPS_DIR = Path("results") / "sweeps"
+REPORT_COLUMNS = (
+    "name", "model", "size", "rung", "train_images", "status", "train_s",
+    "auroc", "f1_max", "recall", "fpr_at_target", "threshold_at_target", "latency_ms", "pareto", "error",
+)
+
+
+def expand_grid(template: dict) -> list[dict]:
+    '''Un'entry per ogni combinazione della griglia, con nome derivato dai valori.'''
+    grid = template.get("grid") or {}
+    base = {key: value for key, value in template.items() if key != "grid"}
+    keys = list(grid)
+    choices = [grid[key] if isinstance(grid[key], list) else [grid[key]] for key in keys]
+
+    entries = []
+    for values in itertools.product(*choices):
+        entry = copy.deepcopy(base)
+        entry["model_params"] = entry.get("model_params") or {}
+        suffix = []
+        for key, value in zip(keys, values):
+            *parents, leaf = key.split(".")
+            target = entry
+            for parent in parents:
+                if not isinstance(target.get(parent), dict):
+                    target[parent] = {}
+                target = target[parent]
+            target[leaf] = value
+            suffix.append(f"{leaf}{value}")
+        entry["name"] = f"{base['name']}__{'_'.join(suffix)}" if suffix else base["name"]
+        entries.append(entry)
+    return entries
+
+
+def _link(source: Path, target: Path):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.symlink(source.resolve(), target)
+    except OSError:
+        shutil.copy2(source, target)  # filesystem senza symlink
+
+
+def prepare_rung_data(sweep_dir: Path, dataset: str, split, fraction: float) -> tuple[Path, int]:
+    '''Cartella Folder con una frazione delle good di training, le good di test e le anomale con maschere.'''
+    from anomalib_eval import list_images
+
+    root = sweep_dir / "data" / f"rung_{fraction:g}"
+    shutil.rmtree(root, ignore_errors=True)
+    train = split.calibration[:max(1, math.ceil(fraction * len(split.calibration)))]
+    for path in train:
+        _link(path, root / "good" / path.name)
+    for path in split.test_good:
+        _link(path, root / "good_test" / path.name)
+    for path in split.test_abnormal:
+        _link(path, root / "crack" / path.name)
+    for path in list_images(DATASETS_DIR / dataset / "mask" / "crack"):
+        _link(path, root / "mask" / "crack" / path.name)
+    return root, len(train)
+
+
+def _sweep_run(task: TrainTask) -> dict:
+    '''Eseguita nel processo del pool: addestra e restituisce gli score sul test split della cartella del rung.'''
+    from anomalib_backends import ExportWrapper
+    from anomalib_eval import list_images, score_images
+    from anomalib_runner import checkpoint_thresholds, get_latest_ckpt_path
+
+    engine, model, _, row, _ = fit_task(task)
+    if engine is None:
+        return row
+
+    model.eval()
+    thresholds = checkpoint_thresholds(model)
+    wrapper = ExportWrapper(model.model, thresholds).eval()
+    root = Path(task.root)
+    good, abnormal = list_images(root / "good_test"), list_images(root / "crack")
+    scores, _ = score_images(lambda batch: wrapper(batch)[1], good + abnormal, int(task.entry["size"]))
+    ckpt_path = get_latest_ckpt_path(task.entry["model"], task.dataset, Path(task.results_dir))
+    return {
+        **row,
+        "status": "ok",
+        "scores": scores.tolist(),
+        "labels": [0] * len(good) + [1] * len(abnormal),
+        "checkpoint_threshold": thresholds["image"],
+        "checkpoint": str(ckpt_path) if ckpt_path else None,
+    }
+
+
+def evaluate(row: dict, target_recall: float) -> dict:
+    '''Metriche immagine dagli score del worker; `objective` (più basso = meglio) guida pruning e Pareto.'''
+    import numpy as np
+    from anomalib_eval import image_metrics, operating_point, recall_at
+
+    labels, scores = np.array(row.pop("labels")), np.array(row.pop("scores"))
+    threshold = row.get("checkpoint_threshold")
+    metrics = image_metrics(labels, scores, threshold)
+    target_threshold, fpr = operating_point(labels, scores, target_recall)
+    objective = fpr if fpr is not None else (1 - metrics["auroc"] if metrics["auroc"] is not None else None)
+    return {
+        "auroc": metrics["auroc"],
+        "f1_max": metrics["f1_max"],
+        "recall": recall_at(labels, scores, threshold) if threshold is not None else None,
+        "fpr_at_target": fpr,
+        "threshold_at_target": target_threshold,
+        "objective": objective,
+    }
+
+
+def prune(names: list[str], results: dict, margin: float) -> list[str]:
+    '''Tiene le configurazioni il cui obiettivo è entro `margin` dalla migliore.'''
+    scored = [name for name in names if results[name].get("objective") is not None]
+    if not scored:
+        return []
+    best = min(results[name]["objective"] for name in scored)
+    kept = [name for name in scored if results[name]["objective"] <= best + margin]
+    for name in set(names) - set(kept):
+        logger.info(f"✂️  {name} scartata al rung {results[name]['rung']} (obiettivo {results[name].get('objective')}, migliore {best:.3f})")
+    return kept
+
+
+def measure_latency(entry: dict, ckpt_path: str, threads: int, repeats: int) -> float | None:
+    '''Mediana in ms di un forward CPU a batch 1 (preprocessing escluso), come in ispezione continua.'''
+    import numpy as np
+    import torch
+
+    from anomalib_backends import ExportWrapper
+    from anomalib_runner import INFERENCE_MODEL_CLASSES, checkpoint_thresholds, load_checkpoint_with_fallback
+    from bench_heatmap import time_call
+
+    model_class = INFERENCE_MODEL_CLASSES.get(entry["model"])
+    if model_class is None or ckpt_path is None:
+        return None
+    torch.set_num_threads(threads)
+    model = load_checkpoint_with_fallback(model_class, Path(ckpt_path), entry)
+    if model is None:
+        return None
+    model.eval()
+    wrapper = ExportWrapper(model.model, checkpoint_thresholds(model)).eval()
+    size = int(entry["size"])
+    tensor = torch.rand(1, 3, size, size)
+    with torch.no_grad():
+        timings = time_call(lambda: wrapper(tensor), repeats)
+    return round(float(np.median(timings)), 2)
+
+
+def mark_pareto(rows: list[dict]):
+    '''pareto=True per le righe non dominate in (latenza, obiettivo), entrambi da minimizzare.'''
+    candidates = [row for row in rows if row.get("latency_ms") is not None and row.get("objective") is not None]
+    for row in candidates:
+        row["pareto"] = not any(
+            other["latency_ms"] <= row["latency_ms"] and other["objective"] <= row["objective"]
+            and (other["latency_ms"] < row["latency_ms"] or other["objective"] < row["objective"])
+            for other in candidates
+        )
+
+
+def write_report(sweep_dir: Path, rows: list[dict], args, recommended: dict | None) -> Path:
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+    rows = sorted(rows, key=lambda row: (-row.get("rung", 0), row.get("latency_ms") or math.inf))
+
+    with open(sweep_dir / f"report_{stamp}.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+    def cell(value):
+        if isinstance(value, float):
+            return f"{value:.4f}"
+        if value is True:
+            return "✓"
+        return "" if value is None or value is False else str(value)
+
+    md_path = sweep_dir / f"report_{stamp}.md"
+    lines = [
+        f"# Sweep {sweep_dir.name} ({stamp})",
+        "",
+        f"Recall target {args.target_recall}, FPR massimo {args.max_fpr}, rung {args.rungs}, margine di pruning {args.prune_margin}.",
+        "",
+        "| " + " | ".join(REPORT_COLUMNS) + " |",
+        "|" + "---|" * len(REPORT_COLUMNS),
+    ]
+    lines += ["| " + " | ".join(cell(row.get(column)) for column in REPORT_COLUMNS) + " |" for row in rows]
+    lines.append("")
+    if recommended:
+        lines.append(f"**Consigliata:** `{recommended['name']}`, {recommended['latency_ms']} ms, FPR {recommended['fpr_at_target']:.3f} al recall {args.target_recall}.")
+    else:
+        lines.append(f"Nessuna configurazione raggiunge il recall {args.target_recall} con FPR ≤ {args.max_fpr}.")
+    md_path.write_text("\n".join(lines) + "\n")
+    return md_path
+
+
+def run_sweep(template: dict, args) -> list[dict]:
+    from anomalib_eval import split_dataset
+
+    entries = {entry["name"]: entry for entry in expand_grid(template)}
+    sweep_dir = SWEEPS_DIR / template["name"]
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+    # Metà delle good per il training (al massimo), il resto e le anomale per il test
+    split = split_dataset(args.dataset, calibration_size=len(os.listdir(DATASETS_DIR / args.dataset / "good")), seed=args.seed)
+    fractions = sorted({float(value) for value in args.rungs.split(",")} | {1.0})
+
+    workers, threads = plan_workers(len(entries), args.mem_per_job_gb, args.workers)
+    logger.info(f"🧪 Sweep {template['name']}: {len(entries)} configurazioni, rung {fractions}, {workers} processi")
+
+    results: dict[str, dict] = {}
+    alive = list(entries)
+    for rung, fraction in enumerate(fractions):
+        root, train_images = prepare_rung_data(sweep_dir, args.dataset, split, fraction)
+        tasks = [
+            TrainTask(
+                entry=entries[name], dataset=args.dataset, root=str(root), iteration=args.seed, threads=threads,
+                feature_cache=args.feature_cache, results_dir=str(sweep_dir / "runs" / name), normal_test_dir="good_test",
+            )
+            for name in alive
+        ]
+        for row in run_tasks(tasks, workers, worker=_sweep_run):
+            row.update({"size": entries[row["name"]]["size"], "rung": rung, "train_images": train_images})
+            if row.get("status") == "ok":
+                row.update(evaluate(row, args.target_recall))
+            results[row["name"]] = row
+        logger.info(f"📊 Rung {rung} ({train_images} immagini): {len(alive)} configurazioni valutate")
+        if rung < len(fractions) - 1:
+            alive = prune(alive, results, args.prune_margin)
+            if not alive:
+                break
+
+    finished = [name for name in alive if results[name].get("status") == "ok" and results[name]["rung"] == len(fractions) - 1]
+    for name in finished:
+        results[name]["latency_ms"] = measure_latency(entries[name], results[name].get("checkpoint"), args.latency_threads, args.repeats)
+
+    rows = list(results.values())
+    final = [results[name] for name in finished]
+    mark_pareto(final)
+    eligible = [
+        row for row in final
+        if row.get("latency_ms") is not None and row.get("fpr_at_target") is not None and row["fpr_at_target"] <= args.max_fpr
+    ]
+    recommended = min(eligible, key=lambda row: row["latency_ms"]) if eligible else None
+    if recommended:
+        entry = copy.deepcopy(entries[recommended["name"]])
+        entry["threshold"] = recommended["threshold_at_target"]
+        entry["disabled"] = False
+        (sweep_dir / "recommended.yaml").write_text(yaml.safe_dump([entry], sort_keys=False, allow_unicode=True))
+
+    md_path = write_report(sweep_dir, rows, args, recommended)
+    logger.info(f"📋 Report sweep: {md_path}")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default=str(CONFIGS_DIR / "anomalib_sweeps.yaml"))
+    parser.add_argument("--sweep", help="sweep da eseguire separati da virgola (default: tutti)")
+    parser.add_argument("--dataset", default="hazelnut_toy")
+    parser.add_argument("--rungs", default="0.25,0.5,1", help="frazioni delle good di training per rung")
+    parser.add_argument("--prune-margin", type=float, default=0.1, help="scarto massimo dall'obiettivo migliore per restare in gara")
+    parser.add_argument("--target-recall", type=float, default=0.95, help="recall richiesto sulle anomale")
+    parser.add_argument("--max-fpr", type=float, default=0.1, help="FPR massimo per la configurazione consigliata")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--mem-per-job-gb", type=float, default=4.0)
+    parser.add_argument("--latency-threads", type=int, default=4, help="thread torch per la misura di latenza")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--feature-cache", choices=["float16", "float32", "off"], default="float32", help="float16 dimezza il disco ma altera leggermente gli score")
+    args = parser.parse_args()
+    if args.feature_cache == "off":
+        args.feature_cache = None
+
+    with open(args.config, "r") as f:
+        templates = yaml.safe_load(f) or []
+    if args.sweep:
+        selected = {name.strip() for name in args.sweep.split(",")}
+        templates = [template for template in templates if template["name"] in selected]
+    if not templates:
+        logger.error("Nessuno sweep da eseguire.")
+        return
+    for template in templates:
+        run_sweep(template, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+'''Training parallelo delle entry di anomalib_models.yaml.
+
+Ogni entry viene addestrata `iterations` volte (seed 0, 1, ...) con
+`epochs` epoche e batch `train_batch_size`. Le run di configurazioni diverse
+girano in parallelo in un pool di processi dimensionato su core e memoria
+liberi; le run che scriverebbero nella stessa cartella results/<Model>/<dataset>
+vengono serializzate. Il dataset viene ridimensionato una sola volta per
+risoluzione in datasets/.cache/<dataset>_<size>/ e riusato da tutte le run.
+Le attivazioni dei backbone congelati finiscono nella feature cache
+(feature_cache.py), così più configurazioni sullo stesso backbone pagano
+una sola estrazione. Al termine scrive results/training/summary_<timestamp>.{csv,md}.
+
+    python train_scheduler.py                                # entry abilitate
+    python train_scheduler.py --names padim_512,patchcore_256 --workers 2
+
+Le good di test restano fuori dal training: la cartella good_test/ del
+dataset se esiste, altrimenti il 20% di good/ estratto con seed fisso, che la
+copia ridimensionata sposta in good_test/. L'elenco viene salvato accanto al
+checkpoint (holdout.json) e anomalib_quantize.py valuta solo su quelle.
+'''
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+
+import cv2
+
+from utils.paths import CONFIGS_DIR, DATASETS_DIR
+from utils.logger import get_logger
+
+logger = get_logger('anomalib')
+
+SUMMARY_DIR = Path("results") / "training"
+CACHE_DIR = DATASETS_DIR / ".cache"
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff"}
+METRIC_COLUMNS = ("image_AUROC", "image_F1Score", "pixel_AUROC", "pixel_F1Score")
+SUMMARY_COLUMNS = ("name", "model", "dataset", "iteration", "seed", "status", "train_s", "test_s", *METRIC_COLUMNS, "cache_hits", "cache_misses", "error")
+
+
+@dataclass
+class TrainTask:
+    '''Una run di training: entry YAML, dataset e seed.'''
+    entry: dict
+    dataset: str
+    root: str
+    iteration: int
+    threads: int
+    feature_cache: str | None = "float32"  # dtype della feature cache, None per disattivarla
+    results_dir: str = "results"
+    normal_test_dir: str | None = None  # good di test separate, altrimenti Folder divide quelle di training
+    holdout: tuple[str, ...] = ()  # good escluse dal training, registrate accanto al checkpoint
+
+    @property
+    def lock_key(self) -> tuple[str, str, str]:
+        # Anomalib versiona <results>/<Model>/<dataset>/vN: due run concorrenti lì si pesterebbero i piedi
+        return self.results_dir, self.entry["model"], self.dataset
+
+
+def cached_dataset_root(
+    dataset: str,
+    size: int,
+    abnormal_dir: str = "crack",
+    normal_test_dir: str = "good_test",
+    holdout: list[Path] = (),
+) -> Path:
+    '''Copia del dataset già ridimensionata a `size`, ricostruita solo se immagini sorgente o holdout cambiano.
+
+    Le good in `holdout` finiscono in `normal_test_dir` invece che in good/.
+    '''
+    source = DATASETS_DIR / dataset
+    target = CACHE_DIR / f"{dataset}_{size}"
+    folders = ("good", normal_test_dir, abnormal_dir, f"mask/{abnormal_dir}")
+    held_out = set(holdout)
+    files = [
+        (normal_test_dir if path in held_out else folder, path)
+        for folder in folders
+        for path in sorted((source / folder).glob("*"))
+        if path.suffix.lower() in IMAGE_SUFFIXES
+    ]
+    manifest = {
+        "size": size,
+        "files": [[f"{folder}/{path.name}", path.stat().st_mtime_ns, path.stat().st_size] for folder, path in files],
+    }
+    manifest_path = target / "manifest.json"
+    if manifest_path.exists() and json.loads(manifest_path.read_text()) == manifest:
+        return target
+
+    start = time.perf_counter()
+    shutil.rmtree(target, ignore_errors=True)
+    for folder, path in files:
+        image = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            continue
+        # Le maschere restano binarie: niente interpolazione
+        interpolation = cv2.INTER_NEAREST if folder.startswith("mask") else cv2.INTER_AREA
+        output = target / folder / f"{path.stem}.png"
+        output.parent.mkdir(parents=True, exist_ok=True)
+        cv2.imwrite(str(output), cv2.resize(image, (size, size), interpolation=interpolation))
+    manifest_path.write_text(json.dumps(manifest))
+    logger.info(f"🗃️  Cache {target.name}: {len(files)} immagini ridimensionate in {time.perf_counter() - start:.1f}s")
+    return target
+
+
+def _available_memory_bytes() -> int | None:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def plan_workers(task_count: int, mem_per_job_gb: float, requested: int | None = None) -> tuple[int, int]:
+    '''(processi, thread torch per processo) in base a core e memoria disponibili.'''
+    import torch
+
+    cores = os.cpu_count() or 1
+    if requested:
+        workers = requested
+    elif torch.cuda.is_available():
+        workers = 1  # una sola GPU: run concorrenti si contenderebbero la memoria video
+    else:
+        available = _available_memory_bytes()
+        by_memory = int(available // (mem_per_job_gb * 1024 ** 3)) if available else cores
+        workers = max(1, min(task_count, cores, by_memory))
+    workers = max(1, min(workers, task_count))
+    return workers, max(1, cores // workers)
+
+
+def fit_task(task: TrainTask):
+    '''Addestra l'entry del task nel processo corrente.
+
+    Restituisce (engine, model, datamodule, row, cache); engine è None se il
+    modello non è supportato.
+    '''
+    import torch
+    from lightning.pytorch import seed_everything
+    from anomalib.engine import Engine
+
+    from anomalib_runner import load_anomalib_model, prepare_folder_datamodule
+    from feature_cache import install_feature_cache
+
+    entry = task.entry
+    row = {"name": entry["name"], "model": entry["model"], "dataset": task.dataset, "iteration": task.iteration, "seed": task.iteration}
+    torch.set_num_threads(task.threads)
+    seed_everything(task.iteration, workers=True)
+
+    model = load_anomalib_model(entry)
+    if model is None:
+        return None, None, None, {**row, "status": "skipped", "error": "modello non supportato"}, None
+    size = int(entry["size"])
+    cache = None
+    if task.feature_cache and entry.get("feature_cache", True):
+        cache = install_feature_cache(model.model, size, task.feature_cache)
+    batch_size = int(entry.get("train_batch_size", 32))
+    datamodule = prepare_folder_datamodule(
+        task.dataset,
+        root=Path(task.root),
+        train_batch_size=batch_size,
+        eval_batch_size=batch_size,
+        image_size=(size, size),
+        seed=task.iteration,
+        normal_test_dir=task.normal_test_dir,
+    )
+
+    logger.info(f"🚀 Inizio training: {entry['name']} (run {task.iteration + 1}/{int(entry.get('iterations', 1))})")
+    engine = Engine(max_epochs=int(entry.get("epochs", 1)), default_root_dir=task.results_dir)
+    start = time.perf_counter()
+    engine.fit(model=model, datamodule=datamodule)
+    row["train_s"] = round(time.perf_counter() - start, 1)
+    if cache is not None:
+        row["cache_hits"], row["cache_misses"] = cache.hits, cache.misses
+    return engine, model, datamodule, row, cache
+
+
+def _train_run(task: TrainTask) -> dict:
+    '''Eseguita nel processo del pool: addestra, costruisce l'eventuale indice e valuta sul test split.'''
+    from anomalib_eval import save_holdout
+    from anomalib_runner import get_latest_ckpt_path
+    from patchcore_index import build_entry_index, checkpoint_stamp, entry_nn_search, index_path
+
+    entry = task.entry
+    engine, model, datamodule, row, cache = fit_task(task)
+    if engine is None:
+        return row
+
+    ckpt_path = get_latest_ckpt_path(entry["model"], task.dataset, Path(task.results_dir))
+    if ckpt_path is not None and task.holdout:
+        save_holdout(ckpt_path, task.dataset, [Path(path) for path in task.holdout])
+    if ckpt_path is not None and entry_nn_search(entry) == "ivf":
+        # Indice costruito subito, accanto al checkpoint appena scritto
+        index = build_entry_index(model.model.memory_bank, entry)
+        index.save(index_path(ckpt_path, entry["name"]), checkpoint=checkpoint_stamp(ckpt_path))
+
+    start = time.perf_counter()
+    results = engine.test(model=model, datamodule=datamodule) or [{}]
+    row["test_s"] = round(time.perf_counter() - start, 1)
+    for column in METRIC_COLUMNS:
+        if column in results[0]:
+            row[column] = round(float(results[0][column]), 4)
+    if cache is not None:
+        row["cache_hits"], row["cache_misses"] = cache.hits, cache.misses
+    logger.info(f"✅ Training completato: {entry['name']} in {row['train_s']}s")
+    return {**row, "status": "ok"}
+
+
+def build_tasks(
+    entries: list[dict],
+    dataset: str,
+    threads: int,
+    use_cache: bool = True,
+    feature_cache: str | None = "float32",
+    normal_test_dir: str = "good_test",
+    holdout_fraction: float = 0.2,
+) -> list[TrainTask]:
+    from anomalib_eval import holdout_good
+
+    tasks = []
+    for entry in entries:
+        entry_dataset = entry.get("dataset", dataset)
+        held_out = holdout_good(entry_dataset, normal_test_dir, holdout_fraction)
+        if use_cache:
+            root = cached_dataset_root(entry_dataset, int(entry["size"]), normal_test_dir=normal_test_dir, holdout=held_out)
+        else:
+            root = DATASETS_DIR / entry_dataset
+            if held_out and not (root / normal_test_dir).is_dir():
+                # Senza la copia ridimensionata non c'è dove spostare le good escluse
+                logger.warning(f"⚠️ {entry['name']}: senza cache nessuna good esclusa dal training, quantizzazione non valutabile")
+                held_out = []
+        for iteration in range(max(1, int(entry.get("iterations", 1)))):
+            tasks.append(TrainTask(
+                entry=entry, dataset=entry_dataset, root=str(root), iteration=iteration, threads=threads,
+                feature_cache=feature_cache, normal_test_dir=normal_test_dir if held_out else None,
+                holdout=tuple(str(path) for path in held_out),
+            ))
+    return tasks
+
+
+def run_tasks(tasks: list[TrainTask], workers: int, worker=None) -> list[dict]:
+    '''Esegue le run nel pool rispettando l'esclusività per (modello, dataset); `worker` di default è _train_run.'''
+    rows, pending, running = [], list(tasks), {}
+    context = multiprocessing.get_context("spawn")  # niente fork di processi con torch/CUDA già inizializzati
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        while pending or running:
+            busy = {task.lock_key for task in running.values()}
+            for task in list(pending):
+                if len(running) >= workers:
+                    break
+                if task.lock_key in busy:
+                    continue
+                running[pool.submit(worker or _train_run, task)] = task
+                busy.add(task.lock_key)
+                pending.remove(task)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    rows.append(future.result())
+                except Exception as e:
+                    logger.exception(f"❌ Training fallito per {task.entry['name']} (run {task.iteration}):")
+                    rows.append({
+                        "name": task.entry["name"], "model": task.entry["model"], "dataset": task.dataset,
+                        "iteration": task.iteration, "seed": task.iteration, "status": "failed", "error": str(e),
+                    })
+    order = {(task.entry["name"], task.iteration): position for position, task in enumerate(tasks)}
+    return sorted(rows, key=lambda row: order[(row["name"], row["iteration"])])
+
+
+def _mean_rows(rows: list[dict]) -> list[dict]:
+    '''Media per entry delle run riuscite, quando le iterazioni sono più di una.'''
+    means = []
+    names = dict.fromkeys(row["name"] for row in rows)
+    for name in names:
+        runs = [row for row in rows if row["name"] == name and row["status"] == "ok"]
+        if len(runs) < 2:
+            continue
+        mean = {"name": name, "model": runs[0]["model"], "dataset": runs[0]["dataset"], "iteration": "mean", "status": "ok"}
+        for column in ("train_s", "test_s", *METRIC_COLUMNS):
+            values = [row[column] for row in runs if row.get(column) is not None]
+            if values:
+                mean[column] = round(sum(values) / len(values), 4)
+        means.append(mean)
+    return means
+
+
+def write_summary(rows: list[dict], workers: int, elapsed: float) -> tuple[Path, Path]:
+    SUMMARY_DIR.mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime("%Y%m%d_%H%M%S")
+    table = rows + _mean_rows(rows)
+
+    csv_path = SUMMARY_DIR / f"summary_{stamp}.csv"
+    with open(csv_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(table)
+
+    md_path = SUMMARY_DIR / f"summary_{stamp}.md"
+    lines = [
+        f"# Training {stamp}",
+        "",
+        f"{len(rows)} run, {workers} processi, {elapsed:.0f}s totali.",
+        "",
+        "| " + " | ".join(SUMMARY_COLUMNS) + " |",
+        "|" + "---|" * len(SUMMARY_COLUMNS),
+    ]
+    for row in table:
+        lines.append("| " + " | ".join(str(row.get(column, "")) for column in SUMMARY_COLUMNS) + " |")
+    md_path.write_text("\n".join(lines) + "\n")
+    return csv_path, md_path
+
+
+def train_entries(
+    entries: list[dict],
+    dataset: str = "hazelnut_toy",
+    workers: int | None = None,
+    mem_per_job_gb: float = 4.0,
+    use_cache: bool = True,
+    feature_cache: str | None = "float32",
+    normal_test_dir: str = "good_test",
+    holdout_fraction: float = 0.2,
+) -> list[dict]:
+    '''Addestra le entry in parallelo e restituisce le righe del riepilogo.'''
+    # Run con lo stesso (modello, dataset) sono serializzate: più processi di così resterebbero fermi
+    parallel = len({(entry["model"], entry.get("dataset", dataset)) for entry in entries})
+    workers, threads = plan_workers(parallel, mem_per_job_gb, workers)
+    tasks = build_tasks(entries, dataset, threads, use_cache, feature_cache, normal_test_dir, holdout_fraction)
+    logger.info(f"🗓️  {len(tasks)} run di training su {workers} processi ({threads} thread ciascuno)")
+
+    start = time.perf_counter()
+    rows = run_tasks(tasks, workers)
+    elapsed = time.perf_counter() - start
+    csv_path, md_path = write_summary(rows, workers, elapsed)
+    logger.info(f"📋 Riepilogo training: {md_path} ({csv_path.name})")
+    return rows
+
+
+def main():
+    from anomalib_runner import select_model_entries
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default=str(CONFIGS_DIR / "anomalib_models.yaml"))
+    parser.add_argument("--names", help="entry da addestrare separate da virgola (default: quelle abilitate)")
+    parser.add_argument("--dataset", default="hazelnut_toy", help="dataset di default, se l'entry non ha `dataset`")
+    parser.add_argument("--workers", type=int, help="processi paralleli (default: in base a core e memoria)")
+    parser.add_argument("--mem-per-job-gb", type=float, default=4.0, help="memoria stimata per run")
+    parser.add_argument("--no-cache", action="store_true", help="usa il dataset originale invece della copia ridimensionata")
+    parser.add_argument(
+        "--feature-cache", choices=["float16", "float32", "off"], default="float32",
+        help="precisione della feature cache (float16: metà disco, ma sposta leggermente memory bank e score)",
+    )
+    parser.add_argument("--normal-test-dir", default="good_test", help="cartella delle good di test, esclusa dal training")
+    parser.add_argument("--holdout-fraction", type=float, default=0.2, help="frazione di good/ esclusa dal training se la cartella manca (0: nessuna)")
+    args = parser.parse_args()
+
+    entries = select_model_entries(Path(args.config), args.names)
+    if not entries:
+        logger.error("Nessun modello da addestrare.")
+        return
+    feature_cache = None if args.feature_cache == "off" else args.feature_cache
+    rows = train_entries(
+        entries, args.dataset, args.workers, args.mem_per_job_gb, not args.no_cache, feature_cache,
+        args.normal_test_dir, args.holdout_fraction,
+    )
+    failed = [row["name"] for row in rows if row["status"] != "ok"]
+    if failed:
+        logger.warning(f"⚠️ Run non riuscite: {failed}")
+
+
+if __name__ == "__main__":
+    main()
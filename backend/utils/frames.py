@@ -0,0 +1,46 @@
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+
+@dataclass(frozen=True)
+class Frame:
+    '''Frame decodificato (BGR) che attraversa la pipeline senza passare dal disco.'''
+    image: np.ndarray
+    frame_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    timestamp: float = field(default_factory=time.time)
+    source: str = "camera"
+
+    @property
+    def shape(self) -> tuple:
+        return self.image.shape
+
+
+def as_frame(item: "Frame | np.ndarray | Path | str", source: str | None = None) -> Frame | None:
+    '''Normalizza l'input delle funzioni di inferenza in un Frame.
+
+    Accetta un Frame, un array BGR già decodificato oppure un percorso su disco
+    (comodo per script e batch offline).
+    '''
+    if isinstance(item, Frame):
+        return item
+    if isinstance(item, np.ndarray):
+        return Frame(image=item, source=source or "array")
+    if isinstance(item, (str, Path)):
+        image = cv2.imread(str(item))
+        if image is None:
+            return None
+        return Frame(image=image, frame_id=Path(item).stem, source=source or str(item))
+    return None
+
+
+def encode_jpeg(image: np.ndarray, quality: int = 90) -> bytes | None:
+    '''Codifica un'immagine BGR in JPEG in memoria.'''
+    ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        return None
+    return buffer.tobytes()
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from utils.logger import get_logger
+from utils.metrics import span
+
+logger = get_logger()
+
+NOT_LOADED = "not_loaded"
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+
+
+class LazyModel:
+    '''Caricamento differito di un modello: al primo utilizzo o con un warmup in background.
+
+    Il loader viene eseguito una sola volta anche con richieste concorrenti; se
+    fallisce lo stato resta `failed` e `get()` restituisce None, come faceva il
+    caricamento all'import.
+    '''
+
+    def __init__(self, name: str, loader: Callable[[], Any]):
+        self.name = name
+        self._loader = loader
+        self._value = None
+        self._lock = threading.Lock()
+        self.state = NOT_LOADED
+        self.error: str | None = None
+        self.load_seconds: float | None = None
+        self.loaded_at: float | None = None
+
+    def get(self) -> Any | None:
+        '''Restituisce il modello, caricandolo se non è ancora stato fatto.'''
+        if self.state == READY:
+            return self._value
+        with self._lock:
+            if self.state in (READY, FAILED):
+                return self._value
+            self.state = LOADING
+            start = time.perf_counter()
+            try:
+                with span("model_load", model=self.name):
+                    self._value = self._loader()
+                self.state = READY
+                self.loaded_at = time.time()
+            except Exception as e:
+                logger.error(f"❌ Failed to load {self.name}: {e}")
+                self._value = None
+                self.state = FAILED
+                self.error = str(e)
+            finally:
+                self.load_seconds = time.perf_counter() - start
+            if self.state == READY:
+                logger.info(f"✅ {self.name} loaded in {self.load_seconds:.2f}s")
+            return self._value
+
+    def reset(self):
+        '''Dimentica il modello caricato (o il fallimento) per ricaricarlo al prossimo uso.'''
+        with self._lock:
+            self._value = None
+            self.state = NOT_LOADED
+            self.error = None
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "load_seconds": round(self.load_seconds, 3) if self.load_seconds is not None else None,
+            "loaded_at": self.loaded_at,
+            "error": self.error,
+        }
+
+
+# Tutti i modelli differiti del processo, per readiness e warmup
+LAZY_MODELS: dict[str, LazyModel] = {}
+
+
+def register_lazy(name: str, loader: Callable[[], Any]) -> LazyModel:
+    lazy = LazyModel(name, loader)
+    LAZY_MODELS[name] = lazy
+    return lazy
+
+
+def warm_in_background(names: list[str] | None = None) -> threading.Thread:
+    '''Carica in sequenza i modelli indicati (tutti se None) in un thread separato.'''
+    selected = [LAZY_MODELS[name] for name in (names or list(LAZY_MODELS)) if name in LAZY_MODELS]
+
+    def warm():
+        for lazy in selected:
+            lazy.get()
+
+    thread = threading.Thread(target=warm, name="model-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def warm_from_env() -> threading.Thread | None:
+    '''Avvia il warmup dei modelli indicati in WARMUP_MODELS (all, none o lista separata da virgole).'''
+    setting = os.getenv('WARMUP_MODELS', 'all').strip().lower()
+    if setting in ('', 'none', 'false'):
+        return None
+    names = None if setting == 'all' else [name.strip() for name in setting.split(',') if name.strip()]
+    return warm_in_background(names)
+
+
+def readiness() -> dict:
+    '''Stato di caricamento di ogni modello registrato.'''
+    return {name: lazy.status() for name, lazy in LAZY_MODELS.items()}
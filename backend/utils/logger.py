@@ -1,11 +1,101 @@
+import atexit
+import copy
+import json
 import logging
 import os
+import queue
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 
 LOGS_DIR = Path(__file__).resolve().parent.parent / "logs"
 LOGS_DIR.mkdir(exist_ok=True)
 
+# LOG_ASYNC=true: chi logga accoda soltanto il record, console e file vengono scritti da un thread dedicato
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()          # formato dei file: text | json
+LOG_MAX_MB = float(os.getenv("LOG_MAX_MB", "20"))              # rotazione dei file (0 = mai)
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "10"))    # messaggi per frame: uno ogni N (1 = tutti)
+# File <logger>.<suffisso>.log: con più processi (worker gunicorn, inference_server) ognuno ruota i propri file,
+# RotatingFileHandler non coordina la rotazione tra processi. Lo imposta gunicorn.conf.py.
+LOG_FILE_SUFFIX = os.getenv("LOG_FILE_SUFFIX", "").strip()
+
+# Da passare come `extra=PER_FRAME` ai messaggi INFO/DEBUG ripetuti per ogni frame o richiesta
+PER_FRAME = {"per_frame": True}
+
+# Identificativi della richiesta / del frame in corso, aggiunti a ogni record
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+frame_id_var: ContextVar[str | None] = ContextVar("frame_id", default=None)
+
+
+def bind_log_context(request_id: str | None = None, frame_id: str | None = None) -> tuple:
+    '''Imposta gli id (None = invariato) e restituisce i token per reset_log_context().'''
+    return (
+        request_id_var.set(request_id if request_id is not None else request_id_var.get()),
+        frame_id_var.set(frame_id if frame_id is not None else frame_id_var.get()),
+    )
+
+
+def reset_log_context(tokens: tuple):
+    '''Ripristina gli id precedenti a bind_log_context(), anche se nel frattempo sono stati cambiati.'''
+    request_token, frame_token = tokens
+    frame_id_var.reset(frame_token)
+    request_id_var.reset(request_token)
+
+
+@contextmanager
+def log_context(request_id: str | None = None, frame_id: str | None = None):
+    '''Id per i log del blocco (richiesta HTTP, operazione del servizio, frame dell'ispezione).'''
+    tokens = bind_log_context(request_id, frame_id)
+    try:
+        yield
+    finally:
+        reset_log_context(tokens)
+
+
+def current_log_context() -> dict:
+    '''Id correnti, serializzabili (es. da inoltrare al processo di inferenza).'''
+    return {key: value for key, value in (("request_id", request_id_var.get()), ("frame_id", frame_id_var.get())) if value}
+
+
+class ContextFilter(logging.Filter):
+    '''Copia nel record request_id e frame_id del contesto di chi logga (prima di passare al thread del listener).'''
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        record.frame_id = frame_id_var.get()
+        ids = [f"req={record.request_id}" if record.request_id else "", f"frame={record.frame_id}" if record.frame_id else ""]
+        record.context = "".join(f" [{value}]" for value in ids if value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    '''Tiene un messaggio PER_FRAME ogni `every` per riga di codice; WARNING e superiori passano sempre.
+
+    Il conteggio non è sincronizzato tra thread: con richieste concorrenti la
+    frequenza è approssimata, il che basta a tenere costante il volume dei log.
+    '''
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(1, every)
+        self._counts: dict[tuple, int] = {}
+
+    def filter(self, record):
+        if self.every == 1 or record.levelno >= logging.WARNING or not getattr(record, "per_frame", False):
+            return True
+        key = (record.pathname, record.lineno)
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        record.sample_rate = self.every
+        return count % self.every == 0
+
+
 class ColorFormatter(logging.Formatter):
     """Formatter that adds color to log messages."""
     COLORS = {
@@ -22,25 +112,150 @@ class ColorFormatter(logging.Formatter):
         msg = super().format(record)
         color = self.COLORS.get(level, self.RESET)
         return f"{color}[{level}] {msg}{self.RESET}"
-    
-def get_logger(name='visioncheck', level=logging.DEBUG):
-    '''Initialize and return a logger with file and console handlers.'''
-    
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with request/frame ids when available."""
+
+    def format(self, record):
+        payload = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key in ("request_id", "frame_id", "sample_rate"):
+            value = getattr(record, key, None)
+            if value:
+                payload[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exception"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class _LoggerQueueHandler(QueueHandler):
+    '''Accoda il record con il messaggio già risolto e il nome del logger a cui è agganciato.
+
+    Il nome serve al listener per scegliere i file: i record propagati dai
+    logger figli (es. `anomalib.models...` della libreria) finiscono nei file
+    del logger padre, come con gli handler sincroni.
+    '''
+
+    def __init__(self, log_queue, route: str):
+        super().__init__(log_queue)
+        self.route = route
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # Il traceback non è serializzabile né sicuro da formattare più tardi
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.route = self.route
+        return record
+
+
+class _RoutingHandler(logging.Handler):
+    '''Lato listener: inoltra ogni record ai handler del logger che l'ha emesso.'''
+
+    def __init__(self):
+        super().__init__()
+        self.routes: dict[str, list[logging.Handler]] = {}
+
+    def emit(self, record):
+        for handler in self.routes.get(record.route, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+_queue: queue.SimpleQueue = queue.SimpleQueue()
+_router = _RoutingHandler()
+_queue_handlers: list[_LoggerQueueHandler] = []
+_listener: QueueListener | None = None
+_listener_pid: int | None = None
+_listener_lock = threading.Lock()
+
+
+def _ensure_listener():
+    global _listener, _listener_pid
+    with _listener_lock:
+        if _listener is None or _listener_pid != os.getpid():
+            _listener = QueueListener(_queue, _router)
+            _listener.start()
+            _listener_pid = os.getpid()
+
+
+def _stop_listener():
+    # Svuota la coda prima di uscire: nessun log perso alla chiusura
+    with _listener_lock:
+        if _listener is not None and _listener_pid == os.getpid():
+            _listener.stop()
+
+
+atexit.register(_stop_listener)
+
+
+def _after_fork_in_child():
+    '''Il thread del listener non sopravvive al fork (es. worker gunicorn): coda e listener nuovi nel figlio.
+
+    Senza, i record del figlio resterebbero nella coda ereditata, che nessuno
+    svuota più. La coda viene sostituita perché il thread del padre poteva
+    tenerne il lock al momento del fork.
+    '''
+    global _queue, _listener, _listener_lock
+    _listener_lock = threading.Lock()
+    _queue = queue.SimpleQueue()
+    for handler in _queue_handlers:
+        handler.queue = _queue
+    if _listener is not None:
+        _listener = None
+        _ensure_listener()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _build_handlers(name: str) -> list[logging.Handler]:
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(ColorFormatter('%(message)s'))
+
+    log_file = LOGS_DIR / (f"{name}.{LOG_FILE_SUFFIX}.log" if LOG_FILE_SUFFIX else f"{name}.log")
+    file_handler = RotatingFileHandler(log_file, maxBytes=int(LOG_MAX_MB * 1024 * 1024), backupCount=LOG_BACKUPS)
+    if LOG_FORMAT == "json":
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_format = logging.Formatter('[%(asctime)s] [%(levelname)s]%(context)s %(message)s', "%Y-%m-%d %H:%M:%S")
+        file_handler.setFormatter(file_format)
+    return [console_handler, file_handler]
+
+
+def get_logger(name='visioncheck', level=None):
+    '''Initialize and return a logger with console and rotating file handlers (queued when LOG_ASYNC).'''
+
     logger = logging.getLogger(name)
-    logger.setLevel(level)
-    
+    logger.setLevel(level if level is not None else LOG_LEVEL)
+
     if logger.handlers:
         return logger  # Return existing logger if already configured
-    
-    console_handler = logging.StreamHandler()
-    console_format = logging.Formatter('%(message)s')
-    console_handler.setFormatter(ColorFormatter(console_format._fmt))
-    logger.addHandler(console_handler)
-    
-    log_file = LOGS_DIR / f"{name}.log"
-    file_handler = logging.FileHandler(log_file)
-    file_format = logging.Formatter('[%(asctime)s] [%(levelname)s] %(message)s', "%Y-%m-%d %H:%M:%S")
-    file_handler.setFormatter(file_format)
-    logger.addHandler(file_handler)
-    
+
+    logger.addFilter(SamplingFilter(LOG_SAMPLE_EVERY))
+    handlers = _build_handlers(name)
+
+    if LOG_ASYNC:
+        queue_handler = _LoggerQueueHandler(_queue, name)
+        queue_handler.addFilter(ContextFilter())
+        _queue_handlers.append(queue_handler)
+        _router.routes[name] = handlers
+        _ensure_listener()
+        logger.addHandler(queue_handler)
+    else:
+        for handler in handlers:
+            handler.addFilter(ContextFilter())
+            logger.addHandler(handler)
+
     return logger
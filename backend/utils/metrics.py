@@ -0,0 +1,332 @@
+'''Tempi per stadio (span), istogrammi ed esposizione in formato Prometheus.
+
+    with span("anomalib_forward"):
+        outputs = run_inference_plan(...)
+
+    @timed("yolo_forward")
+    def predict(...): ...
+
+Ogni span aggiorna l'istogramma `visioncheck_stage_seconds{stage="..."}`. Se
+nel contesto corrente è aperta una traccia (vedi `trace()`), la durata viene
+aggiunta anche lì, per l'header Server-Timing della richiesta. Gli span
+eseguiti in altri thread (batcher, writer) finiscono solo negli istogrammi.
+
+Con METRICS_ENABLED=false `span()` restituisce un context manager vuoto
+condiviso: il costo è una chiamata di funzione.
+
+Con più processi HTTP (gunicorn) i worker non espongono metriche proprie:
+un MetricsForwarder invia le loro osservazioni al processo di inferenza, che
+è l'unico registro letto da /metrics.
+'''
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+# Secondi: dalla conversione colore di un frame al caricamento di un checkpoint
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+ENABLED = True
+TIMING_HEADERS = False
+
+
+def configure(enabled: bool | None = None, timing_headers: bool | None = None):
+    '''Legge METRICS_ENABLED e METRICS_TIMING_HEADERS (da richiamare dopo load_dotenv).'''
+    global ENABLED, TIMING_HEADERS
+    ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true" if enabled is None else enabled
+    TIMING_HEADERS = (
+        os.getenv("METRICS_TIMING_HEADERS", "false").lower() == "true" if timing_headers is None else timing_headers
+    )
+
+
+configure()
+
+
+class Histogram:
+    '''Istogramma a bucket fissi, una serie per combinazione di label.'''
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}  # label -> [conteggio per bucket..., +Inf, somma]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: tuple = ()):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[position] += 1
+            series[-1] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            series = [
+                {"labels": dict(labels), "counts": values[:-1], "sum": values[-1]}
+                for labels, values in self._series.items()
+            ]
+        return {"type": self.type, "help": self.help, "buckets": list(self.buckets), "series": series}
+
+
+class Counter:
+    '''Contatore monotono, una serie per combinazione di label.'''
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._series: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            series = [{"labels": dict(labels), "value": value} for labels, value in self._series.items()]
+        return {"type": self.type, "help": self.help, "series": series}
+
+
+# Registro del processo
+REGISTRY: dict[str, Histogram | Counter] = {}
+
+
+def histogram(name: str, help: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.setdefault(name, Histogram(name, help, buckets))
+
+
+def counter(name: str, help: str) -> Counter:
+    return REGISTRY.setdefault(name, Counter(name, help))
+
+
+def labels(**values) -> tuple:
+    '''Chiave di serie ordinata, da passare a observe()/inc().'''
+    return tuple(sorted((key, str(value)) for key, value in values.items()))
+
+
+STAGE_SECONDS = histogram("visioncheck_stage_seconds", "Durata degli stadi di acquisizione, inferenza e salvataggio")
+STAGE_ERRORS = counter("visioncheck_stage_errors_total", "Stadi terminati con un'eccezione")
+# Registrato in ogni processo: i worker HTTP lo osservano, il processo di inferenza riceve le loro osservazioni
+HTTP_REQUEST_SECONDS = histogram("visioncheck_http_request_seconds", "Durata delle richieste HTTP per rotta")
+
+# Span della richiesta corrente: lista di (stadio, secondi) oppure None
+_trace: ContextVar[list | None] = ContextVar("metrics_trace", default=None)
+
+
+class _Span:
+    __slots__ = ("stage", "labels", "start")
+
+    def __init__(self, stage: str, series: tuple):
+        self.stage = stage
+        self.labels = series
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(elapsed, self.labels)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(self.labels)
+        timings = _trace.get()
+        if timings is not None:
+            timings.append((self.stage, elapsed))
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(stage: str, **extra):
+    '''Misura il blocco come stadio `stage` (label aggiuntive opzionali, a bassa cardinalità).'''
+    if not ENABLED:
+        return _NOOP_SPAN
+    return _Span(stage, labels(stage=stage, **extra))
+
+
+def timed(stage: str, **extra):
+    '''Decoratore equivalente a `with span(stage):` attorno all'intera funzione.'''
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage, **extra):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def trace():
+    '''Raccoglie gli span del contesto corrente per l'header Server-Timing.
+
+    Restituisce la lista solo a chi apre la traccia; dentro una traccia già
+    aperta (es. app e servizio nello stesso processo) restituisce None e gli
+    span finiscono in quella esterna.
+    '''
+    if not (ENABLED and TIMING_HEADERS) or _trace.get() is not None:
+        yield None
+        return
+    timings: list = []
+    token = _trace.set(timings)
+    try:
+        yield timings
+    finally:
+        _trace.reset(token)
+
+
+def begin_trace():
+    '''Come trace(), per chi apre e chiude in due punti diversi (before/after_request).'''
+    if not (ENABLED and TIMING_HEADERS) or _trace.get() is not None:
+        return None
+    return _trace.set([])
+
+
+def end_trace(token) -> list:
+    if token is None:
+        return []
+    timings = _trace.get() or []
+    _trace.reset(token)
+    return timings
+
+
+def add_timings(timings: list):
+    '''Aggiunge alla traccia corrente gli span misurati altrove (es. nel processo di inferenza).'''
+    current = _trace.get()
+    if current is not None and timings:
+        current.extend((stage, seconds) for stage, seconds in timings)
+
+
+def server_timing(timings: list, total_s: float | None = None) -> str:
+    '''Valore dell'header Server-Timing; gli span ripetuti dello stesso stadio vengono sommati.'''
+    totals: dict[str, float] = {}
+    for stage, seconds in timings:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    if total_s is not None:
+        totals["total"] = total_s
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items())
+
+
+class MetricsForwarder:
+    '''Osservazioni di istogrammi da registrare in un altro processo, inviate in blocco da un thread.
+
+    `send(osservazioni)` riceve una lista di [nome, valore, label] ogni
+    `interval_s`; se fallisce il blocco viene scartato (e contato), così le
+    richieste HTTP non attendono mai il processo di inferenza.
+    '''
+
+    def __init__(self, send, interval_s: float = 1.0, max_pending: int = 10000):
+        self.send = send
+        self.interval_s = interval_s
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending: list = []
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def observe(self, metric: Histogram, value: float, series: tuple = ()):
+        with self._lock:
+            if len(self._pending) < self.max_pending:
+                self._pending.append([metric.name, value, [list(pair) for pair in series]])
+            else:
+                self.dropped += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="metrics-forwarder", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval_s)
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                continue
+            try:
+                self.send(batch)
+            except Exception:
+                self.dropped += len(batch)
+
+
+def record(observations: list):
+    '''Registra le osservazioni ricevute da un MetricsForwarder; i nomi sconosciuti vengono ignorati.'''
+    for name, value, series in observations:
+        metric = REGISTRY.get(name)
+        if isinstance(metric, Histogram):
+            metric.observe(float(value), tuple(tuple(pair) for pair in series))
+
+
+def snapshot() -> dict:
+    '''Stato serializzabile (JSON) di tutte le metriche del processo.'''
+    return {name: metric.snapshot() for name, metric in REGISTRY.items()}
+
+
+def _merge(snapshots: tuple) -> dict:
+    '''Unisce gli snapshot di più processi sommando le serie con le stesse label.'''
+    merged: dict = {}
+    for current in snapshots:
+        for name, metric in current.items():
+            target = merged.setdefault(name, {**metric, "series": []})
+            for series in metric["series"]:
+                existing = next((item for item in target["series"] if item["labels"] == series["labels"]), None)
+                if existing is None:
+                    series = dict(series)
+                    if "counts" in series:
+                        series["counts"] = list(series["counts"])
+                    target["series"].append(series)
+                elif metric["type"] == "histogram":
+                    existing["counts"] = [a + b for a, b in zip(existing["counts"], series["counts"])]
+                    existing["sum"] += series["sum"]
+                else:
+                    existing["value"] += series["value"]
+    return merged
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(values: dict, extra: tuple = ()) -> str:
+    pairs = [*values.items(), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in pairs) + "}"
+
+
+def render_prometheus(*snapshots: dict) -> str:
+    '''Formato di esposizione testuale di Prometheus (0.0.4).'''
+    lines = []
+    for name, metric in _merge(snapshots or (snapshot(),)).items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for series in metric["series"]:
+            label_text = _format_labels(series["labels"])
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{label_text} {series['value']}")
+                continue
+            cumulative = 0
+            bounds = [f"{bound:g}" for bound in metric["buckets"]] + ["+Inf"]
+            for bound, count in zip(bounds, series["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(series['labels'], (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{label_text} {series['sum']:.6f}")
+            lines.append(f"{name}_count{label_text} {cumulative}")
+    return "\n".join(lines) + "\n"
@@ -7,7 +7,7 @@ ROOT_DIR = Path(__file__).resolve().parent.parent.parent
 # Percorsi interni
 BACKEND_DIR = ROOT_DIR / "backend"
 FRONTEND_DIR = ROOT_DIR / "frontend"
-DATA_DIR = ROOT_DIR / "data"
+DATA_DIR = Path(os.getenv("DATA_DIR", ROOT_DIR / "data"))  # sovrascrivibile, es. dal benchmark
 MODELS_DIR = ROOT_DIR / "backend" / "models"
 CONFIGS_DIR = ROOT_DIR / "configs"
 DATASETS_DIR = ROOT_DIR / "datasets"
@@ -0,0 +1,229 @@
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from utils.logger import get_logger
+from utils.paths import DATA_DIR
+from utils.frames import encode_jpeg
+from utils.metrics import span
+
+logger = get_logger()
+
+# Cartelle di output gestite dalla retention
+RESULT_FOLDERS = ("images", "yolo", "sam", "anomalib")
+
+
+@dataclass
+class RetentionPolicy:
+    '''Regole di pulizia di una cartella di output (0 = nessun limite).'''
+    max_age_s: float = 0
+    max_bytes: int = 0
+    keep_only_defects: bool = False
+
+    @classmethod
+    def from_env(cls, folder: str) -> "RetentionPolicy":
+        '''Legge RETENTION_<CARTELLA>_* con fallback sui valori globali RETENTION_*.'''
+        def setting(name: str, default: str) -> str:
+            return os.getenv(f"RETENTION_{folder.upper()}_{name}", os.getenv(f"RETENTION_{name}", default))
+
+        return cls(
+            max_age_s=float(setting("MAX_AGE_H", "0")) * 3600,
+            max_bytes=int(float(setting("MAX_MB", "0")) * 1024 * 1024),
+            keep_only_defects=setting("KEEP_ONLY_DEFECTS", "false").lower() == "true",
+        )
+
+
+@dataclass
+class StoredImage:
+    '''Risultato codificato una sola volta: i byte servono alla risposta, il file arriva in background.'''
+    jpeg: bytes
+    path: Path | None  # None se la scrittura è stata scartata (policy o coda piena)
+
+    @property
+    def name(self) -> str | None:
+        return self.path.name if self.path else None
+
+
+class AsyncImageWriter:
+    '''Pool di thread che scrive immagini su disco fuori dal percorso della richiesta.
+
+    La coda è limitata: se il disco non tiene il passo le nuove scritture vengono
+    scartate invece di bloccare l'inferenza. Un thread separato applica
+    periodicamente le RetentionPolicy alle cartelle di output.
+    '''
+
+    def __init__(self, workers: int = 2, max_queue: int = 64, sweep_interval_s: float = 60.0, root: Path = DATA_DIR):
+        self.workers = max(1, workers)
+        self.sweep_interval_s = sweep_interval_s
+        self.root = Path(root)
+        self.policies = {folder: RetentionPolicy.from_env(folder) for folder in RESULT_FOLDERS}
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._threads: list[threading.Thread] = []
+        self._sweeper: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+        self._stats = {
+            "submitted": 0,
+            "written": 0,
+            "written_bytes": 0,
+            "dropped_queue_full": 0,
+            "skipped_by_policy": 0,
+            "failed": 0,
+            "deleted_files": 0,
+            "deleted_bytes": 0,
+        }
+        self._write_seconds = 0.0
+
+    def _count(self, key: str, amount: int = 1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _ensure_started(self):
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, name=f"image-writer-{len(self._threads)}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            if self._sweeper is None or not self._sweeper.is_alive():
+                self._sweeper = threading.Thread(target=self._sweep_loop, name="retention-sweeper", daemon=True)
+                self._sweeper.start()
+
+    def submit(self, path: Path, payload: np.ndarray | bytes, is_defect: bool | None = None) -> bool:
+        '''Accoda la scrittura; restituisce False se scartata per policy o coda piena.'''
+        path = Path(path)
+        policy = self.policies.get(path.parent.name)
+        if policy is not None and policy.keep_only_defects and is_defect is False:
+            self._count("skipped_by_policy")
+            return False
+
+        self._ensure_started()
+        self._count("submitted")
+        try:
+            self._queue.put_nowait((path, payload))
+            return True
+        except queue.Full:
+            self._count("dropped_queue_full")
+            logger.warning(f"⚠️ Write queue full, dropping {path.name}")
+            return False
+
+    def _write(self, path: Path, payload: np.ndarray | bytes) -> int:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Scrittura su file temporaneo + rename: chi legge non vede mai file parziali
+        tmp_path = path.with_name(f".{path.stem}.tmp{path.suffix}")
+        if isinstance(payload, (bytes, bytearray)):
+            tmp_path.write_bytes(payload)
+        elif not cv2.imwrite(str(tmp_path), payload):
+            raise OSError(f"cv2.imwrite failed for {tmp_path}")
+        os.replace(tmp_path, path)
+        return path.stat().st_size
+
+    def _worker(self):
+        while True:
+            path, payload = self._queue.get()
+            start = time.perf_counter()
+            try:
+                with span("jpeg_write", folder=path.parent.name):
+                    size = self._write(path, payload)
+                with self._lock:
+                    self._stats["written"] += 1
+                    self._stats["written_bytes"] += size
+                    self._write_seconds += time.perf_counter() - start
+            except Exception as e:
+                self._count("failed")
+                logger.error(f"❌ Failed to write {path}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self.sweep_interval_s)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("❌ Retention sweep failed:")
+
+    def sweep(self):
+        '''Applica età massima e quota di byte a ogni cartella di output.'''
+        now = time.time()
+        for folder, policy in self.policies.items():
+            if policy.max_age_s <= 0 and policy.max_bytes <= 0:
+                continue
+            directory = self.root / folder
+            if not directory.is_dir():
+                continue
+
+            files = []
+            for path in directory.iterdir():
+                if not path.is_file() or path.name.startswith("."):
+                    continue
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+            files.sort()  # dal più vecchio
+
+            total = sum(size for _, size, _ in files)
+            for mtime, size, path in files:
+                expired = policy.max_age_s > 0 and now - mtime > policy.max_age_s
+                over_quota = policy.max_bytes > 0 and total > policy.max_bytes
+                if not expired and not over_quota:
+                    break
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+                total -= size
+                self._count("deleted_files")
+                self._count("deleted_bytes", size)
+
+    def flush(self):
+        '''Attende che tutte le scritture in coda siano completate.'''
+        self._queue.join()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            written = self._stats["written"]
+            return {
+                **self._stats,
+                "pending": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+                "workers": self.workers,
+                "avg_write_ms": round(1000 * self._write_seconds / written, 2) if written else 0,
+                "policies": {
+                    folder: {
+                        "max_age_h": policy.max_age_s / 3600,
+                        "max_mb": policy.max_bytes / 1024 ** 2,
+                        "keep_only_defects": policy.keep_only_defects,
+                    }
+                    for folder, policy in self.policies.items()
+                },
+            }
+
+
+# Writer condiviso da tutto il processo
+image_writer = AsyncImageWriter(
+    workers=int(os.getenv("WRITER_WORKERS", "2")),
+    max_queue=int(os.getenv("WRITER_MAX_QUEUE", "64")),
+    sweep_interval_s=float(os.getenv("RETENTION_SWEEP_S", "60")),
+)
+
+
+def store_result(folder: str, filename: str, image: np.ndarray, is_defect: bool | None = None) -> StoredImage | None:
+    '''Codifica il risultato in JPEG e ne accoda il salvataggio in DATA_DIR/<folder>.'''
+    with span("jpeg_encode", folder=folder):
+        jpeg = encode_jpeg(image)
+    if jpeg is None:
+        logger.error(f"❌ JPEG encoding failed for {filename}")
+        return None
+    path = DATA_DIR / folder / filename
+    accepted = image_writer.submit(path, jpeg, is_defect=is_defect)
+    return StoredImage(jpeg=jpeg, path=path if accepted else None)
@@ -0,0 +1,19 @@
+'''Entry point WSGI di produzione.
+
+I worker HTTP non caricano modelli né aprono la camera: inoltrano tutto al
+processo inference_server.py, avviato da gunicorn.conf.py.
+
+    cd backend && gunicorn -c gunicorn.conf.py wsgi:app
+'''
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from inference_server import DEFAULT_ADDRESS
+
+# In produzione l'inferenza è sempre nel processo condiviso
+os.environ.setdefault("INFERENCE_ADDRESS", DEFAULT_ADDRESS)
+
+from app import app  # noqa: E402
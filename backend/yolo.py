@@ -1,38 +1,77 @@
-from ultralytics import YOLO
 from pathlib import Path
-from utils.logger import get_logger
+from utils.logger import PER_FRAME, get_logger
 import uuid
 from utils.paths import DATA_DIR, MODELS_DIR
 import cv2
+import numpy as np
 import os
+import threading
+from utils.frames import Frame, as_frame
+from utils.storage import StoredImage, store_result
+from utils.lazy import register_lazy
+from utils.metrics import span
 
 logger = get_logger('yolo')
 
-# carica il modello una volta sola per evitare di ricaricarlo ad ogni richiesta
-
-try:
-    model = YOLO(MODELS_DIR / 'yolov8n.pt')
-    logger.info(f"✅ Yolo model loaded")
-except Exception as e:
-    logger.error(f"❌ Failed to load model {e}")
-    model = None
-    
-def run_yolo(image_path: Path) -> Path | None:
-    '''Esegue il modello YOLO su un'immagine e salva i risultati.'''
+# carica il modello una volta sola (al primo utilizzo o nel warmup) per evitare di ricaricarlo ad ogni richiesta
+
+def _load_yolo():
+    from ultralytics import YOLO
+    return YOLO(MODELS_DIR / 'yolov8n.pt')
+
+yolo_model = register_lazy("yolo", _load_yolo)
+
+# Il predictor di ultralytics non è thread-safe: batcher, ispezione continua e YOLO+SAM passano tutti da qui
+_predict_lock = threading.Lock()
+
+def predict_frames(frames: list[Frame], **kwargs) -> list | None:
+    '''Forward YOLO batched su frame già decodificati; restituisce i Results di ultralytics.'''
+    model = yolo_model.get()
     if model is None:
         logger.error("❌ YOLO model is not loaded, cannot run detection.")
         return None
     try:
-        results = model.predict(source=str(image_path), save=True, save_txt=True, save_conf=True)
+        with _predict_lock, span("yolo_forward"):
+            return model.predict(source=[frame.image for frame in frames], verbose=False, **kwargs)  # array BGR in memoria, nessuna rilettura da disco
     except Exception as e:
         logger.error(f"Errore durante la predizione: {e}")
         return None
-    
-    # save
-    annotated = results[0].plot() # save the image with bounding boxes
-    output_name = f'yolo_{uuid.uuid4().hex}.jpg'
-    output_path = DATA_DIR / 'yolo' / output_name
-    os.makedirs(output_path.parent, exist_ok=True)  # Assicura che la cartella yolo esista
-    cv2.imwrite(str(output_path), annotated)
-    logger.info(f"✅ YOLO detection completed, results saved to {output_path}")
-    return output_path
\ No newline at end of file
+
+
+def run_yolo_batch(frames: list, raw: bool | list[bool] = False) -> list:
+    '''Esegue YOLO su più frame con un solo forward e salva i risultati.
+
+    Per i frame con `raw` restituisce i Results di ultralytics senza disegnarli
+    né salvarli (l'ispezione continua compone il proprio overlay).
+    '''
+    if isinstance(raw, bool):
+        raw = [raw] * len(frames)
+    frames = [as_frame(frame) for frame in frames]
+    valid = [index for index, frame in enumerate(frames) if frame is not None]
+    if len(valid) != len(frames):
+        logger.error("❌ Invalid input frame for YOLO.")
+    outputs: list = [None] * len(frames)
+    if not valid:
+        return outputs
+
+    results = predict_frames([frames[index] for index in valid])
+    if results is None:
+        return outputs
+
+    for index, result in zip(valid, results):
+        if raw[index]:
+            outputs[index] = result
+            continue
+        # save (in background, la risposta usa i byte già codificati)
+        with span("yolo_render"):
+            annotated = result.plot() # save the image with bounding boxes
+        output_name = f'yolo_{frames[index].frame_id}_{uuid.uuid4().hex[:8]}.jpg'
+        outputs[index] = store_result('yolo', output_name, annotated)
+
+    logger.info(f"✅ YOLO detection completed on {len(valid)} frame(s)", extra=PER_FRAME)
+    return outputs
+
+
+def run_yolo(frame: Frame | np.ndarray | Path) -> StoredImage | None:
+    '''Esegue il modello YOLO su un frame e salva i risultati.'''
+    return run_yolo_batch([frame])[0]
@@ -0,0 +1,63 @@
+import uuid
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from utils.logger import PER_FRAME, get_logger
+from utils.frames import Frame, as_frame
+from utils.storage import StoredImage, store_result
+
+from yolo import predict_frames
+from sam import segment_prompts
+
+logger = get_logger('sam')
+
+MASK_COLOR = np.array([0, 255, 0], dtype=np.uint8)  # verde (BGR)
+
+
+def _draw_detections(annotated: np.ndarray, masks: np.ndarray) -> np.ndarray:
+    '''Riempimento semitrasparente e contorno delle maschere sopra le box YOLO.'''
+    if len(masks) == 0:
+        return annotated
+    union = np.any(masks, axis=0)
+    annotated[union] = (0.6 * annotated[union] + 0.4 * MASK_COLOR).astype(np.uint8)
+    for seg in masks:
+        contours, _ = cv2.findContours(seg.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        cv2.drawContours(annotated, contours, -1, MASK_COLOR.tolist(), 2)
+    return annotated
+
+
+def run_yolo_sam(frame: Frame | np.ndarray | Path, conf: float | None = None) -> StoredImage | None:
+    '''Detect-then-segment: le box YOLO diventano prompt per SAM in un'unica chiamata del decoder.
+
+    Si segmentano solo gli oggetti rilevati, quindi il costo del decoder cresce
+    con il numero di oggetti invece che con la griglia di punti della
+    generazione automatica.
+    '''
+    frame = as_frame(frame)
+    if frame is None:
+        logger.error("❌ Impossibile leggere il frame in ingresso")
+        return None
+
+    results = predict_frames([frame], **({"conf": conf} if conf is not None else {}))
+    if not results:
+        return None
+    detections = results[0]
+    boxes = detections.boxes.xyxy.cpu().numpy() if detections.boxes is not None else np.empty((0, 4))
+
+    annotated = detections.plot()  # box e classi YOLO
+    if len(boxes) > 0:
+        try:
+            segmented = segment_prompts(frame, boxes=boxes.tolist())
+        except Exception as e:
+            logger.error(f"❌ Errore durante la segmentazione delle box YOLO: {e}")
+            return None
+        if segmented is None:
+            return None
+        masks, _ = segmented
+        annotated = _draw_detections(annotated, masks)
+
+    logger.info(f"✅ YOLO+SAM: {len(boxes)} oggetti segmentati", extra=PER_FRAME)
+    filename = f"yolo_sam_{frame.frame_id}_{uuid.uuid4().hex[:8]}.jpg"
+    return store_result('sam', filename, annotated)